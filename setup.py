@@ -33,7 +33,8 @@ test_requirements = [
     "pytest",
     "coverage",
     "python-coveralls",
-    "mock"
+    "mock",
+    "lmdb"
 ]
 
 class PyTest(TestCommand):
@@ -2,32 +2,120 @@
 # coding: utf8
 from __future__ import unicode_literals
 import re
+import time
+import bisect
+import array
 import logging
-import redis
+from itertools import islice
 
-from .backend import FileStorage, RedisStorage, DynamoStorage
-from .models import Bucket, ResultSet, BucketType
-from ..errors import NotFoundError
+from .backend import load_backend
+from .models import Bucket, ResultSet, BucketType, AlignedFrame
+from .models import aggregation_function, CALENDAR_WINDOWS
+from .cache import QueryCache
+from ..errors import NotFoundError, ConflictError
 
 
 logger = logging.getLogger(__name__)
 
 
+def check_key(key):
+    """Return the lower case key or raise ValueError if it is invalid.
+    """
+    key = key.lower()
+    if not re.match(r'^[A-Za-z0-9_\-\.]+$', key):
+        raise ValueError("Key should be alphanumeric (including .-_)")
+    return key
+
+
+def pattern_regex(pattern):
+    """Compile a key pattern.
+
+    ``*`` matches within one level of the dotted hierarchy, ``**`` across
+    levels and ``?`` matches a single character.
+    """
+    if not re.match(r'^[A-Za-z0-9_\-\.\*\?]+$', pattern):
+        raise ValueError("Pattern should be alphanumeric (including .-_*?)")
+    out = []
+    for token in re.split(r'(\*\*|\*|\?)', pattern.lower()):
+        if token == "**":
+            out.append(".*")
+        elif token == "*":
+            out.append(r"[^.]*")
+        elif token == "?":
+            out.append(r"[^.]")
+        else:
+            out.append(re.escape(token))
+    return re.compile("^" + "".join(out) + "$")
+
+
+def columns(data):
+    """Convert insert data to sorted (timestamps, values) columns.
+
+    ``data`` is a list of (ts, value) tuples, a (timestamps, values) pair
+    of arrays or lists or a buffer of packed native ``If`` records. Sorted
+    input is detected in one pass and not copied again.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        # bytes() of a memoryview is its repr on Python 2
+        data = memoryview(data).tobytes()
+        if len(data) % 8 != 0:
+            raise ValueError("Packed data should be 8 byte (If) records")
+        raw = array.array("I")
+        raw.fromstring(data)
+        floats = array.array("f")
+        floats.fromstring(data)
+        timestamps, values = raw[0::2], floats[1::2]
+    elif isinstance(data, tuple) and len(data) == 2:
+        timestamps, values = data
+        # A pair of (ts, value) points is not a columnar form
+        if not all(isinstance(c, (array.array, list)) for c in data):
+            raise ValueError("Columns should be arrays or lists")
+        if len(timestamps) != len(values):
+            raise ValueError("Timestamps and values differ in length")
+        if getattr(timestamps, "typecode", None) != "I":
+            timestamps = array.array("I", [int(t) for t in timestamps])
+    elif isinstance(data, list):
+        if len(data) < 1:
+            raise ValueError("No data to insert")
+        timestamps, values = zip(*data)
+        timestamps = array.array("I", [int(t) for t in timestamps])
+    else:
+        raise ValueError("Data should be a list, a (timestamps, values) "
+                         "tuple or packed records")
+    if len(timestamps) < 1:
+        raise ValueError("No data to insert")
+    if all(a <= b for a, b in zip(timestamps, islice(timestamps, 1, None))):
+        return timestamps, values
+    # Stable, the first of equal timestamps stays first
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    return (array.array("I", [timestamps[i] for i in order]),
+            [values[i] for i in order])
+
+
 class TSDB(object):
     def __init__(self, STORAGE="file", **kwargs):
         self.settings = {
             "BUCKET_TYPE": "daily",
             "BUCKET_DYNAMIC_TARGET": 100,
             "BUCKET_DYNAMIC_MAX": 200,
-            "REDIS_PORT": 6379,
-            "REDIS_HOST": "localhost",
-            "REDIS_DB": 0,
             "ENABLE_CACHING": False,
             "ENABLE_EVENTS": False,
-            "FILE_STORAGE_FOLDER": "./stss/",
-            "DYNAMO_TABLE_NAME": "data_table",
-            "DYNAMO_LOCAL": True
+            "INSERT_RETRIES": 5,
+            "APPEND_CHUNKS": False,
+            "APPEND_CHUNKS_MAX": 32,
+            "QUERY_PARALLELISM": 8,
+            "ENABLE_SKETCHES": False,
+            "CACHE_MAX_ENTRIES": 1000,
+            "CACHE_LIVE_TTL": 10,
+            "CACHE_LIVE_MARGIN": 300,
+            "ENABLE_INDEX": True,
+            "RETENTION": {},
+            "CONSISTENT_QUERIES": True,
+            "SETTLED_HORIZON": None
         }
+        # Defaults of the backend settings
+        storage_class = load_backend(STORAGE)
+        self.settings.update(storage_class.SETTINGS)
         self.settings.update(kwargs)
 
         # Setup Item Model
@@ -35,29 +123,23 @@ class TSDB(object):
         Bucket.DYNAMICSIZE_MAX = self.settings["BUCKET_DYNAMIC_MAX"]
         Bucket.DEFAULT_BUCKETTYPE = BucketType[self.settings["BUCKET_TYPE"]]
 
-        # Setup Redis Pool
-        self.redis_pool = redis.ConnectionPool(host=self.settings["REDIS_HOST"],
-                                               port=self.settings["REDIS_PORT"],
-                                               db=self.settings["REDIS_DB"])
-
-        # Setup Storage
-        if STORAGE == "file":
-            self.storage = FileStorage()
-        elif STORAGE == "redis":
-            self.storage = RedisStorage(connection_pool=self.redis_pool)
-        elif STORAGE == "dynamo":
-            self.storage = DynamoStorage(table_name=self.settings["DYNAMO_TABLE_NAME"],
-                                         local_dynamo=self.settings["DYNAMO_LOCAL"])
-        else:
-            raise NotImplementedError("Storage not implemented")
+        # Setup Storage, only the configured backend is imported
+        self.storage = storage_class.from_settings(self.settings)
+        self.storage.store_sketches = self.settings["ENABLE_SKETCHES"]
+
+        # Known end of each key for blind appends (APPEND_CHUNKS)
+        self._tails = {}
 
         # Event Class
         if self.settings["ENABLE_EVENTS"]:
             pass
 
+        self.cache = None
         if self.settings["ENABLE_CACHING"]:
-            pass
-
+            self.cache = QueryCache(
+                self.settings["CACHE_MAX_ENTRIES"],
+                live_ttl=self.settings["CACHE_LIVE_TTL"],
+                live_margin=self.settings["CACHE_LIVE_MARGIN"])
 
     def _get_last_item_or_new(self, key):
         # Get it from DB
@@ -67,22 +149,220 @@ class TSDB(object):
             item = Bucket.new(key)
         return item
 
-    def _get_items_between(self, key, ts_min, ts_max):
-        return self.storage.query(key, ts_min, ts_max)
+    def _get_items_between(self, key, ts_min, ts_max, consistent=True):
+        return self.storage.query(key, ts_min, ts_max, consistent=consistent)
 
-    def query(self, key, ts_min, ts_max):
-        return self._query(key, ts_min, ts_max)
+    def _consistent(self, ts_max, consistent=None):
+        """Whether a query ending at ts_max needs a consistent read.
 
-    def _query(self, key, ts_min, ts_max):
-        r = ResultSet(key, self._get_items_between(key, ts_min, ts_max))
+        Without an explicit ``consistent`` queries follow
+        CONSISTENT_QUERIES, windows ending more than SETTLED_HORIZON
+        seconds ago are read eventually consistent. The insert path always
+        reads consistently.
+        """
+        if consistent is not None:
+            return consistent
+        if not self.settings["CONSISTENT_QUERIES"]:
+            return False
+        horizon = self.settings["SETTLED_HORIZON"]
+        if horizon is not None and ts_max < time.time() - horizon:
+            return False
+        return True
+
+    def query(self, key, ts_min, ts_max, consistent=None):
+        return self._query(key, ts_min, ts_max, consistent)
+
+    def _query(self, key, ts_min, ts_max, consistent=None):
+        if self.settings["APPEND_CHUNKS"]:
+            self._fold_chunks(key)
+        r = ResultSet(key, self._get_items_between(
+            key, ts_min, ts_max, self._consistent(ts_max, consistent)))
         r._trim(ts_min, ts_max)
         return r
 
+    def aggregate(self, key, ts_min, ts_max, group="hourly", function="mean",
+                  window=None, exact=False, consistent=None):
+        """Query and aggregate a key, returns a list of (ts, value).
+
+        With ENABLE_CACHING the result is cached until a write touches
+        the queried window, windows reaching into the last
+        CACHE_LIVE_MARGIN seconds at most for CACHE_LIVE_TTL seconds.
+        ``consistent`` overrides the read consistency
+        of the query, see _consistent.
+        """
+        key = key.lower()
+        cache_key = (key, ts_min, ts_max, group, function, window, exact)
+        if self.cache is not None:
+            res = self.cache.get(cache_key)
+            if res is not None:
+                return res
+        res = list(self._query(key, ts_min, ts_max, consistent)
+                   .aggregation(group, function, window=window, exact=exact))
+        if self.cache is not None:
+            self.cache.put(cache_key, res)
+        return res
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def _invalidate(self, key, ts_min, ts_max):
+        if self.cache is not None:
+            self.cache.invalidate(key, ts_min, ts_max)
+
+    def _map_keys(self, func, keys):
+        """Apply func to each key, in parallel if the storage allows it.
+        """
+        parallelism = min(len(keys), self.settings["QUERY_PARALLELISM"])
+        if not self.storage.CONCURRENT_READS or parallelism < 2:
+            return [func(k) for k in keys]
+        # Only imported when needed, it is slow to import
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(parallelism)
+        try:
+            return pool.map(func, keys)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _query_many(self, keys, ts_min, ts_max):
+        """Query several keys, in parallel if the storage allows it.
+        """
+        return self._map_keys(lambda k: self._query(k, ts_min, ts_max), keys)
+
+    def resolve_pattern(self, pattern):
+        """Return the sorted keys matching a pattern, see pattern_regex.
+        """
+        regex = pattern_regex(pattern)
+        prefix = re.split(r'[\*\?]', pattern.lower(), 1)[0]
+        return [k for k in self.storage.list_keys(prefix) if regex.match(k)]
+
+    def query_pattern(self, pattern, ts_min, ts_max, aggregation=None,
+                      group="hourly", reduce=None):
+        """Query all keys matching a pattern.
+
+        Without ``aggregation`` a dict key -> ResultSet is returned. With an
+        aggregation function each series is aggregated per ``group``
+        window (dict key -> list of (ts, value)). ``reduce`` (sum, mean,
+        min, max, ...) then combines the series into one list of
+        (ts, value) per window.
+        """
+        keys = self.resolve_pattern(pattern)
+        if reduce is not None:
+            if aggregation is None:
+                raise ValueError("reduce needs an aggregation")
+            reduce_func = aggregation_function(reduce)
+        if aggregation is None:
+            return dict(zip(keys, self._query_many(keys, ts_min, ts_max)))
+
+        def aggregate(k):
+            return self.aggregate(k, ts_min, ts_max, group, aggregation)
+        results = dict(zip(keys, self._map_keys(aggregate, keys)))
+        if reduce is None:
+            return results
+        windows = {}
+        for res in results.values():
+            for ts, value in res:
+                if value is not None:
+                    windows.setdefault(ts, []).append(value)
+        return [(ts, reduce_func(windows[ts])) for ts in sorted(windows)]
+
+    def query_aligned(self, keys, ts_min, ts_max, step=None, fill="none"):
+        """Query several keys on one shared timestamp axis.
+
+        Returns an AlignedFrame, see AlignedFrame.align for step and fill.
+        """
+        results = self._query_many(keys, ts_min, ts_max)
+        return AlignedFrame.align(keys, results, ts_min, ts_max,
+                                  step=step, fill=fill)
+
+    def list_keys(self, prefix=""):
+        """Return all known keys starting with prefix.
+        """
+        return self.storage.list_keys(prefix.lower())
+
+    def describe(self, key):
+        """Return the index entry of a key.
+
+        Contains item and bucket type, the number of buckets, points and
+        stored bytes and the first and last timestamp.
+        """
+        key = key.lower()
+        meta = self.storage.get_meta(key)
+        if meta is None:
+            raise NotFoundError("Key {} not found".format(key))
+        return meta
+
+    def _update_meta(self, key, deltas, written=(), refresh=False):
+        """Apply size deltas and the written buckets to the index entry.
+
+        The entry is updated atomically by the storage, concurrent writers
+        do not lose each others deltas. With refresh the bounds are read
+        again from the storage, this is needed after buckets were deleted.
+        """
+        if not self.settings["ENABLE_INDEX"]:
+            return None
+        if refresh:
+            try:
+                first = self.storage.first(key)
+                last = self.storage.last(key)
+            except NotFoundError:
+                bounds = {"ts_min": None, "ts_max": None,
+                          "first_range_key": None, "last_range_key": None}
+            else:
+                bounds = {"ts_min": first.ts_min, "ts_max": last.ts_max,
+                          "first_range_key": first.range_key,
+                          "last_range_key": last.range_key}
+
+        def update(meta):
+            meta = meta or {
+                "key": key, "buckets": 0, "count": 0, "bytes": 0,
+                "ts_min": None, "ts_max": None,
+                "first_range_key": None, "last_range_key": None}
+            for d in deltas:
+                for k in ("buckets", "count", "bytes"):
+                    meta[k] += d[k]
+            for item in written:
+                if len(item) < 1:
+                    continue
+                meta["item_type"] = item.item_type.name
+                meta["bucket_type"] = item.bucket_type.name
+                if meta["ts_min"] is None or item.ts_min < meta["ts_min"]:
+                    meta["ts_min"] = item.ts_min
+                    meta["first_range_key"] = item.range_key
+                if meta["ts_max"] is None or item.ts_max > meta["ts_max"]:
+                    meta["ts_max"] = item.ts_max
+                    meta["last_range_key"] = item.range_key
+            if refresh:
+                meta.update(bounds)
+            return meta
+        return self.storage.update_meta(key, update)
+
     def _insert_or_update_item(self, item):
+        """Write a bucket, returns the size delta for the index.
+        """
+        delta = {"buckets": 0 if item.existing else 1,
+                 "count": len(item) - item._stored_count,
+                 "bytes": item.nbytes - item._stored_bytes}
         if item.existing:
             self.storage.update(item)
         else:
             self.storage.insert(item)
+        item._stored_count = len(item)
+        item._stored_bytes = item.nbytes
+        self._invalidate(item.key, item.ts_min, item.ts_max)
+        return delta
+
+    def _delete_item(self, item):
+        """Delete a bucket, returns the size delta for the index.
+        """
+        self.storage.delete(item)
+        if len(item) > 0:
+            # Callers that empty a bucket invalidate the removed range
+            self._invalidate(item.key, item.ts_min, item.ts_max)
+        return {"buckets": -1, "count": -item._stored_count,
+                "bytes": -item._stored_bytes}
 
     def insert_bulk(self, inserts):
         res = []
@@ -94,23 +374,238 @@ class TSDB(object):
         return self._insert(key, data)
 
     def _insert(self, key, data):
+        key = check_key(key)
+
+        timestamps, values = columns(data)
+
+        if self.settings["APPEND_CHUNKS"]:
+            stats = self._append_chunk(key, timestamps, values)
+            if stats is not None:
+                return stats
+            self._fold_chunks(key)
+        return self._insert_merged(key, timestamps, values)
+
+    def _append_chunk(self, key, timestamps, values):
+        """Blind write of data behind the known end of the series.
+
+        Returns None if the data can not be appended as a chunk.
+        """
+        tail = self._tails.get(key)
+        ts_min = int(timestamps[0])
+        ts_max = int(timestamps[-1])
+        if (tail is None or ts_min <= tail["ts_max"] or
+                tail["chunks"] >= self.settings["APPEND_CHUNKS_MAX"]):
+            return None
+        chunk = Bucket.new(key)
+        chunk.merge(timestamps, values)
+        try:
+            # The first timestamp is unique for chunks behind the tail
+            self.storage.insert_chunk(chunk, ts_min)
+        except ConflictError:
+            return None
+        tail["ts_max"] = ts_max
+        tail["chunks"] += 1
+        self._invalidate(key, ts_min, ts_max)
+        logger.debug("Appended chunk {} to {}".format(ts_min, key))
+        return {"ts_min": ts_min, "ts_max": ts_max, "count": len(timestamps),
+                "appended": len(chunk), "inserted": 0, "updated": 0,
+                "key": key, "splits": 0, "merged": 0, "chunks": 1,
+                "retries": 0}
+
+    def _fold_chunks(self, key):
+        """Merge pending append chunks into the buckets.
+        """
+        chunks = self.storage.chunks(key)
+        if len(chunks) < 1:
+            return None
+        timestamps = array.array("I")
+        values = []
+        for _, chunk in chunks:
+            timestamps.extend(chunk._timestamps)
+            values.extend(chunk._values)
+        timestamps, values = columns((timestamps, values))
+        logger.debug("Folding {} chunks into {}".format(len(chunks), key))
+        stats = self._insert_merged(key, timestamps, values)
+        # A crash before this point leaves the chunks, folding them again
+        # later is harmless because duplicates are skipped
+        self.storage.delete_chunks(key, [seq for seq, _ in chunks])
+        return stats
+
+    def _with_retries(self, key, func, *args):
+        # Optimistic concurrency, another writer changed one of our buckets
+        # between read and write. Writes are idempotent so we just redo it.
+        retries = self.settings["INSERT_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                stats = func(key, *args)
+            except ConflictError:
+                logger.warning("Conflict on {} (attempt {})"
+                               .format(key, attempt + 1))
+            else:
+                stats["retries"] = attempt
+                return stats
+        raise ConflictError("Could not write {} after {} retries"
+                            .format(key, retries))
+
+    def _insert_merged(self, key, timestamps, values):
+        return self._with_retries(key, self._merge_and_write, timestamps,
+                                  values)
+
+    def delete_range(self, key, ts_min, ts_max):
+        """Delete all points of key in [ts_min, ts_max].
+
+        Buckets inside the range are dropped with one bulk delete, the
+        buckets on the edges are trimmed.
+        """
         key = key.lower()
-        if not re.match(r'^[A-Za-z0-9_\-\.]+$', key):
-            raise ValueError("Key should be alphanumeric (including .-_)")
+        if self.settings["APPEND_CHUNKS"]:
+            self._fold_chunks(key)
+            self._tails.pop(key, None)
+        return self._with_retries(key, self._delete_range, ts_min, ts_max)
+
+    def _trim_item(self, item, ts_min, ts_max, deltas, written):
+        """Remove [ts_min, ts_max] from an edge bucket.
 
-        assert(isinstance(data, list))
-        assert(len(data) > 0)
-        data.sort(key=lambda x: x[0])
+        The index deltas and the written buckets are added to deltas and
+        written as the writes happen. Returns the number of removed points.
+        """
+        removed = item.remove_range(ts_min, ts_max)
+        if len(item) < 1:
+            deltas.append(self._delete_item(item))
+            return removed
+        if item.range_key != item.stored_range_key:
+            # The range key of dynamic buckets is the first timestamp,
+            # move the rest to a new bucket
+            deltas.append(self._delete_item(item))
+            item = item._like(item._timestamps, item._values)
+        deltas.append(self._insert_or_update_item(item))
+        written.append(item)
+        return removed
+
+    def _delete_range(self, key, ts_min, ts_max):
+        stats = {"key": key, "ts_min": ts_min, "ts_max": ts_max,
+                 "deleted": 0, "trimmed": 0, "removed": 0}
+        # The edge buckets reach over the range
+        edges = []
+        try:
+            left = self.storage.left(key, ts_min)
+        except NotFoundError:
+            left = None
+        if (left is not None and left.range_key < ts_min and
+                left.ts_max >= ts_min):
+            edges.append(left)
+        bulk_max = ts_max
+        try:
+            right = self.storage.left(key, ts_max)
+        except NotFoundError:
+            right = None
+        if (right is not None and right.range_key >= ts_min and
+                right.ts_max > ts_max):
+            edges.append(right)
+            bulk_max = right.range_key - 1
+
+        deltas = []
+        written = []
+        try:
+            if bulk_max >= ts_min:
+                for item in self.storage.delete_range(key, ts_min, bulk_max):
+                    deltas.append({"buckets": -1,
+                                   "count": -item._stored_count,
+                                   "bytes": -item._stored_bytes})
+                    stats["deleted"] += 1
+                    stats["removed"] += len(item)
+            for item in edges:
+                stats["removed"] += self._trim_item(item, ts_min, ts_max,
+                                                    deltas, written)
+                stats["trimmed"] += 1
+        finally:
+            # Also after a conflict, the retry starts from the new state
+            if len(deltas) > 0:
+                self._invalidate(key, ts_min, ts_max)
+                self._update_meta(key, deltas, written, refresh=True)
+        logger.debug("Deleted {} - {} from {}: {}"
+                     .format(ts_min, ts_max, key, stats))
+        return stats
+
+    def retention(self, key):
+        """Return the retention in seconds for key or None.
+
+        RETENTION maps keys or key patterns to seconds, exact keys win
+        over patterns and longer patterns over shorter ones.
+        """
+        rules = self.settings["RETENTION"]
+        if key in rules:
+            return rules[key]
+        for pattern in sorted(rules, key=len, reverse=True):
+            if pattern_regex(pattern).match(key):
+                return rules[pattern]
+        return None
+
+    def apply_retention(self, now=None):
+        """Delete all points older than the retention of their key.
+        """
+        if now is None:
+            now = int(time.time())
+        res = []
+        for key in self.list_keys():
+            seconds = self.retention(key)
+            if seconds is None:
+                continue
+            res.append(self.delete_range(key, 0, now - seconds - 1))
+        return res
+
+    def _partition(self, key, items, timestamps):
+        """Assign sorted timestamps to their buckets in one pass.
+
+        Returns (bucket, start, end) index ranges. Points of calendar
+        periods without a stored bucket and points in front of the first
+        dynamic bucket get new buckets.
+        """
+        n = len(timestamps)
+        if len(items) > 0:
+            bucket_type = items[0].bucket_type
+        else:
+            bucket_type = Bucket.DEFAULT_BUCKETTYPE
+        parts = []
+        i = 0
+        window = CALENDAR_WINDOWS.get(bucket_type.name)
+        if window is not None:
+            left, right = window
+            stored = dict((b.range_key, b) for b in items)
+            while i < n:
+                j = bisect.bisect_right(timestamps, right(timestamps[i]), i)
+                bucket = stored.get(left(timestamps[i]))
+                if bucket is None:
+                    bucket = Bucket.new(key)
+                parts.append((bucket, i, j))
+                i = j
+            return parts
+        # A dynamic bucket reaches up to the next one
+        starts = [b.ts_min for b in items]
+        if len(starts) < 1 or timestamps[0] < starts[0]:
+            i = n if len(starts) < 1 else bisect.bisect_left(timestamps,
+                                                             starts[0])
+            parts.append((Bucket.new(key), 0, i))
+        for k, bucket in enumerate(items):
+            if k + 1 < len(starts):
+                j = bisect.bisect_left(timestamps, starts[k + 1], i)
+            else:
+                j = n
+            if j > i:
+                parts.append((bucket, i, j))
+            i = j
+        return parts
 
+    def _merge_and_write(self, key, timestamps, values):
         # Limits and Stats
-        ts_min = int(data[0][0])
-        ts_max = int(data[-1][0])
-        count = len(data)
-        logger.debug("Inserting {} {} points".format(key, len(data)))
+        ts_min = int(timestamps[0])
+        ts_max = int(timestamps[-1])
+        count = len(timestamps)
+        logger.debug("Inserting {} {} points".format(key, count))
         logger.debug("Limits: {} - {}".format(ts_min, ts_max))
         stats = {"ts_min": ts_min, "ts_max": ts_max, "count": count,
                  "appended": 0, "inserted": 0, "updated": 0, "key": key,
-                 "splits": 0, "merged": 0}
+                 "splits": 0, "merged": 0, "chunks": 0}
 
         # Find the last Item
         last_item = self._get_last_item_or_new(key)
@@ -126,29 +621,22 @@ class TSDB(object):
         # Just Append - Best Case
         if ts_min >= last_item.ts_max:
             logger.debug("Append Data")
-            appended = last_item.insert(data)
+            appended = last_item.merge(timestamps, values)
             updated.append(last_item)
             stats["appended"] += appended
         else:
             # Merge Round
             merge_items = self._get_items_between(key, ts_min, ts_max)
-            assert(len(merge_items) > 0)
-            assert(merge_items[0].ts_min <= ts_min)
             logger.debug("Merging Data Query({} - {}) {} items"
                          .format(ts_min, ts_max, len(merge_items)))
-            i = len(data) - 1
-            m = len(merge_items) - 1
             inserted = 0
-            while i >= 0:
-                last_merge_item = merge_items[m]
-                if data[i][0] >= last_merge_item.ts_min:
-                    inserted += last_merge_item.insert_point(data[i][0],
-                                                             data[i][1])
-                    i -= 1
-                else:
-                    m -= 1
-            updated += merge_items
-            stats["merged"] += len(merge_items)
+            for item, a, b in self._partition(key, merge_items, timestamps):
+                added = item.merge(timestamps[a:b], values[a:b])
+                if added > 0:
+                    inserted += added
+                    updated.append(item)
+                    if item.existing:
+                        stats["merged"] += 1
             stats["inserted"] += inserted
 
         # Splitting Round
@@ -171,10 +659,22 @@ class TSDB(object):
 
         # Update
         if stats["inserted"] > 0 or stats["appended"] > 0:
-            # Update Round
-            for i in updated_splitted:
-                self._insert_or_update_item(i)
+            # Update Round, buckets written before a conflict are indexed
+            # too, the retry reads them with their new size
+            deltas = []
+            written = []
+            try:
+                for i in updated_splitted:
+                    deltas.append(self._insert_or_update_item(i))
+                    written.append(i)
+            finally:
+                # Chunks are indexed when they are folded
+                if len(deltas) > 0:
+                    self._update_meta(key, deltas, written)
         else:
             logger.info("Duplicate ... Nothing to do ...")
 
+        if self.settings["APPEND_CHUNKS"]:
+            self._tails[key] = {"ts_max": max(last_item.ts_max, ts_max),
+                                "chunks": 0}
         return stats
\ No newline at end of file
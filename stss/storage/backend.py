@@ -7,13 +7,14 @@ import os
 import binascii
 import logging
 import json
+import fcntl
+import importlib
+import tempfile
+from contextlib import contextmanager
 from abc import ABCMeta, abstractmethod
-from redis import StrictRedis as Redis
-import boto3
-import botocore
-from collections import namedtuple
 from ..errors import NotFoundError, ConflictError
-from .models import Bucket
+from .models import Bucket, ItemType
+from .sketch import DDSketch
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,37 @@ logger = logging.getLogger(__name__)
 class StorageAPI(object):
     __metaclass__ = ABCMeta
 
+    # Settings used by from_settings and their defaults
+    SETTINGS = {}
+    # Whether reads may be issued from several threads at once
+    CONCURRENT_READS = False
+    # Store a quantile sketch beside every bucket
+    store_sketches = False
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create the backend from TSDB settings.
+        """
+        return cls()
+
+    def _sketch_data(self, bucket):
+        if not self.store_sketches:
+            return None
+        if bucket.item_type not in (ItemType.raw_float, ItemType.raw_int):
+            return None
+        return bucket.sketch.to_string()
+
+    def _load_sketch(self, bucket, data):
+        if data:
+            bucket._sketch = DDSketch.from_string(data)
+
+    def _load(self, item):
+        bucket = self._to_bucket(item)
+        bucket._stored_count = len(bucket)
+        bucket._stored_bytes = bucket.nbytes
+        bucket._stored_range_key = bucket.range_key
+        return bucket
+
     @abstractmethod
     def _to_bucket(self, item):
         pass
@@ -31,43 +63,118 @@ class StorageAPI(object):
         pass
 
     def get(self, key, range_key):
-        return self._to_bucket(self._get(key, range_key))
+        return self._load(self._get(key, range_key))
 
     @abstractmethod
     def _get(self, key, range_key):
         pass
 
+    def get_many(self, pairs):
+        """Fetch many (key, range_key) buckets at once.
+
+        Returns the buckets in request order, None for missing ones.
+        """
+        return [None if i is None else self._load(i)
+                for i in self._get_many(list(pairs))]
+
+    def _get_many(self, pairs):
+        res = []
+        for key, range_key in pairs:
+            try:
+                res.append(self._get(key, range_key))
+            except NotFoundError:
+                res.append(None)
+        return res
+
     def insert(self, bucket):
+        """Store a new bucket.
+
+        Raises a ConflictError if the bucket already exists.
+        """
         self._insert(bucket.key, bucket.range_key, self._from_bucket(bucket))
+        bucket._version += 1
+        bucket._existing = True
+        bucket._stored_range_key = bucket.range_key
 
     @abstractmethod
     def _insert(self, key, range_key, item):
         pass
 
+    def insert_many(self, buckets):
+        """Store many new buckets of one key with batched writes.
+
+        Meant for bulk loads into an empty range, on some backends the
+        batched writes do not check that the buckets are new.
+        """
+        if len(buckets) < 1:
+            return
+        self._insert_many(buckets[0].key,
+                          [(b.range_key, self._from_bucket(b))
+                           for b in buckets])
+        for b in buckets:
+            b._version += 1
+            b._existing = True
+            b._stored_range_key = b.range_key
+
+    def _insert_many(self, key, items):
+        for range_key, item in items:
+            self._insert(key, range_key, item)
+
     def update(self, bucket):
-        self._update(bucket.key, bucket.range_key, self._from_bucket(bucket))
+        """Replace a stored bucket.
+
+        The write only succeeds if the stored version still matches the
+        version the bucket was read with, otherwise a ConflictError is
+        raised and the caller has to read and merge again.
+        """
+        self._update(bucket.key, bucket.stored_range_key,
+                     self._from_bucket(bucket), bucket.version)
+        bucket._version += 1
+
+    @abstractmethod
+    def _update(self, key, range_key, item, version):
+        pass
+
+    def delete(self, bucket):
+        """Remove a stored bucket, with the same version check as update.
+        """
+        self._delete(bucket.key, bucket.stored_range_key, bucket.version)
+        bucket._existing = False
 
     @abstractmethod
-    def _update(self, key, range_key, item):
+    def _delete(self, key, range_key, version):
         pass
 
-    def query(self, key, range_min, range_max):
+    def query(self, key, range_min, range_max, consistent=True):
+        """Return the buckets of [range_min, range_max] and the one left.
+
+        With consistent=False the backend may answer from an eventually
+        consistent read, only use it for ranges that are not written.
+        """
+        if consistent:
+            items = self._query(key, range_min, range_max)
+        else:
+            items = self._query_eventual(key, range_min, range_max)
         out = list()
-        for i in self._query(key, range_min, range_max):
-            out.append(self._to_bucket(i))
+        for i in items:
+            out.append(self._load(i))
         return out
 
     @abstractmethod
     def _query(self, key, range_min, range_max):
         pass
 
+    def _query_eventual(self, key, range_min, range_max):
+        # Reads of most backends are always consistent
+        return self._query(key, range_min, range_max)
+
     def last(self, key, limit=1):
         assert limit < 10
         l = self._last(key, limit=limit)
         if limit == 1:
-            return self._to_bucket(l[0])
+            return self._load(l[0])
         else:
-            return [self._to_bucket(i) for i in l]
+            return [self._load(i) for i in l]
 
     @abstractmethod
     def _last(self, key, limit=1):
@@ -77,9 +184,9 @@ class StorageAPI(object):
         assert limit < 10
         f = self._first(key, limit=limit)
         if limit == 1:
-            return self._to_bucket(f[0])
+            return self._load(f[0])
         else:
-            return [self._to_bucket(i) for i in f]
+            return [self._load(i) for i in f]
 
     @abstractmethod
     def _first(self, key, limit=1):
@@ -89,14 +196,89 @@ class StorageAPI(object):
         assert limit < 10
         l = self._left(key, range_key, limit=limit)
         if limit == 1:
-            return self._to_bucket(l[0])
+            return self._load(l[0])
         else:
-            return [self._to_bucket(i) for i in l]
+            return [self._load(i) for i in l]
 
     @abstractmethod
     def _left(self, key, range_key, limit=1):
         pass
 
+    def insert_chunk(self, bucket, seq):
+        """Write an append chunk without reading the buckets of the key.
+
+        Chunks are identified by ``seq`` and folded into the buckets later.
+        """
+        self._insert_chunk(bucket.key, seq, self._from_bucket(bucket))
+
+    def _insert_chunk(self, key, seq, item):
+        raise NotImplementedError("Storage does not support append chunks")
+
+    def chunks(self, key):
+        """Return all pending append chunks of a key as (seq, bucket).
+        """
+        return [(seq, self._load(i)) for seq, i in self._chunks(key)]
+
+    def _chunks(self, key):
+        raise NotImplementedError("Storage does not support append chunks")
+
+    def delete_chunks(self, key, seqs):
+        if len(seqs) > 0:
+            self._delete_chunks(key, seqs)
+
+    def _delete_chunks(self, key, seqs):
+        raise NotImplementedError("Storage does not support append chunks")
+
+    def delete_range(self, key, range_min, range_max):
+        """Remove all buckets with a range key in [range_min, range_max].
+
+        Unlike delete this is not version checked. Returns the removed
+        buckets.
+        """
+        return [self._load(i)
+                for i in self._delete_range(key, range_min, range_max)]
+
+    def _delete_range(self, key, range_min, range_max):
+        raise NotImplementedError("range deletes are not supported")
+
+    def get_meta(self, key):
+        """Return the index entry of a key or None.
+        """
+        return self._get_meta(key)
+
+    @abstractmethod
+    def _get_meta(self, key):
+        pass
+
+    def put_meta(self, key, meta):
+        self._put_meta(key, meta)
+
+    @abstractmethod
+    def _put_meta(self, key, meta):
+        pass
+
+    def update_meta(self, key, update):
+        """Atomically replace the index entry of key by update(entry).
+
+        ``update`` gets the current entry or None and returns the new one.
+        It can be called again if a concurrent writer got in between.
+        Returns the written entry.
+        """
+        return self._update_meta(key, update)
+
+    @abstractmethod
+    def _update_meta(self, key, update):
+        pass
+
+    def list_keys(self, prefix=""):
+        """Return the sorted keys in the index starting with prefix.
+        """
+        return sorted(self._list_keys(prefix))
+
+    @abstractmethod
+    def _list_keys(self, prefix):
+        pass
+
     def range(self, key):
         try:
             s = {"ts_min": self.ts_min(key),
@@ -125,286 +307,81 @@ class StorageAPI(object):
         return self._count(key)
 
 
-class DynamoStorage(StorageAPI):
-    def __init__(self, table_name,
-                 aws_access_key_id=None, aws_secret_access_key=None,
-                 region_name=None, local_dynamo=False, create_table=False,
-                 endpoint_url="http://localhost:8000"):
-        kwargs = {}
-        if aws_access_key_id:
-            kwargs["aws_access_key_id"] = aws_access_key_id
-        if aws_secret_access_key:
-            kwargs["aws_secret_access_key"] = aws_secret_access_key
-        if region_name:
-            kwargs["region_name"] = region_name
-        if local_dynamo:
-            kwargs["aws_access_key_id"] = "none"
-            kwargs["aws_secret_access_key"] = "none"
-            kwargs["region_name"] = "none"
-            kwargs["endpoint_url"] = endpoint_url
-
-        self.local = local_dynamo
-        self.table_name = "stss_{}".format(table_name)
-        self.client = boto3.resource('dynamodb', **kwargs)
-        self.client_low = boto3.client('dynamodb', **kwargs)
-        self.table = self.client.Table(self.table_name)
-
-    def _createTable(self):
-        logger.warning("creating table %s", self.table_name)
-        self.client.create_table(
-            AttributeDefinitions=[
-                {
-                    'AttributeName': 'key',
-                    'AttributeType': 'S'
-                },
-                {
-                    'AttributeName': 'range_key',
-                    'AttributeType': 'N'
-                }],
-            TableName=self.table_name,
-            KeySchema=[
-                {
-                    'AttributeName': 'key',
-                    'KeyType': 'HASH'
-                }, {
-                    'AttributeName': 'range_key',
-                    'KeyType': 'RANGE'
-                }],
-            ProvisionedThroughput={
-                'ReadCapacityUnits': 123,
-                'WriteCapacityUnits': 123
-            },
-            StreamSpecification={
-                'StreamEnabled': False,
-#                'StreamViewType': 'NEW_IMAGE'|'OLD_IMAGE'|'NEW_AND_OLD_IMAGES'|'KEYS_ONLY'
-            })
-
-    def _dropTable(self):
-        if not self.local:
-            raise RuntimeError("I will not delete a not local table")
-        if self.table:
-            logger.warning("Deleting Table %s", self.table)
-            try:
-                self.table.delete()
-            except botocore.exceptions.ClientError:
-                logger.warning("could not delete table")
-
-    def _to_bucket(self, item):
-        key = item["key"]
-        data = str(item["data"])
-        bucket = Bucket.from_db_data(key, data)
-        return bucket
-
-    def _from_bucket(self, bucket):
-        item =  {"key": bucket.key,
-                 "range_key": bucket.range_key,
-                 "data": bucket.to_string(),
-                 "size": len(bucket)}
-        return item
-
-    def _insert(self, key, range_key, item):
-        self.table.put_item(
-            Item={
-                'key': key,
-                'range_key': range_key,
-                'data': boto3.dynamodb.types.Binary(item["data"])
-            },
-            ConditionExpression=boto3.dynamodb.conditions.Attr("key").not_exists()
-        )
-
-    def _get(self, key, range_key):
-        result = self.table.get_item(
-            Key={
-                'key': key,
-                'range_key': range_key
-            },
-            ConsistentRead=True,
-        )
-        item = result.get("Item", None)
-        if not item:
-            raise NotFoundError
-        return item
-
-    def _first(self, key, limit=1):
-        result = self.table.query(
-            Select='ALL_ATTRIBUTES',
-            Limit=limit,
-            ConsistentRead=True,
-            ScanIndexForward=True,
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('key').eq(key))
-        items = list(result["Items"])
-        if len(items) < 1:
-            raise NotFoundError
-        return items
-
-    def _last(self, key, limit=1):
-        result = self.table.query(
-            Select='ALL_ATTRIBUTES',
-            Limit=limit,
-            ConsistentRead=True,
-            ScanIndexForward=False,
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('key').eq(key))
-        items = list(result["Items"])
-        if len(items) < 1:
-            raise NotFoundError
-        return items
-
-    def _left(self, key, range_key, limit=1):
-        result = self.table.query(
-            Select='ALL_ATTRIBUTES',
-            Limit=limit,
-            ConsistentRead=True,
-            ScanIndexForward=False,
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('key').eq(key) & boto3.dynamodb.conditions.Key('range_key').lte(range_key))
-        items = list(result["Items"])
-        if len(items) < 1:
-            raise NotFoundError
-        return items
-
-    def _update(self, key, range_key, data, size):
-        self._insert(key, range_key, data, size)
-
-    def _full_query(self, ScanIndexForward=True, ConsistentRead=True,
-                        KeyConditionExpression=None, Select=None):
-        result = self.table.query(
-            Select=Select,
-            ConsistentRead=ConsistentRead,
-            ScanIndexForward=ScanIndexForward,
-            KeyConditionExpression=KeyConditionExpression)
-        items = result['Items']
-
-        while result.get('LastEvaluatedKey'):
-            result = self.table.query(
-                Select=Select,
-                ConsistentRead=ConsistentRead,
-                ScanIndexForward=ScanIndexForward,
-                KeyConditionExpression=KeyConditionExpression,
-                ExclusiveStartKey=result['LastEvaluatedKey'])
-            items.extend(result['Items'])
-        return list(items)
-
-    def _query(self, key, range_min, range_max):
-        items = self._full_query(
-            Select='ALL_ATTRIBUTES',
-            ConsistentRead=True,
-            ScanIndexForward=True,
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('key').eq(key) & boto3.dynamodb.conditions.Key('range_key').between(range_min, range_max))
-        try:
-            left = self._left(key, range_min, limit=1)[0]
-        except NotFoundError:
-            return items
-        if len(items) > 0 and left == items[0]:
-            pass
-        else:
-            items.insert(0, left)
-        return items
-
-
-class RedisStorage(StorageAPI):
-    def __init__(self, redis=None, expire=None, **kwargs):
-        if expire is not None:
-            self.expire = expire
-        else:
-            self.expire = False
-        if redis is not None:
-            self.redis = redis
-        else:
-            self.redis = Redis(**kwargs)
-
-    def _to_bucket(self, item):
-        d = json.loads(item)
-        return Bucket.from_db_data(d["key"], binascii.unhexlify(d["data"]))
-
-    def _from_bucket(self, bucket):
-        return json.dumps({"key": bucket.key,
-                           "range_key": bucket.range_key,
-                           "data": binascii.hexlify(bucket.to_string())})
-
-    def _insert(self, key, range_key, item):
-        self.redis.zadd(key, range_key, item)
-        if self.expire:
-            self.redis.expire(key, self.expire)
-
-    def _get(self, key, range_key):
-        l = self.redis.zrevrangebyscore(key, min=range_key, max=range_key,
-                                        start=0, num=1)
-        if len(l) < 1:
-            raise NotFoundError
-        return l[0]
-
-    def _first(self, key, limit=1):
-        i = self.redis.zrangebyscore(key, min="-inf", max="+inf",
-                                     start=0, num=limit)
-        if len(i) < 1:
-            raise NotFoundError
-        return i[:limit]
-
-    def _last(self, key, limit=1):
-        i = self.redis.zrevrangebyscore(key, min="-inf", max="+inf",
-                                        start=0, num=limit)
-        if len(i) < 1:
-            raise NotFoundError
-        return i[:limit]
-
-    def _left(self, key, range_key, limit=1):
-        i = self.redis.zrevrangebyscore(key, min="-inf", max=range_key,
-                                        start=0, num=limit)
-        if len(i) < 1:
-            raise NotFoundError
-        return i[:limit]
-
-    def _update(self, key, range_key, item):
-        p = self.redis.pipeline()
-        p.zremrangebyscore(key, min=range_key, max=range_key)
-        p.zadd(key, range_key, item)
-        if self.expire:
-            p.expire(key, self.expire)
-        p.execute()
-
-    def _query(self, key, range_min, range_max):
-        items = self.redis.zrangebyscore(key, min=range_min, max=range_max)
-        try:
-            left = self._left(key, range_min)[0]
-        except NotFoundError:
-            return items
-        if len(items) > 0 and left == items[0]:
-            pass
-        else:
-            items.insert(0, left)
-        return items
-
-
 class FileStorage(StorageAPI):
+    SETTINGS = {
+        "FILE_STORAGE_FOLDER": "./stss_data/",
+    }
+
     def __init__(self, path):
         self.storage_path = os.path.realpath(path)
         if not os.path.exists(self.storage_path):
             os.makedirs(self.storage_path)
         self.cache = {}
 
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings["FILE_STORAGE_FOLDER"])
+
     def _to_bucket(self, item):
-        return Bucket.from_db_data(item["key"], binascii.unhexlify(item["data"]))
+        bucket = Bucket.from_db_data(item["key"],
+                                     binascii.unhexlify(item["data"]))
+        bucket._version = item.get("version", 0)
+        if item.get("sketch"):
+            self._load_sketch(bucket, binascii.unhexlify(item["sketch"]))
+        return bucket
 
     def _from_bucket(self, bucket):
-        return {"key": bucket.key,
-                "range_key": bucket.range_key,
-                "data": binascii.hexlify(bucket.to_string())}
+        item = {"key": bucket.key,
+                "range_key": bucket.stored_range_key,
+                "data": binascii.hexlify(bucket.to_string()),
+                "version": bucket.version + 1}
+        sketch = self._sketch_data(bucket)
+        if sketch:
+            item["sketch"] = binascii.hexlify(sketch)
+        return item
+
+    @contextmanager
+    def _lock(self, key):
+        """Exclusive lock on a key shared by all processes using the folder.
+        """
+        filename = os.path.join(self.storage_path, "{}.lock".format(key))
+        with open(filename, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _replace(self, filename, lines):
+        """Write a new version of filename next to it and rename it over.
+
+        Readers without the lock see either the old or the new file,
+        never a truncated one.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.storage_path, prefix=".",
+                                   suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for line in lines:
+                    f.write(line)
+                    f.write("\n")
+            os.rename(tmp, filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
 
     def _load_key(self, key):
         o = []
         filename = os.path.join(self.storage_path, "{}.stss".format(key))
-        if not os.path.isfile(filename):
-            return o
-        with open(filename, 'r') as f:
-            for line in f:
-                o.append(json.loads(line.strip()))
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    o.append(json.loads(line.strip()))
         self.cache[key] = o
 
     def _write_key(self, key):
         filename = os.path.join(self.storage_path, "{}.stss".format(key))
-        with open(filename, 'w') as f:
-            for i in self.cache[key]:
-                f.write(json.dumps(i))
-                f.write("\n")
+        self._replace(filename, (json.dumps(i) for i in self.cache[key]))
 
     def _left(self, key, range_key, limit=1):
         self._load_key(key)
@@ -446,27 +423,77 @@ class FileStorage(StorageAPI):
         return self._get_key(key)[min:max]
 
     def _insert(self, key, range_key, item):
-        self._load_key(key)
-        a = self._get_range_keys(key)
-        position = bisect.bisect_left(a, range_key)
-        if position != len(a) and a[position] == range_key:
-            raise ConflictError
-        self._get_key(key).insert(position, dict(key=key, range_key=range_key,
-                                                 data=item["data"]))
-        self._write_key(key)
-
-    def _update(self, key, range_key, item):
-        self._load_key(key)
-        i = self._index(key, range_key)
-        self._get_key(key)[i] = dict(key=key, range_key=range_key,
-                                     data=item["data"])
-        self._write_key(key)
+        with self._lock(key):
+            self._load_key(key)
+            a = self._get_range_keys(key)
+            position = bisect.bisect_left(a, range_key)
+            if position != len(a) and a[position] == range_key:
+                raise ConflictError
+            self._get_key(key).insert(position,
+                                      dict(item, key=key,
+                                           range_key=range_key))
+            self._write_key(key)
+
+    def _insert_many(self, key, items):
+        # One lock and one rewrite of the key file for all buckets
+        with self._lock(key):
+            self._load_key(key)
+            a = self._get_range_keys(key)
+            for range_key, item in items:
+                position = bisect.bisect_left(a, range_key)
+                if position != len(a) and a[position] == range_key:
+                    raise ConflictError("bucket {} {} exists"
+                                        .format(key, range_key))
+                a.insert(position, range_key)
+                self._get_key(key).insert(position,
+                                          dict(item, key=key,
+                                               range_key=range_key))
+            self._write_key(key)
+
+    def _checked_index(self, key, range_key, version):
+        try:
+            i = self._index(key, range_key)
+        except NotFoundError:
+            raise ConflictError("bucket {} {} was removed"
+                                .format(key, range_key))
+        if self._at(key, i).get("version", 0) != version:
+            raise ConflictError("bucket {} {} was modified"
+                                .format(key, range_key))
+        return i
+
+    def _update(self, key, range_key, item, version):
+        with self._lock(key):
+            self._load_key(key)
+            i = self._checked_index(key, range_key, version)
+            self._get_key(key)[i] = dict(item, key=key, range_key=range_key)
+            self._write_key(key)
+
+    def _delete(self, key, range_key, version):
+        with self._lock(key):
+            self._load_key(key)
+            i = self._checked_index(key, range_key, version)
+            del self._get_key(key)[i]
+            self._write_key(key)
 
     def _get(self, key, range_key):
         self._load_key(key)
         i = self._index(key, range_key)
         return self._at(key, i)
 
+    def _get_many(self, pairs):
+        loaded = set()
+        res = []
+        for key, range_key in pairs:
+            # Every key file is read once
+            if key not in loaded:
+                self._load_key(key)
+                loaded.add(key)
+            try:
+                res.append(self._at(key, self._index(key, range_key)))
+            except NotFoundError:
+                res.append(None)
+        return res
+
     def _query(self, key, range_min, range_max):
         self._load_key(key)
         m = self._ge(key, range_min)
@@ -492,3 +519,142 @@ class FileStorage(StorageAPI):
         if len(k) > 0:
             return k[:limit]
         raise NotFoundError
+
+    def _chunk_file(self, key):
+        return os.path.join(self.storage_path, "{}.chunks".format(key))
+
+    def _insert_chunk(self, key, seq, item):
+        # Appending a line does not touch the bucket file
+        with self._lock(key):
+            with open(self._chunk_file(key), 'a') as f:
+                f.write(json.dumps(dict(item, key=key, range_key=seq)))
+                f.write("\n")
+
+    def _read_chunks(self, key):
+        filename = self._chunk_file(key)
+        if not os.path.isfile(filename):
+            return []
+        with open(filename, 'r') as f:
+            return [json.loads(line.strip()) for line in f if line.strip()]
+
+    def _chunks(self, key):
+        chunks = sorted(self._read_chunks(key), key=lambda x: x["range_key"])
+        return [(c["range_key"], c) for c in chunks]
+
+    def _delete_chunks(self, key, seqs):
+        seqs = set(seqs)
+        with self._lock(key):
+            # Chunks appended in the meantime are kept
+            keep = [c for c in self._read_chunks(key)
+                    if c["range_key"] not in seqs]
+            if len(keep) > 0:
+                self._replace(self._chunk_file(key),
+                              (json.dumps(c) for c in keep))
+            else:
+                os.unlink(self._chunk_file(key))
+
+    def _delete_range(self, key, range_min, range_max):
+        with self._lock(key):
+            self._load_key(key)
+            a = self._ge(key, range_min)
+            b = bisect.bisect_right(self._get_range_keys(key), range_max)
+            items = self._slice(key, a, b)
+            if len(items) > 0:
+                del self._get_key(key)[a:b]
+                self._write_key(key)
+            return items
+
+    def _meta_file(self, key):
+        return os.path.join(self.storage_path, "{}.meta".format(key))
+
+    def _get_meta(self, key):
+        filename = self._meta_file(key)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+    def _put_meta(self, key, meta):
+        self._replace(self._meta_file(key), [json.dumps(meta)])
+
+    def _update_meta(self, key, update):
+        with self._lock(key):
+            meta = update(self._get_meta(key))
+            self._put_meta(key, meta)
+        return meta
+
+    def _list_keys(self, prefix):
+        return [f[:-len(".meta")] for f in os.listdir(self.storage_path)
+                if f.endswith(".meta") and f.startswith(prefix)]
+
+
+# Backends by STORAGE name as "module:class", imported on first use so
+# that only the dependencies of the configured backend are loaded.
+# Other packages add backends with an entry point in ENTRY_POINT_GROUP:
+#   entry_points={"stss.backends": ["lmdb = mypackage.lmdb:LMDBStorage"]}
+BACKENDS = {
+    "file": "stss.storage.backend:FileStorage",
+    "redis": "stss.storage.redis_backend:RedisStorage",
+    "dynamo": "stss.storage.dynamo_backend:DynamoStorage",
+    "sqlite": "stss.storage.sqlite_backend:SQLiteStorage",
+    "lmdb": "stss.storage.lmdb_backend:LMDBStorage",
+}
+ENTRY_POINT_GROUP = "stss.backends"
+
+
+def register_backend(name, backend):
+    """Register a storage class or a "module:class" path as name.
+    """
+    BACKENDS[name] = backend
+
+
+def _entry_point(name):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return None
+        for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+            return ep.load
+        return None
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        found = eps.select(group=ENTRY_POINT_GROUP, name=name)
+    else:
+        found = [ep for ep in eps.get(ENTRY_POINT_GROUP, ())
+                 if ep.name == name]
+    for ep in found:
+        return ep.load
+    return None
+
+
+def _import(path):
+    module_name, class_name = path.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def load_backend(name):
+    """Return the storage class registered as name.
+
+    Built in and registered backends are looked up first, then the
+    installed entry points.
+    """
+    backend = BACKENDS.get(name)
+    if isinstance(backend, type):
+        return backend
+    try:
+        if backend is not None:
+            backend = _import(backend)
+        else:
+            load = _entry_point(name)
+            if load is None:
+                raise NotImplementedError(
+                    "Storage not implemented: {}".format(name))
+            backend = load()
+    except ImportError as e:
+        raise ImportError("Storage {} needs an optional dependency: {}"
+                          .format(name, e))
+    BACKENDS[name] = backend
+    return backend
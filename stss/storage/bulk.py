@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import array
+import csv
+import heapq
+import logging
+import struct
+import tempfile
+
+from itertools import chain
+
+from . import check_key
+from .models import Bucket, BucketType, ItemType
+from .helper import ts_daily_left, ts_hourly_left
+from .helper import ts_weekly_left, ts_monthly_left
+
+
+logger = logging.getLogger(__name__)
+
+
+# Binary columnar format, a sequence of blocks:
+# magic, item type, tuple size (1 for scalars), number of points
+# followed by the timestamps ("I") and the value columns.
+BLOCK_HEADER = struct.Struct("<4sHHI")
+BLOCK_MAGIC = b"STSB"
+BLOCK_SIZE = 65536
+
+PERIOD_LEFT = {
+    BucketType.hourly: ts_hourly_left,
+    BucketType.daily: ts_daily_left,
+    BucketType.weekly: ts_weekly_left,
+    BucketType.monthly: ts_monthly_left,
+}
+
+
+def _tuple_size(item_type):
+    if item_type == ItemType.tuple_float_2:
+        return 2
+    elif item_type == ItemType.tuple_float_3:
+        return 3
+    elif item_type in (ItemType.tuple_float_4, ItemType.basic_aggregation):
+        return 4
+    return 1
+
+
+def _item_type(value):
+    if isinstance(value, tuple):
+        return {2: ItemType.tuple_float_2, 3: ItemType.tuple_float_3,
+                4: ItemType.tuple_float_4}[len(value)]
+    if Bucket.DEFAULT_ITEMTYPE == ItemType.raw_int:
+        return ItemType.raw_int
+    return ItemType.raw_float
+
+
+def write_block(f, points, item_type=ItemType.raw_float):
+    """Write a list of (ts, value) as one binary block.
+    """
+    size = _tuple_size(item_type)
+    timestamps = array.array("I", [p[0] for p in points])
+    values = array.array("I" if item_type == ItemType.raw_int else "f")
+    if size == 1:
+        values.extend(p[1] for p in points)
+    else:
+        for c in range(size):
+            values.extend(p[1][c] for p in points)
+    f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, item_type.value, size,
+                              len(points)))
+    f.write(timestamps.tostring())
+    f.write(values.tostring())
+
+
+def write_binary(f, points, item_type=ItemType.raw_float):
+    """Write (ts, value) pairs in blocks of BLOCK_SIZE points.
+    """
+    block = []
+    for p in points:
+        block.append(p)
+        if len(block) >= BLOCK_SIZE:
+            write_block(f, block, item_type)
+            block = []
+    if len(block) > 0:
+        write_block(f, block, item_type)
+
+
+def read_binary(f):
+    """Generate (ts, value) pairs from a binary columnar file.
+    """
+    while True:
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+        magic, item_type, size, n = BLOCK_HEADER.unpack(header)
+        if magic != BLOCK_MAGIC:
+            raise ValueError("invalid block header")
+        timestamps = array.array("I")
+        timestamps.fromstring(f.read(4 * n))
+        values = array.array("I" if ItemType(item_type) == ItemType.raw_int
+                             else "f")
+        values.fromstring(f.read(4 * n * size))
+        if size == 1:
+            for p in zip(timestamps, values):
+                yield p
+        else:
+            columns = [values[c * n:(c + 1) * n] for c in range(size)]
+            for p in zip(timestamps, zip(*columns)):
+                yield p
+
+
+def read_csv(f):
+    """Generate (ts, value) pairs from csv rows ``ts,value[,value...]``.
+
+    Rows that do not start with a number (headers) are skipped.
+    """
+    for row in csv.reader(f):
+        if len(row) < 2:
+            continue
+        try:
+            ts = int(float(row[0]))
+        except ValueError:
+            continue
+        if len(row) == 2:
+            yield (ts, float(row[1]))
+        else:
+            yield (ts, tuple(float(v) for v in row[1:]))
+
+
+def write_csv(f, points):
+    writer = csv.writer(f)
+    for ts, value in points:
+        if isinstance(value, tuple):
+            writer.writerow([ts] + list(value))
+        else:
+            writer.writerow([ts, value])
+
+
+def _keyed(points, run):
+    # Unique merge keys, equal timestamps are never ordered by value
+    for seq, p in enumerate(points):
+        yield (p[0], run, seq), p
+
+
+def _dedup(points):
+    # Like insert the first value of a timestamp wins
+    last = None
+    for p in points:
+        if p[0] != last:
+            yield p
+            last = p[0]
+
+
+class BulkLoader(object):
+    """Import and export whole series.
+
+    The input is sorted in chunks of ``chunk_points`` that are spilled to
+    temporary files and merged, so the memory use does not depend on the
+    file size. If no data exists in the imported range, complete buckets
+    are built in memory and written with batched writes, otherwise the
+    sorted data goes through the normal insert path in chunks.
+    """
+    def __init__(self, db, chunk_points=1000000, tmpdir=None,
+                 batch_buckets=100):
+        self.db = db
+        self.storage = db.storage
+        self.chunk_points = chunk_points
+        self.tmpdir = tmpdir
+        self.batch_buckets = batch_buckets
+
+    def _sorted_runs(self, points):
+        """Sort points in chunks.
+
+        Returns the number of runs, the last timestamp and an iterator
+        over all points in order.
+        """
+        runs = []
+        chunk = []
+        ts_max = None
+        for p in points:
+            chunk.append(p)
+            if ts_max is None or p[0] > ts_max:
+                ts_max = p[0]
+            if len(chunk) >= self.chunk_points:
+                runs.append(self._spill(chunk))
+                chunk = []
+        if len(runs) < 1:
+            chunk.sort(key=lambda x: x[0])
+            return 1, ts_max, iter(chunk)
+        if len(chunk) > 0:
+            runs.append(self._spill(chunk))
+        # Earlier runs and points first, so _dedup keeps the first value
+        merged = heapq.merge(*[_keyed(read_binary(r), i)
+                               for i, r in enumerate(runs)])
+        return len(runs), ts_max, (p for _, p in merged)
+
+    def _spill(self, chunk):
+        chunk.sort(key=lambda x: x[0])
+        f = tempfile.TemporaryFile(dir=self.tmpdir)
+        write_binary(f, chunk, _item_type(chunk[0][1]))
+        f.seek(0)
+        return f
+
+    def _range_empty(self, key, ts_min, ts_max):
+        """True if no stored bucket can hold points of [ts_min, ts_max].
+        """
+        for b in self.storage.query(key, ts_min, ts_max):
+            if b.ts_max >= ts_min:
+                return False
+            left = PERIOD_LEFT.get(b.bucket_type)
+            # A calendar bucket owns its whole period
+            if left is not None and left(b.ts_max) == left(ts_min):
+                return False
+        return True
+
+    def _buckets(self, key, points, item_type):
+        """Build complete buckets of item_type from sorted points.
+        """
+        left = PERIOD_LEFT.get(Bucket.DEFAULT_BUCKETTYPE)
+        target = Bucket.DYNAMICSIZE_TARGET
+        bucket = None
+        period = None
+        for ts, value in points:
+            if left is not None:
+                p = left(ts)
+                if bucket is not None and p != period:
+                    yield bucket
+                    bucket = None
+                period = p
+            elif bucket is not None and len(bucket) >= target:
+                yield bucket
+                bucket = None
+            if bucket is None:
+                bucket = Bucket(key, item_type=item_type,
+                                bucket_type=Bucket.DEFAULT_BUCKETTYPE)
+            bucket.insert_point(ts, value)
+        if bucket is not None:
+            yield bucket
+
+    def _write_direct(self, key, points, item_type):
+        stats = {"buckets": 0, "count": 0}
+        batch = []
+
+        def flush():
+            self.storage.insert_many(batch)
+            deltas = []
+            for b in batch:
+                b._stored_count = len(b)
+                b._stored_bytes = b.nbytes
+                deltas.append({"buckets": 1, "count": len(b),
+                               "bytes": b.nbytes})
+            self.db._update_meta(key, deltas, batch)
+            del batch[:]
+
+        for bucket in self._buckets(key, points, item_type):
+            batch.append(bucket)
+            stats["buckets"] += 1
+            stats["count"] += len(bucket)
+            if len(batch) >= self.batch_buckets:
+                flush()
+        if len(batch) > 0:
+            flush()
+        return stats
+
+    def _write_merged(self, key, points):
+        stats = {"buckets": 0, "count": 0}
+        chunk = []
+        for p in points:
+            chunk.append(p)
+            if len(chunk) >= self.chunk_points:
+                stats["count"] += self.db._insert(key, chunk)["count"]
+                chunk = []
+        if len(chunk) > 0:
+            stats["count"] += self.db._insert(key, chunk)["count"]
+        return stats
+
+    def load(self, key, f, fmt="binary"):
+        """Import a csv (text file) or binary columnar file into key.
+
+        Tuple values (csv rows with several values) are only loaded into
+        an empty range, new buckets of the insert path hold scalars.
+        """
+        key = check_key(key)
+        if fmt == "csv":
+            points = read_csv(f)
+        elif fmt == "binary":
+            points = read_binary(f)
+        else:
+            raise ValueError("Invalid format {}".format(fmt))
+
+        runs, ts_max, points = self._sorted_runs(points)
+        points = _dedup(points)
+        try:
+            first = next(points)
+        except StopIteration:
+            return {"key": key, "count": 0, "buckets": 0, "runs": 0,
+                    "direct": False}
+        ts_min = first[0]
+        item_type = _item_type(first[1])
+        direct = self._range_empty(key, ts_min, ts_max)
+        if not direct and item_type != Bucket.DEFAULT_ITEMTYPE:
+            raise ValueError("{} values can only be loaded into an empty "
+                             "range".format(item_type.name))
+        points = chain([first], points)
+        if direct:
+            stats = self._write_direct(key, points, item_type)
+        else:
+            stats = self._write_merged(key, points)
+        stats.update({"key": key, "runs": runs, "direct": direct,
+                      "ts_min": ts_min, "ts_max": ts_max})
+        self.db._invalidate(key, ts_min, ts_max)
+        # The known end for blind appends may have moved
+        self.db._tails.pop(key, None)
+        logger.info("Loaded {}: {}".format(key, stats))
+        return stats
+
+    def dump(self, key, f, ts_min=0, ts_max=(2**31) - 1, fmt="binary"):
+        """Export key to a csv (text file) or binary columnar file.
+        """
+        key = check_key(key)
+        res = self.db.query(key, ts_min, ts_max)
+        if fmt == "csv":
+            write_csv(f, res.all())
+        elif fmt == "binary":
+            item_type = ItemType.raw_float
+            if len(res._segments) > 0:
+                item_type = res._segments[0][0].item_type
+            write_binary(f, res.all(), item_type)
+        else:
+            raise ValueError("Invalid format {}".format(fmt))
+        return len(res)
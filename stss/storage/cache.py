@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import logging
+import threading
+import time
+
+from collections import OrderedDict, defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCache(object):
+    """LRU cache for computed aggregations.
+
+    Entries are keyed by ``(key, ts_min, ts_max, ...)``. Writes invalidate
+    only the entries of the written key whose window overlaps the written
+    time span, so closed historical windows stay cached. Invalidation is
+    local to the process that writes, so windows ending at or after
+    ``now - live_margin`` expire after ``live_ttl`` seconds and writes of
+    other processes (the ingest coordinator) show up in live windows.
+    """
+    def __init__(self, max_entries=1000, live_ttl=10, live_margin=300):
+        self.max_entries = max_entries
+        self.live_ttl = live_ttl
+        self.live_margin = live_margin
+        self._entries = OrderedDict()
+        self._by_key = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Parallel queries share the cache
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            expires = entry[1] if entry is not None else None
+            if expires is not None and expires <= time.time():
+                # Live window past its ttl
+                self._remove(cache_key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Move to the end, most recently used
+            del self._entries[cache_key]
+            self._entries[cache_key] = entry
+            self.hits += 1
+            return list(entry[0])
+
+    def put(self, cache_key, value):
+        now = time.time()
+        expires = None
+        if cache_key[2] >= now - self.live_margin:
+            expires = now + self.live_ttl
+        with self._lock:
+            self._remove(cache_key)
+            self._entries[cache_key] = (list(value), expires)
+            self._by_key[cache_key[0]].add(cache_key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def _remove(self, cache_key):
+        if cache_key in self._entries:
+            del self._entries[cache_key]
+            keys = self._by_key[cache_key[0]]
+            keys.discard(cache_key)
+            if not keys:
+                del self._by_key[cache_key[0]]
+
+    def invalidate(self, key, ts_min, ts_max):
+        """Drop the entries of key overlapping [ts_min, ts_max].
+        """
+        with self._lock:
+            for cache_key in list(self._by_key.get(key, ())):
+                if cache_key[1] <= ts_max and cache_key[2] >= ts_min:
+                    self._remove(cache_key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_key.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_ratio": float(self.hits) / requests if requests else 0.0,
+                "entries": len(self._entries),
+                "invalidations": self.invalidations}
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import logging
+import time
+
+from .models import Bucket, BucketType
+from ..errors import ConflictError
+
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor(object):
+    """Tidy up the buckets of a TSDB.
+
+    Undersized neighbouring buckets are merged (dynamic buckets only, the
+    calendar bucket types have exactly one bucket per period), oversized
+    buckets are split and every rewritten bucket is encoded with the
+    current format. Writes are rate limited with ``max_writes_per_second``
+    so compaction can run beside production traffic.
+    """
+    def __init__(self, db, max_writes_per_second=None, reencode=False):
+        self.db = db
+        self.storage = db.storage
+        self.max_writes_per_second = max_writes_per_second
+        self.reencode = reencode
+        self._next_write = 0.0
+
+    def _throttle(self):
+        if not self.max_writes_per_second:
+            return
+        now = time.time()
+        wait = self._next_write - now
+        if wait > 0:
+            time.sleep(wait)
+        self._next_write = (max(now, self._next_write) +
+                            1.0 / self.max_writes_per_second)
+
+    def _merge_neighbours(self, buckets):
+        """Merge undersized dynamic buckets into their left neighbour.
+
+        Returns the remaining buckets and the absorbed ones.
+        """
+        target = Bucket.DYNAMICSIZE_TARGET
+        merged = []
+        absorbed = []
+        for b in buckets:
+            if (len(merged) > 0 and
+                    b.bucket_type == BucketType.dynamic and
+                    len(merged[-1]) + len(b) <= target):
+                merged[-1].insert(zip(b._timestamps, b._values))
+                absorbed.append(b)
+            else:
+                merged.append(b)
+        return merged, absorbed
+
+    def _split_oversized(self, buckets):
+        out = []
+        splits = 0
+        for b in buckets:
+            if b.split_needed(limit="soft"):
+                out.extend(b.split_item())
+                splits += 1
+            else:
+                out.append(b)
+        return out, splits
+
+    def compact_key(self, key):
+        """Compact all buckets of one key and return stats.
+        """
+        if self.db.settings.get("APPEND_CHUNKS"):
+            self.db._fold_chunks(key)
+        buckets = self.storage.query(key, 0, (2**31) - 1)
+        bytes_before = sum(len(b.to_string()) for b in buckets)
+        stats = {"key": key, "buckets_before": len(buckets),
+                 "buckets_after": len(buckets), "merged": 0, "splits": 0,
+                 "writes": 0, "bytes_before": bytes_before,
+                 "bytes_after": bytes_before, "bytes_reclaimed": 0}
+        if len(buckets) < 1:
+            return stats
+
+        merged, absorbed = self._merge_neighbours(buckets)
+        result, splits = self._split_oversized(merged)
+
+        # Write the new state before removing absorbed buckets, a crash in
+        # between leaves duplicates but never loses points
+        deltas = []
+        written = []
+        try:
+            for b in result:
+                if b.existing and not b.dirty and not self.reencode:
+                    continue
+                self._throttle()
+                deltas.append(self.db._insert_or_update_item(b))
+                written.append(b)
+                stats["writes"] += 1
+            for b in absorbed:
+                self._throttle()
+                deltas.append(self.db._delete_item(b))
+                stats["writes"] += 1
+        finally:
+            # Writes done before a conflict stay indexed
+            if stats["writes"] > 0:
+                self.db._update_meta(key, deltas, written, refresh=True)
+
+        bytes_after = sum(len(b.to_string()) for b in result)
+        stats.update({"buckets_after": len(result),
+                      "merged": len(absorbed), "splits": splits,
+                      "bytes_after": bytes_after,
+                      "bytes_reclaimed": bytes_before - bytes_after})
+        logger.debug("Compacted {}: {}".format(key, stats))
+        return stats
+
+    def compact(self, keys):
+        """Compact a list of keys, keys with concurrent writes are skipped.
+        """
+        res = []
+        for key in keys:
+            try:
+                res.append(self.compact_key(key))
+            except ConflictError:
+                logger.info("Conflict while compacting {}, skipped"
+                            .format(key))
+        return res
+
+    def run(self, keys, interval=60, stop_event=None):
+        """Compact forever, every ``interval`` seconds.
+
+        ``keys`` is a list or a callable returning the keys for each round.
+        The loop ends when ``stop_event`` (a threading.Event) is set.
+        """
+        while stop_event is None or not stop_event.is_set():
+            round_keys = keys() if callable(keys) else keys
+            stats = self.compact(round_keys)
+            reclaimed = sum(s["bytes_reclaimed"] for s in stats)
+            logger.info("Compacted {} keys, {} bytes reclaimed"
+                        .format(len(stats), reclaimed))
+            if stop_event is not None:
+                stop_event.wait(interval)
+            else:
+                time.sleep(interval)
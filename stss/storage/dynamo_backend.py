@@ -0,0 +1,604 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import json
+import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import boto3
+import boto3.session
+import botocore
+import botocore.config
+
+from ..errors import NotFoundError, ConflictError, InternalError
+from .backend import StorageAPI
+from .models import Bucket
+
+
+logger = logging.getLogger(__name__)
+
+
+_dynamo_clients = {}
+_dynamo_clients_lock = threading.Lock()
+
+
+def _client_config(max_pool_connections):
+    # Throttled requests are retried by DynamoStorage._call within the
+    # capacity budget, botocore must not retry them on its own
+    options = {"max_pool_connections": max_pool_connections,
+               "retries": {"max_attempts": 0}}
+    try:
+        return botocore.config.Config(tcp_keepalive=True, **options)
+    except TypeError:
+        # tcp_keepalive needs a recent botocore
+        return botocore.config.Config(**options)
+
+
+def dynamo_clients(max_pool_connections=16, **kwargs):
+    """Shared (resource, client) per endpoint, region and credentials.
+
+    Creating clients is slow (credential and endpoint resolution, TLS
+    setup), so all DynamoStorage instances of a process reuse them.
+    """
+    cache_key = (max_pool_connections,) + tuple(sorted(kwargs.items()))
+    with _dynamo_clients_lock:
+        if cache_key not in _dynamo_clients:
+            kwargs = dict(kwargs)
+            endpoint_url = kwargs.pop("endpoint_url", None)
+            session = boto3.session.Session(**kwargs)
+            config = _client_config(max_pool_connections)
+            _dynamo_clients[cache_key] = (
+                session.resource("dynamodb", endpoint_url=endpoint_url,
+                                 config=config),
+                session.client("dynamodb", endpoint_url=endpoint_url,
+                               config=config))
+        return _dynamo_clients[cache_key]
+
+
+class CapacityBudget(object):
+    """Token bucket of capacity units per second.
+
+    ``acquire`` reserves an estimate before a request and waits if the
+    budget is used up, ``adjust`` books the difference to the capacity
+    the response reported.
+    """
+    def __init__(self, units_per_second):
+        self.rate = float(units_per_second)
+        self._tokens = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.rate,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, units=1):
+        with self._lock:
+            self._refill()
+            wait = max(0.0, (units - self._tokens) / self.rate)
+            self._tokens -= units
+        if wait > 0:
+            time.sleep(wait)
+
+    def adjust(self, units):
+        with self._lock:
+            self._tokens -= units
+
+
+class DynamoStorage(StorageAPI):
+    """Storage in a DynamoDB table with one item per bucket.
+
+    The key index (ENABLE_INDEX) lives in a second table
+    ``stss_<table>_meta`` that only _createTable creates, so it is off by
+    default. To enable it on an existing table, create the meta table
+    with a string hash key ``key``, then set ENABLE_INDEX. Existing series
+    are listed after their next write, their sizes only count the writes
+    since.
+    """
+    SETTINGS = {
+        "ENABLE_INDEX": False,
+        "DYNAMO_TABLE_NAME": "data_table",
+        "DYNAMO_LOCAL": True,
+        "DYNAMO_READ_CAPACITY": None,
+        "DYNAMO_WRITE_CAPACITY": None,
+        "DYNAMO_MAX_POOL_CONNECTIONS": None,
+    }
+    CONCURRENT_READS = True
+
+    # Parallel batch deletes for delete_range
+    DELETE_WORKERS = 4
+    BATCH_WRITE_SIZE = 25
+    BATCH_GET_SIZE = 100
+    # Retries of throttled requests, jittered exponential backoff
+    THROTTLE_ERRORS = ("ProvisionedThroughputExceededException",
+                       "ThrottlingException", "RequestLimitExceeded")
+    MAX_RETRIES = 8
+    BACKOFF_BASE = 0.05
+    BACKOFF_MAX = 5.0
+
+    def __init__(self, table_name,
+                 aws_access_key_id=None, aws_secret_access_key=None,
+                 region_name=None, local_dynamo=False, create_table=False,
+                 endpoint_url="http://localhost:8000", read_capacity=None,
+                 write_capacity=None, max_pool_connections=16):
+        kwargs = {}
+        if aws_access_key_id:
+            kwargs["aws_access_key_id"] = aws_access_key_id
+        if aws_secret_access_key:
+            kwargs["aws_secret_access_key"] = aws_secret_access_key
+        if region_name:
+            kwargs["region_name"] = region_name
+        if local_dynamo:
+            kwargs["aws_access_key_id"] = "none"
+            kwargs["aws_secret_access_key"] = "none"
+            kwargs["region_name"] = "none"
+            kwargs["endpoint_url"] = endpoint_url
+
+        self.local = local_dynamo
+        self.table_name = "stss_{}".format(table_name)
+        # The resource is only used for tables and the key index, the
+        # bucket reads and writes use the low level client
+        self.client, self.client_low = dynamo_clients(
+            max_pool_connections=max_pool_connections, **kwargs)
+        self.table = self.client.Table(self.table_name)
+        self.meta_table_name = "{}_meta".format(self.table_name)
+        self.meta_table = self.client.Table(self.meta_table_name)
+
+        # Optional budgets in capacity units per second
+        self.budgets = {}
+        if read_capacity:
+            self.budgets["read"] = CapacityBudget(read_capacity)
+        if write_capacity:
+            self.budgets["write"] = CapacityBudget(write_capacity)
+        self.consumed = {"read": 0.0, "write": 0.0}
+        self.throttled = 0
+        self._stats_lock = threading.Lock()
+        self._batch_size = self.BATCH_WRITE_SIZE
+
+    @classmethod
+    def from_settings(cls, settings):
+        # Enough connections for parallel queries and batch deletes
+        pool_size = (settings["DYNAMO_MAX_POOL_CONNECTIONS"] or
+                     settings.get("QUERY_PARALLELISM", 1) +
+                     cls.DELETE_WORKERS)
+        return cls(table_name=settings["DYNAMO_TABLE_NAME"],
+                   local_dynamo=settings["DYNAMO_LOCAL"],
+                   read_capacity=settings["DYNAMO_READ_CAPACITY"],
+                   write_capacity=settings["DYNAMO_WRITE_CAPACITY"],
+                   max_pool_connections=pool_size)
+
+    def _backoff(self, attempt):
+        time.sleep(random.uniform(
+            0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt)))
+
+    def _call(self, kind, func, units=1, **kwargs):
+        """Call the API within the budget and retry throttled requests.
+
+        ``kind`` is read or write, ``units`` the estimated capacity.
+        """
+        budget = self.budgets.get(kind)
+        if budget is not None:
+            budget.acquire(units)
+        kwargs["ReturnConsumedCapacity"] = "TOTAL"
+        for attempt in range(self.MAX_RETRIES + 1):
+            try:
+                result = func(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if (code not in self.THROTTLE_ERRORS or
+                        attempt == self.MAX_RETRIES):
+                    raise
+                with self._stats_lock:
+                    self.throttled += 1
+                self._backoff(attempt)
+            else:
+                break
+        consumed = result.get("ConsumedCapacity") or []
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        units_used = sum(float(c.get("CapacityUnits", 0)) for c in consumed)
+        with self._stats_lock:
+            self.consumed[kind] += units_used
+        if budget is not None and consumed:
+            budget.adjust(units_used - units)
+        return result
+
+    def _createTable(self):
+        logger.warning("creating table %s", self.table_name)
+        self.client.create_table(
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'key',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'range_key',
+                    'AttributeType': 'N'
+                }],
+            TableName=self.table_name,
+            KeySchema=[
+                {
+                    'AttributeName': 'key',
+                    'KeyType': 'HASH'
+                }, {
+                    'AttributeName': 'range_key',
+                    'KeyType': 'RANGE'
+                }],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 123,
+                'WriteCapacityUnits': 123
+            },
+            StreamSpecification={
+                'StreamEnabled': False,
+#                'StreamViewType': 'NEW_IMAGE'|'OLD_IMAGE'|'NEW_AND_OLD_IMAGES'|'KEYS_ONLY'
+            })
+        # One item per series for the key index
+        self.client.create_table(
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'key',
+                    'AttributeType': 'S'
+                }],
+            TableName=self.meta_table_name,
+            KeySchema=[
+                {
+                    'AttributeName': 'key',
+                    'KeyType': 'HASH'
+                }],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 10,
+                'WriteCapacityUnits': 10
+            })
+
+    def _dropTable(self):
+        if not self.local:
+            raise RuntimeError("I will not delete a not local table")
+        for table in (self.table, self.meta_table):
+            logger.warning("Deleting Table %s", table)
+            try:
+                table.delete()
+            except botocore.exceptions.ClientError:
+                logger.warning("could not delete table")
+
+    # Placeholders for the low level expressions, key is a reserved word
+    NAMES = {"#k": "key", "#r": "range_key", "#v": "version"}
+
+    def _names(self, *expressions):
+        return dict((n, v) for n, v in self.NAMES.items()
+                    if any(n in e for e in expressions))
+
+    def _plain(self, item):
+        """Convert a low level item to a plain dict.
+        """
+        plain = {"key": item["key"]["S"],
+                 "range_key": int(item["range_key"]["N"]),
+                 "data": bytes(item["data"]["B"])}
+        if "version" in item:
+            plain["version"] = int(item["version"]["N"])
+        if "sketch" in item:
+            plain["sketch"] = bytes(item["sketch"]["B"])
+        return plain
+
+    def _low_item(self, key, range_key, item):
+        new_item = {"key": {"S": key},
+                    "range_key": {"N": str(range_key)},
+                    "data": {"B": item["data"]},
+                    "version": {"N": str(item["version"])}}
+        if item.get("sketch"):
+            new_item["sketch"] = {"B": item["sketch"]}
+        return new_item
+
+    def _to_bucket(self, item):
+        bucket = Bucket.from_db_data(item["key"], item["data"])
+        bucket._version = item.get("version", 0)
+        if item.get("sketch"):
+            self._load_sketch(bucket, item["sketch"])
+        return bucket
+
+    def _from_bucket(self, bucket):
+        item =  {"key": bucket.key,
+                 "range_key": bucket.stored_range_key,
+                 "data": bucket.to_string(),
+                 "size": len(bucket),
+                 "version": bucket.version + 1,
+                 "sketch": self._sketch_data(bucket)}
+        return item
+
+    def _put(self, key, range_key, item, condition, values=None):
+        kwargs = {}
+        if values:
+            kwargs["ExpressionAttributeValues"] = values
+        try:
+            self._call(
+                "write", self.client_low.put_item,
+                TableName=self.table_name,
+                Item=self._low_item(key, range_key, item),
+                ConditionExpression=condition,
+                ExpressionAttributeNames=self._names(condition),
+                **kwargs)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code == "ConditionalCheckFailedException":
+                raise ConflictError("bucket {} {} was modified"
+                                    .format(key, range_key))
+            raise
+
+    def _insert(self, key, range_key, item):
+        self._put(key, range_key, item, "attribute_not_exists(#k)")
+
+    def _get(self, key, range_key):
+        result = self._call(
+            "read", self.client_low.get_item,
+            TableName=self.table_name,
+            Key={
+                'key': {'S': key},
+                'range_key': {'N': str(range_key)}
+            },
+            ConsistentRead=True,
+        )
+        item = result.get("Item", None)
+        if not item:
+            raise NotFoundError
+        return self._plain(item)
+
+    def _get_many(self, pairs):
+        found = {}
+        # batch_get_item rejects duplicate keys
+        unique = list(set((k, int(r)) for k, r in pairs))
+        for i in range(0, len(unique), self.BATCH_GET_SIZE):
+            keys = [{'key': {'S': k}, 'range_key': {'N': str(r)}}
+                    for k, r in unique[i:i + self.BATCH_GET_SIZE]]
+            request = {self.table_name: {'Keys': keys,
+                                         'ConsistentRead': True}}
+            attempt = 0
+            while request:
+                result = self._call("read", self.client_low.batch_get_item,
+                                    units=len(keys), RequestItems=request)
+                for item in result["Responses"].get(self.table_name, []):
+                    item = self._plain(item)
+                    found[(item["key"], item["range_key"])] = item
+                request = result.get("UnprocessedKeys")
+                if request:
+                    if attempt >= self.MAX_RETRIES:
+                        raise InternalError("keys of {} unprocessed after {} "
+                                            "retries".format(self.table_name,
+                                                             attempt))
+                    self._backoff(attempt)
+                    attempt += 1
+        return [found.get((k, int(r))) for k, r in pairs]
+
+    def _query_items(self, condition, values, forward=True, limit=None,
+                     consistent=True):
+        """Query the bucket table, all pages unless limit is set.
+        """
+        kwargs = {"TableName": self.table_name,
+                  "KeyConditionExpression": condition,
+                  "ExpressionAttributeNames": self._names(condition),
+                  "ExpressionAttributeValues": values,
+                  "ConsistentRead": consistent,
+                  "ScanIndexForward": forward}
+        if limit is not None:
+            kwargs["Limit"] = limit
+        result = self._call("read", self.client_low.query, **kwargs)
+        items = result['Items']
+        while limit is None and result.get('LastEvaluatedKey'):
+            result = self._call("read", self.client_low.query,
+                                ExclusiveStartKey=result['LastEvaluatedKey'],
+                                **kwargs)
+            items.extend(result['Items'])
+        return [self._plain(i) for i in items]
+
+    def _range_items(self, key, range_min, range_max, consistent=True):
+        return self._query_items(
+            "#k = :k AND #r BETWEEN :a AND :b",
+            {":k": {"S": key}, ":a": {"N": str(range_min)},
+             ":b": {"N": str(range_max)}}, consistent=consistent)
+
+    def _first(self, key, limit=1):
+        items = self._query_items("#k = :k", {":k": {"S": key}},
+                                  limit=limit)
+        if len(items) < 1:
+            raise NotFoundError
+        return items
+
+    def _last(self, key, limit=1):
+        items = self._query_items("#k = :k", {":k": {"S": key}},
+                                  forward=False, limit=limit)
+        if len(items) < 1:
+            raise NotFoundError
+        return items
+
+    def _left(self, key, range_key, limit=1, consistent=True):
+        items = self._query_items("#k = :k AND #r <= :r",
+                                  {":k": {"S": key},
+                                   ":r": {"N": str(range_key)}},
+                                  forward=False, limit=limit,
+                                  consistent=consistent)
+        if len(items) < 1:
+            raise NotFoundError
+        return items
+
+    def _version_condition(self, version):
+        if version > 0:
+            return "#v = :v", {":v": {"N": str(version)}}
+        # Buckets written before versioning have no version attribute
+        return "attribute_exists(#k) AND attribute_not_exists(#v)", None
+
+    def _update(self, key, range_key, item, version):
+        condition, values = self._version_condition(version)
+        self._put(key, range_key, item, condition, values)
+
+    def _delete(self, key, range_key, version):
+        condition, values = self._version_condition(version)
+        kwargs = {}
+        if values:
+            kwargs["ExpressionAttributeValues"] = values
+        try:
+            self._call(
+                "write", self.client_low.delete_item,
+                TableName=self.table_name,
+                Key={
+                    'key': {'S': key},
+                    'range_key': {'N': str(range_key)}
+                },
+                ConditionExpression=condition,
+                ExpressionAttributeNames=self._names(condition),
+                **kwargs)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code == "ConditionalCheckFailedException":
+                raise ConflictError("bucket {} {} was modified"
+                                    .format(key, range_key))
+            raise
+
+    def _query(self, key, range_min, range_max, consistent=True):
+        items = self._range_items(key, range_min, range_max,
+                                  consistent=consistent)
+        try:
+            left = self._left(key, range_min, limit=1,
+                              consistent=consistent)[0]
+        except NotFoundError:
+            return items
+        if len(items) > 0 and left == items[0]:
+            pass
+        else:
+            items.insert(0, left)
+        return items
+
+    def _query_eventual(self, key, range_min, range_max):
+        # Half the read capacity of a strongly consistent query
+        return self._query(key, range_min, range_max, consistent=False)
+
+    def _chunk_key(self, key):
+        # "#" is not allowed in keys so this can not collide with a series
+        return "{}#chunks".format(key)
+
+    def _insert_chunk(self, key, seq, item):
+        self._put(self._chunk_key(key), seq, item, "attribute_not_exists(#k)")
+
+    def _chunks(self, key):
+        items = self._query_items("#k = :k",
+                                  {":k": {"S": self._chunk_key(key)}})
+        return [(i["range_key"], dict(i, key=key)) for i in items]
+
+    def _delete_chunks(self, key, seqs):
+        self._write_batches([{"DeleteRequest": {"Key": {
+            "key": {"S": self._chunk_key(key)},
+            "range_key": {"N": str(seq)}}}} for seq in seqs])
+
+    def _batch_write(self, requests):
+        """Write requests with batch_write_item.
+
+        The batch size shrinks while items come back unprocessed and grows
+        again after clean batches, unprocessed items are retried with
+        jittered backoff up to MAX_RETRIES times in a row.
+        """
+        attempt = 0
+        while requests:
+            size = self._batch_size
+            batch, requests = requests[:size], requests[size:]
+            result = self._call("write", self.client_low.batch_write_item,
+                                units=len(batch),
+                                RequestItems={self.table_name: batch})
+            unprocessed = result.get("UnprocessedItems", {}).get(
+                self.table_name, [])
+            if unprocessed:
+                if attempt >= self.MAX_RETRIES:
+                    raise InternalError("items of {} unprocessed after {} "
+                                        "retries".format(self.table_name,
+                                                         attempt))
+                self._batch_size = max(1, size // 2)
+                requests = unprocessed + requests
+                self._backoff(attempt)
+                attempt += 1
+            else:
+                self._batch_size = min(self.BATCH_WRITE_SIZE, size + 1)
+                attempt = 0
+
+    def _write_batches(self, requests, workers=1):
+        """Write requests in batches, optionally from several threads.
+        """
+        batches = [requests[i:i + self.BATCH_WRITE_SIZE]
+                   for i in range(0, len(requests), self.BATCH_WRITE_SIZE)]
+        if workers > 1 and len(batches) > 1:
+            pool = ThreadPool(min(len(batches), workers))
+            try:
+                pool.map(self._batch_write, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for batch in batches:
+                self._batch_write(batch)
+
+    def _insert_many(self, key, items):
+        self._write_batches([
+            {"PutRequest": {"Item": self._low_item(key, range_key, item)}}
+            for range_key, item in items])
+
+    def _delete_range(self, key, range_min, range_max):
+        items = self._range_items(key, range_min, range_max)
+        requests = [{"DeleteRequest": {"Key": {
+            "key": {"S": key},
+            "range_key": {"N": str(i["range_key"])}}}} for i in items]
+        self._write_batches(requests, workers=self.DELETE_WORKERS)
+        return items
+
+    def _get_meta(self, key):
+        result = self._call("read", self.meta_table.get_item,
+                            Key={'key': key}, ConsistentRead=True)
+        item = result.get("Item", None)
+        if not item:
+            return None
+        return json.loads(item["meta"])
+
+    def _put_meta(self, key, meta):
+        self._call("write", self.meta_table.put_item,
+                   Item={'key': key, 'meta': json.dumps(meta)})
+
+    def _update_meta(self, key, update):
+        # Conditional put on the entry that was read, redone on a conflict
+        conditions = boto3.dynamodb.conditions
+        for attempt in range(self.MAX_RETRIES + 1):
+            result = self._call("read", self.meta_table.get_item,
+                                Key={'key': key}, ConsistentRead=True)
+            item = result.get("Item", None)
+            if item:
+                meta = update(json.loads(item["meta"]))
+                condition = conditions.Attr("meta").eq(item["meta"])
+            else:
+                meta = update(None)
+                condition = conditions.Attr("key").not_exists()
+            try:
+                self._call("write", self.meta_table.put_item,
+                           Item={'key': key, 'meta': json.dumps(meta)},
+                           ConditionExpression=condition)
+            except botocore.exceptions.ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code != "ConditionalCheckFailedException":
+                    raise
+                self._backoff(attempt)
+            else:
+                return meta
+        raise InternalError("could not update the index of {}".format(key))
+
+    def _list_keys(self, prefix):
+        kwargs = {"ProjectionExpression": "#k",
+                  "ExpressionAttributeNames": {"#k": "key"}}
+        if prefix:
+            kwargs["FilterExpression"] = \
+                boto3.dynamodb.conditions.Attr("key").begins_with(prefix)
+        result = self._call("read", self.meta_table.scan, **kwargs)
+        keys = [i["key"] for i in result["Items"]]
+        while result.get('LastEvaluatedKey'):
+            result = self._call(
+                "read", self.meta_table.scan,
+                ExclusiveStartKey=result['LastEvaluatedKey'], **kwargs)
+            keys.extend(i["key"] for i in result["Items"])
+        return keys
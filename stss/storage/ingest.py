@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import logging
+import multiprocessing
+import threading
+import time
+import zlib
+
+from ..errors import NotFoundError, ConflictError, InternalError
+from . import check_key
+
+
+logger = logging.getLogger(__name__)
+
+
+def _worker(settings, tasks, results):
+    """Worker process, owns its own TSDB and backend connections.
+    """
+    from . import TSDB
+    db = TSDB(**settings)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, key, data = task
+        try:
+            stats = db.insert(key, data)
+        except (ValueError, NotFoundError, ConflictError, InternalError) as e:
+            results.put((task_id, None, e))
+        except Exception as e:
+            # Backend exceptions are not always picklable
+            logger.exception("Insert into {} failed".format(key))
+            results.put((task_id, None, InternalError(repr(e))))
+        else:
+            results.put((task_id, stats, None))
+
+
+class PendingInsert(object):
+    """Result of an insert that is processed by a worker.
+    """
+    def __init__(self, key):
+        self.key = key
+        self._event = threading.Event()
+        self._stats = None
+        self._error = None
+
+    def ready(self):
+        return self._event.is_set()
+
+    def get(self, timeout=None):
+        """Wait for the insert and return its stats.
+        """
+        if not self._event.wait(timeout):
+            raise InternalError("insert into {} timed out".format(self.key))
+        if self._error is not None:
+            raise self._error
+        return self._stats
+
+    def _set(self, stats, error):
+        self._stats = stats
+        self._error = error
+        self._event.set()
+
+
+class IngestCoordinator(object):
+    """Distribute inserts over worker processes by key.
+
+    All inserts for one key go to the same worker, so workers never
+    compete for the same bucket. Each worker has a bounded queue, a full
+    queue blocks the caller.
+    """
+    def __init__(self, workers=None, queue_size=1000, **settings):
+        self.settings = settings
+        self.workers = workers or multiprocessing.cpu_count()
+        self._closed = False
+        self._counter = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+
+        self._results = multiprocessing.Queue()
+        self._queues = [multiprocessing.Queue(queue_size)
+                        for _ in range(self.workers)]
+        self._processes = []
+        for q in self._queues:
+            p = multiprocessing.Process(target=_worker,
+                                        args=(settings, q, self._results))
+            p.daemon = True
+            p.start()
+            self._processes.append(p)
+
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _shard(self, key):
+        return (zlib.crc32(key.encode("utf8")) & 0xffffffff) % self.workers
+
+    def insert(self, key, data):
+        """Queue an insert, returns a PendingInsert.
+        """
+        if self._closed:
+            raise InternalError("ingest coordinator is closed")
+        # Invalid keys fail here, before anything is registered
+        key = check_key(key)
+        queue = self._queues[self._shard(key)]
+        pending = PendingInsert(key)
+        with self._lock:
+            self._counter += 1
+            task_id = self._counter
+            self._pending[task_id] = pending
+        try:
+            queue.put((task_id, key, data))
+        except BaseException:
+            # Never queued, flush must not wait for it
+            with self._lock:
+                del self._pending[task_id]
+                if not self._pending:
+                    self._drained.notify_all()
+            raise
+        return pending
+
+    def insert_bulk(self, inserts):
+        return [self.insert(i["key"], i["data"]) for i in inserts]
+
+    def _collect(self):
+        while True:
+            msg = self._results.get()
+            if msg is None:
+                break
+            task_id, stats, error = msg
+            with self._lock:
+                pending = self._pending.pop(task_id)
+                if not self._pending:
+                    self._drained.notify_all()
+            pending._set(stats, error)
+
+    def flush(self, timeout=None):
+        """Wait until all queued inserts are processed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._pending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self._drained.wait(remaining)
+            return not self._pending
+
+    def close(self, timeout=None):
+        """Drain the queues and stop the workers.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.flush(timeout)
+        for q in self._queues:
+            q.put(None)
+        for p in self._processes:
+            p.join(timeout)
+        self._results.put(None)
+        self._collector.join(timeout)
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import json
+import logging
+import os
+import struct
+import threading
+
+import lmdb
+
+from ..errors import NotFoundError, ConflictError
+from .backend import StorageAPI
+from .models import Bucket
+
+
+logger = logging.getLogger(__name__)
+
+
+# An environment must only be opened once per process
+_environments = {}
+_environments_lock = threading.Lock()
+
+
+def lmdb_environment(path, map_size):
+    """Open or reuse the environment of path.
+    """
+    with _environments_lock:
+        env = _environments.get(path)
+        if env is None:
+            env = lmdb.open(path, map_size=map_size, max_dbs=3,
+                            subdir=True)
+            _environments[path] = env
+        return env
+
+
+class LMDBStorage(StorageAPI):
+    """Embedded storage in an LMDB environment.
+
+    Buckets are stored under ``key + "\\x00" + range_key`` with the range
+    key big endian, so the buckets of a key are adjacent and in order.
+    ``left`` is a single cursor seek and range queries are cursor walks.
+    The buckets are decoded inside the read transaction straight from the
+    memory map, the items of this backend are already buckets.
+
+    Readers in other threads and processes do not block, writes are
+    serialized by LMDB. Open the storage after forking.
+    """
+    SETTINGS = {
+        "LMDB_PATH": "./stss.lmdb",
+        "LMDB_MAP_SIZE": 1 << 30,
+    }
+    CONCURRENT_READS = True
+
+    RANGE_KEY = struct.Struct(">I")
+    RANGE_KEY_MAX = (2**32) - 1
+    # Version and sketch size, followed by the sketch and the bucket
+    VALUE_HEADER = struct.Struct("<II")
+
+    def __init__(self, path, map_size=1 << 30):
+        self.path = os.path.realpath(path)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.env = lmdb_environment(self.path, map_size)
+        self.buckets = self.env.open_db(b"buckets")
+        self.chunk_db = self.env.open_db(b"chunks")
+        self.meta_db = self.env.open_db(b"meta")
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings["LMDB_PATH"], map_size=settings["LMDB_MAP_SIZE"])
+
+    def _prefix(self, key):
+        return key.encode("utf8") + b"\x00"
+
+    def _db_key(self, key, range_key):
+        range_key = min(max(range_key, 0), self.RANGE_KEY_MAX)
+        return self._prefix(key) + self.RANGE_KEY.pack(range_key)
+
+    def _read(self, db):
+        return self.env.begin(db=db, buffers=True)
+
+    def _write(self, db):
+        return self.env.begin(db=db, write=True)
+
+    def _to_bucket(self, item):
+        return item
+
+    def _from_bucket(self, bucket):
+        sketch = self._sketch_data(bucket) or b""
+        return b"".join([self.VALUE_HEADER.pack(bucket.version + 1,
+                                                len(sketch)),
+                         sketch, bucket.to_string()])
+
+    def _decode(self, key, value):
+        version, size = self.VALUE_HEADER.unpack_from(value, 0)
+        start = self.VALUE_HEADER.size
+        bucket = Bucket.from_db_data(key, bytes(value[start + size:]))
+        bucket._version = version
+        if size > 0:
+            self._load_sketch(bucket, bytes(value[start:start + size]))
+        return bucket
+
+    # With buffers the values are reused by the next cursor operation,
+    # so every value is decoded right away. Buffers are compared as bytes,
+    # Python 2 buffers never equal a str.
+    def _forward(self, cursor, key, range_min, range_max, limit=None):
+        """(range_key, bucket) of key in [range_min, range_max] in order.
+        """
+        prefix = self._prefix(key)
+        n = len(prefix)
+        items = []
+        if not cursor.set_range(self._db_key(key, range_min)):
+            return items
+        for k, v in cursor.iternext():
+            if limit is not None and len(items) >= limit:
+                break
+            if bytes(k[:n]) != prefix:
+                break
+            range_key = self.RANGE_KEY.unpack_from(k, n)[0]
+            if range_key > range_max:
+                break
+            items.append((range_key, self._decode(key, v)))
+        return items
+
+    def _backward(self, cursor, key, range_max, limit):
+        """Up to limit (range_key, bucket) of key <= range_max, newest first.
+        """
+        prefix = self._prefix(key)
+        n = len(prefix)
+        upper = self._db_key(key, range_max)
+        items = []
+        if range_max < 0:
+            return items
+        if cursor.set_range(upper):
+            # Positioned on the first key >= upper
+            if bytes(cursor.key()) != upper and not cursor.prev():
+                return items
+        elif not cursor.last():
+            return items
+        for k, v in cursor.iterprev():
+            if len(items) >= limit or bytes(k[:n]) != prefix:
+                break
+            items.append((self.RANGE_KEY.unpack_from(k, n)[0],
+                          self._decode(key, v)))
+        return items
+
+    def _insert(self, key, range_key, item):
+        with self._write(self.buckets) as txn:
+            if not txn.put(self._db_key(key, range_key), item,
+                           overwrite=False):
+                raise ConflictError("bucket {} {} exists"
+                                    .format(key, range_key))
+
+    def _insert_many(self, key, items):
+        # One write transaction, aborted as a whole on a conflict
+        with self._write(self.buckets) as txn:
+            for range_key, item in items:
+                if not txn.put(self._db_key(key, range_key), item,
+                               overwrite=False):
+                    raise ConflictError("bucket {} {} exists"
+                                        .format(key, range_key))
+
+    def _checked(self, txn, key, range_key, version):
+        db_key = self._db_key(key, range_key)
+        current = txn.get(db_key)
+        if current is None:
+            raise ConflictError("bucket {} {} was removed"
+                                .format(key, range_key))
+        if self.VALUE_HEADER.unpack_from(current, 0)[0] != version:
+            raise ConflictError("bucket {} {} was modified"
+                                .format(key, range_key))
+        return db_key
+
+    def _update(self, key, range_key, item, version):
+        with self._write(self.buckets) as txn:
+            txn.put(self._checked(txn, key, range_key, version), item)
+
+    def _delete(self, key, range_key, version):
+        with self._write(self.buckets) as txn:
+            txn.delete(self._checked(txn, key, range_key, version))
+
+    def _get(self, key, range_key):
+        with self._read(self.buckets) as txn:
+            value = txn.get(self._db_key(key, range_key))
+            if value is None:
+                raise NotFoundError
+            return self._decode(key, value)
+
+    def _get_many(self, pairs):
+        res = []
+        with self._read(self.buckets) as txn:
+            for key, range_key in pairs:
+                value = txn.get(self._db_key(key, range_key))
+                res.append(None if value is None
+                           else self._decode(key, value))
+        return res
+
+    def _first(self, key, limit=1):
+        with self._read(self.buckets) as txn:
+            items = self._forward(txn.cursor(), key, 0, self.RANGE_KEY_MAX,
+                                  limit=limit)
+            if len(items) < 1:
+                raise NotFoundError
+            return [b for _, b in items]
+
+    def _last(self, key, limit=1):
+        return self._left(key, self.RANGE_KEY_MAX, limit=limit)
+
+    def _left(self, key, range_key, limit=1):
+        with self._read(self.buckets) as txn:
+            items = self._backward(txn.cursor(), key, range_key, limit)
+            if len(items) < 1:
+                raise NotFoundError
+            return [b for _, b in items]
+
+    def _query(self, key, range_min, range_max):
+        with self._read(self.buckets) as txn:
+            cursor = txn.cursor()
+            left = self._backward(cursor, key, range_min, 1)
+            items = self._forward(cursor, key, range_min, range_max)
+            if len(left) > 0 and (len(items) < 1 or
+                                  items[0][0] != left[0][0]):
+                items.insert(0, left[0])
+            return [b for _, b in items]
+
+    def _insert_chunk(self, key, seq, item):
+        with self._write(self.chunk_db) as txn:
+            txn.put(self._db_key(key, seq), item)
+
+    def _chunks(self, key):
+        with self._read(self.chunk_db) as txn:
+            return self._forward(txn.cursor(), key, 0, self.RANGE_KEY_MAX)
+
+    def _delete_chunks(self, key, seqs):
+        with self._write(self.chunk_db) as txn:
+            for seq in seqs:
+                txn.delete(self._db_key(key, seq))
+
+    def _delete_range(self, key, range_min, range_max):
+        with self._write(self.buckets) as txn:
+            # Walk first, then delete
+            items = self._forward(txn.cursor(), key, range_min, range_max)
+            for range_key, _ in items:
+                txn.delete(self._db_key(key, range_key))
+        return [bucket for _, bucket in items]
+
+    def _get_meta(self, key):
+        with self._read(self.meta_db) as txn:
+            meta = txn.get(key.encode("utf8"))
+            if meta is None:
+                return None
+            return json.loads(bytes(meta).decode("utf8"))
+
+    def _put_meta(self, key, meta):
+        with self._write(self.meta_db) as txn:
+            txn.put(key.encode("utf8"), json.dumps(meta).encode("utf8"))
+
+    def _update_meta(self, key, update):
+        # Write transactions are serialized, read and write in one
+        with self._write(self.meta_db) as txn:
+            current = txn.get(key.encode("utf8"))
+            meta = update(None if current is None
+                          else json.loads(bytes(current).decode("utf8")))
+            txn.put(key.encode("utf8"), json.dumps(meta).encode("utf8"))
+        return meta
+
+    def _list_keys(self, prefix):
+        prefix = prefix.encode("utf8")
+        keys = []
+        with self._read(self.meta_db) as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(prefix):
+                return keys
+            for k in cursor.iternext(values=False):
+                if bytes(k[:len(prefix)]) != prefix:
+                    break
+                keys.append(bytes(k).decode("utf8"))
+        return keys
@@ -11,10 +11,14 @@ from enum import Enum
 from collections import MutableSequence
 from collections import namedtuple
 from collections import OrderedDict
-from itertools import chain
+from collections import deque
+from itertools import chain, islice
 
 import bisect
+import heapq
 import logging
+import math
+import numbers
 import struct
 import array
 import hashlib
@@ -24,6 +28,7 @@ from .helper import ts_daily_left, ts_daily_right
 from .helper import ts_hourly_left, ts_hourly_right
 from .helper import ts_weekly_left, ts_weekly_right
 from .helper import ts_monthly_left, ts_monthly_right
+from .sketch import DDSketch
 
 
 Aggregation = namedtuple('Aggregation', ['min', 'max', 'sum', 'count'])
@@ -47,32 +52,139 @@ class ItemType(Enum):
     basic_aggregation = 6
 
 
+CALENDAR_WINDOWS = {
+    "hourly": (ts_hourly_left, ts_hourly_right),
+    "daily": (ts_daily_left, ts_daily_right),
+    "weekly": (ts_weekly_left, ts_weekly_right),
+    "monthly": (ts_monthly_left, ts_monthly_right),
+}
+
+
+def percentile(values, q):
+    """Percentile with linear interpolation between the closest ranks.
+    """
+    v = sorted(values)
+    pos = (len(v) - 1) * q / 100.0
+    low = int(math.floor(pos))
+    high = min(low + 1, len(v) - 1)
+    return v[low] + (v[high] - v[low]) * (pos - low)
+
+
+def parse_percentile(function):
+    """Return the percentile of ``median`` or ``pNN`` functions or None.
+    """
+    if function == "median":
+        return 50.0
+    if not function.startswith("p"):
+        return None
+    try:
+        q = float(function[1:])
+    except ValueError:
+        raise ValueError("Invalid aggregation function")
+    if not 0 <= q <= 100:
+        raise ValueError("Invalid percentile")
+    return q
+
+
+def aggregation_function(function):
+    if function == "sum":
+        return sum
+    elif function == "count":
+        return len
+    elif function == "min":
+        return min
+    elif function == "max":
+        return max
+    elif function == "amp":
+        def amp(x):
+            return max(x) - min(x)
+        return amp
+    elif function == "mean":
+        def mean(x):
+            return sum(x) / len(x)
+        return mean
+    q = parse_percentile(function)
+    if q is not None:
+        return lambda x: percentile(x, q)
+    raise ValueError("Invalid aggregation function")
+
+
 class TupleArray(MutableSequence):
+    """Sequence of fixed size tuples backed by one contiguous array.
+
+    The tuples are stored one after the other (array of structs) in a
+    single ``array.array``, so appending a tuple is amortized O(1) and a
+    component is a strided slice. The serialized format stays the old
+    one-array-per-component layout (column after column).
+    """
     def __init__(self, data_type="f", tuple_size=2):
         if tuple_size < 2 or tuple_size > 20:
             raise ValueError("invalid tuple size (2-20)")
         super(TupleArray, self).__init__()
         self.data_type = data_type
         self.tuple_size = tuple_size
-        self._arrays = [array.array(data_type) for i in range(tuple_size)]
+        self._data = array.array(data_type)
 
     def __len__(self):
-        return len(self._arrays[0])
+        return len(self._data) // self.tuple_size
+
+    def _index(self, ii):
+        n = len(self)
+        if ii < 0:
+            ii += n
+        if ii < 0 or ii >= n:
+            raise IndexError("TupleArray index out of range")
+        return ii
+
+    def _pack(self, val):
+        if len(val) != self.tuple_size:
+            raise ValueError("tuple size incorrect")
+        return array.array(self.data_type, val)
 
     def __getitem__(self, ii):
-        return tuple(item[ii] for item in self._arrays)
+        if isinstance(ii, slice):
+            return self._slice(*ii.indices(len(self)))
+        k = self.tuple_size
+        ii = self._index(ii)
+        return tuple(self._data[ii * k:(ii + 1) * k])
+
+    def _slice(self, start, stop, step):
+        k = self.tuple_size
+        t = TupleArray(self.data_type, k)
+        if step == 1:
+            t._data = self._data[start * k:max(start, stop) * k]
+        else:
+            for i in range(start, stop, step):
+                t._data += self._data[i * k:(i + 1) * k]
+        return t
 
     def __delitem__(self, ii):
-        for a in self._arrays:
-            del a[ii]
+        k = self.tuple_size
+        if isinstance(ii, slice):
+            start, stop, step = ii.indices(len(self))
+            if step != 1:
+                for i in sorted(range(start, stop, step), reverse=True):
+                    del self[i]
+                return
+            del self._data[start * k:max(start, stop) * k]
+            return
+        ii = self._index(ii)
+        del self._data[ii * k:(ii + 1) * k]
 
     def __setitem__(self, ii, val):
-        if len(val) != len(self._arrays):
-            raise ValueError("tuple size incorrect")
+        k = self.tuple_size
+        val = self._pack(val)
+        ii = self._index(ii)
+        self._data[ii * k:(ii + 1) * k] = val
 
-        for i, v in enumerate(val):
-            self._arrays[i][ii] = v
-        return tuple(item[ii] for item in self._arrays)
+    def __eq__(self, other):
+        if not isinstance(other, TupleArray):
+            return False
+        return (self.tuple_size == other.tuple_size and
+                self._data == other._data)
+
+    def __ne__(self, other):
+        return not self == other
 
     def __str__(self):
         return self.__repr__()
@@ -81,68 +193,139 @@ class TupleArray(MutableSequence):
         return "<TupleArray {} x {}>".format(self.data_type, self.tuple_size)
 
     def insert(self, ii, val):
-        if len(val) != len(self._arrays):
-            raise ValueError("tuple size incorrect")
-
-        for i, v in enumerate(val):
-            self._arrays[i].insert(ii, v)
+        k = self.tuple_size
+        val = self._pack(val)
+        n = len(self)
+        if ii < 0:
+            ii = max(0, ii + n)
+        ii = min(ii, n)
+        self._data[ii * k:ii * k] = val
 
     def append(self, val):
-        if len(val) != len(self._arrays):
+        self._data.extend(self._pack(val))
+
+    def extend(self, values):
+        """Append many tuples at once.
+        """
+        if isinstance(values, TupleArray):
+            if values.tuple_size != self.tuple_size:
+                raise ValueError("tuple size incorrect")
+            self._data.extend(values._data)
+            return
+        for val in values:
+            self.append(val)
+
+    def extend_columns(self, columns):
+        """Append one sequence of values per component.
+
+        The columns are interleaved with one strided assignment each.
+        """
+        if len(columns) != self.tuple_size:
             raise ValueError("tuple size incorrect")
+        columns = [c if isinstance(c, array.array) and
+                   c.typecode == self.data_type
+                   else array.array(self.data_type, c) for c in columns]
+        added = len(columns[0])
+        if any(len(c) != added for c in columns):
+            raise ValueError("columns have different lengths")
+        k = self.tuple_size
+        data = array.array(self.data_type, [0]) * (added * k)
+        for c in range(k):
+            data[c::k] = columns[c]
+        self._data.extend(data)
+
+    def column(self, i):
+        """Return the values of one component.
+
+        This is a strided memoryview into the backing buffer where the
+        platform supports it (no copy), otherwise a copy of the values.
+        """
+        if i < 0 or i >= self.tuple_size:
+            raise IndexError("column out of range")
+        k = self.tuple_size
+        try:
+            return memoryview(self._data)[i::k]
+        except TypeError:  # Python 2 arrays have no buffer interface
+            return self._data[i::k]
 
-        for i, v in enumerate(val):
-            self._arrays[i].append(v)
+    @property
+    def nbytes(self):
+        return self._data.itemsize * len(self._data)
 
     def tostring(self):
-        return b"".join([x.tostring() for x in self._arrays])
+        k = self.tuple_size
+        return b"".join(self._data[c::k].tostring() for c in range(k))
 
     def fromstring(self, string):
-        s = len(string) / len(self._arrays)
-        for i, a in enumerate(self._arrays):
-            f = int(i * s)
-            t = int(i * s + s)
-            a.fromstring(string[f:t])
+        data = array.array(self.data_type)
+        data.fromstring(string)
+        n = len(data) // self.tuple_size
+        self.extend_columns([data[c * n:(c + 1) * n]
+                             for c in range(self.tuple_size)])
 
 
 class Bucket(object):
-    def __init__(self, parent, key, range_key, values=None):
-        self.parent = parent
-        self._dirty = False
-        self._existing = False
-        self._range_min = 0
-        self._range_max = 0
-        self.set_range_key(range_key)
+    HEADER_SIZE = 8
+    SKETCH_ACCURACY = 0.01
+    DEFAULT_ITEMTYPE = ItemType.raw_float
+    DEFAULT_BUCKETTYPE = BucketType.dynamic
+    DYNAMICSIZE_TARGET = 100
+    DYNAMICSIZE_MAX = 190
+
+    def __init__(self, key, values=None, item_type=ItemType.raw_float,
+                 bucket_type=BucketType.dynamic):
+        self.key = str(key).lower()
+        self.item_type = item_type
+        self.bucket_type = bucket_type
+        self._sketch = None
+        # Version of the stored bucket, used for conditional writes
+        self._version = 0
+        # Size when the bucket was read, to maintain the key index
+        self._stored_count = 0
+        self._stored_bytes = 0
+        # Range key the bucket is stored under, None if not stored
+        self._stored_range_key = None
 
         # Create Data Structures
         self._timestamps = array.array("I")
-        if self.item_type == ItemType.raw_float:
-            self._values = array.array("f")
-        elif self.item_type == ItemType.raw_int:
-            self._values = array.array("I")
-        elif self.item_type == ItemType.tuple_float_2:
-            self._values = TupleArray("f", 2)
-        elif self.item_type == ItemType.tuple_float_3:
-            self._values = TupleArray("f", 3)
-        elif self.item_type == ItemType.tuple_float_4:
-            self._values = TupleArray("f", 4)
-        else:
-            raise NotImplementedError("invalid item type")
+        self._values = self._new_values()
 
         if values is not None:
             self.insert(values)
+        self._dirty = False
+        self._existing = False
 
-    @property
-    def item_type(self):
-        return self.parent.item_type
+    @classmethod
+    def new(cls, key, values=None):
+        """Factory Method to create Items.
+        """
+        return cls(key, values, item_type=cls.DEFAULT_ITEMTYPE,
+                   bucket_type=cls.DEFAULT_BUCKETTYPE)
 
-    @property
-    def bucket_type(self):
-        return self.parent.bucket_type
+    def _new_values(self):
+        if self.item_type == ItemType.raw_float:
+            return array.array("f")
+        elif self.item_type == ItemType.raw_int:
+            return array.array("I")
+        elif self.item_type == ItemType.tuple_float_2:
+            return TupleArray("f", 2)
+        elif self.item_type == ItemType.tuple_float_3:
+            return TupleArray("f", 3)
+        elif self.item_type == ItemType.tuple_float_4:
+            return TupleArray("f", 4)
+        elif self.item_type == ItemType.basic_aggregation:
+            return TupleArray("f", 4)
+        raise NotImplementedError("invalid item type")
 
-    @property
-    def key(self):
-        return self.parent.key
+    def _like(self, timestamps, values):
+        """New dirty bucket of the same key and types.
+        """
+        b = Bucket(self.key, item_type=self.item_type,
+                   bucket_type=self.bucket_type)
+        b._dirty = True
+        b._timestamps = timestamps
+        b._values = values
+        return b
 
     @property
     def existing(self):
@@ -156,36 +339,51 @@ class Bucket(object):
         self._dirty = False
 
     @property
-    def range_key(self):
-        return self._range_min
+    def version(self):
+        return self._version
 
-    def set_range_key(self, range_key):
-        if self.bucket_type == BucketType.hourly:
-            l = ts_hourly_left(range_key)
-            r = ts_hourly_right(range_key)
-        elif self.bucket_type == BucketType.daily:
-            l = ts_daily_left(range_key)
-            r = ts_daily_right(range_key)
-        elif self.bucket_type == BucketType.weekly:
-            l = ts_weekly_left(range_key)
-            r = ts_weekly_right(range_key)
-        elif self.bucket_type == BucketType.monthly:
-            l = ts_monthly_left(range_key)
-            r = ts_monthly_right(range_key)
-        else:
+    @property
+    def sketch(self):
+        """Quantile sketch of the values, built on first use.
+        """
+        if self.item_type not in (ItemType.raw_float, ItemType.raw_int):
+            raise ValueError("sketches need scalar values")
+        if self._sketch is None:
+            sketch = DDSketch(self.SKETCH_ACCURACY)
+            sketch.extend(self._values)
+            self._sketch = sketch
+        return self._sketch
+
+    @property
+    def range_key(self):
+        if len(self._timestamps) < 1:
+            raise ValueError("empty series")
+        if self.bucket_type == BucketType.dynamic:
+            return self._timestamps[0]
+        window = CALENDAR_WINDOWS.get(self.bucket_type.name)
+        if window is None:
             raise NotImplementedError("invalid bucket type")
-        if l != range_key:
-            raise ValueError("invalid range key: %s" % range_key)
-        self._range_min = l
-        self._range_max = r
+        return window[0](self._timestamps[0])
+
+    @property
+    def stored_range_key(self):
+        """Range key the bucket was read or written with.
+
+        Stays valid when removing points moves or empties the range key.
+        """
+        if self._stored_range_key is None:
+            return self.range_key
+        return self._stored_range_key
 
     @property
     def range_min(self):
-        return self._range_min
+        return self.range_key
 
     @property
     def range_max(self):
-        return self._range_max
+        if self.bucket_type == BucketType.dynamic:
+            return self.ts_max
+        return CALENDAR_WINDOWS[self.bucket_type.name][1](self.range_key)
 
     def __len__(self):
         return len(self._timestamps)
@@ -266,12 +464,93 @@ class Bucket(object):
             return self._timestamps[0]
         return -1
 
+    @property
+    def count(self):
+        return len(self._timestamps)
+
+    def split_needed(self, limit="soft"):
+        if len(self) < 1:
+            return False
+        if self.bucket_type == BucketType.dynamic:
+            if len(self) > Bucket.DYNAMICSIZE_MAX:
+                return True
+            if len(self) > Bucket.DYNAMICSIZE_TARGET and limit == "soft":
+                return True
+            return False
+        window = CALENDAR_WINDOWS.get(self.bucket_type.name)
+        if window is None:
+            raise NotImplementedError("invalid bucket type")
+        return window[0](self.ts_min) != window[0](self.ts_max)
+
+    def split_item(self):
+        """Split into buckets of the target size or of one period each.
+
+        The bucket itself keeps the first part, all parts are dirty.
+        """
+        if self.bucket_type == BucketType.dynamic:
+            return self._split_item_at(count=Bucket.DYNAMICSIZE_TARGET)
+        return self._split_item()
+
+    def _split_item(self):
+        window = CALENDAR_WINDOWS.get(self.bucket_type.name)
+        if window is None:
+            raise NotImplementedError("invalid bucket type")
+        right = window[1]
+        ts = self._timestamps
+        values = self._values
+        # Cut at the end of every period in one pass
+        cuts = [0]
+        while cuts[-1] < len(ts):
+            cuts.append(bisect.bisect_right(ts, right(ts[cuts[-1]]),
+                                            cuts[-1]))
+        new_items = [self._like(ts[a:b], values[a:b])
+                     for a, b in zip(cuts[1:-1], cuts[2:])]
+        self._timestamps = ts[:cuts[1]]
+        self._values = values[:cuts[1]]
+        self._dirty = True
+        self._sketch = None
+        new_items.insert(0, self)
+        return new_items
+
+    def _split_item_at(self, count):
+        if count >= len(self._timestamps):
+            raise ValueError("split to big")
+        splits = list(range(count, len(self._timestamps), count))
+        splits += [len(self._timestamps)]
+
+        new_items = [self._like(self._timestamps[splits[s]:splits[s + 1]],
+                                self._values[splits[s]:splits[s + 1]])
+                     for s in range(len(splits) - 1)]
+        self._timestamps = self._timestamps[0:splits[0]]
+        self._values = self._values[0:splits[0]]
+        self._dirty = True
+        self._sketch = None
+
+        new_items.insert(0, self)
+        return new_items
+
     def _at(self, i):
+        if self.item_type == ItemType.basic_aggregation:
+            return (self._timestamps[i], Aggregation(*self._values[i]))
         return (self._timestamps[i], self._values[i])
 
     def __getitem__(self, key):
         return self._at(key)
 
+    def to_list(self):
+        return [self._at(i) for i in range(len(self._timestamps))]
+
+    @property
+    def nbytes(self):
+        """Size of the encoded bucket without encoding it.
+        """
+        if isinstance(self._values, TupleArray):
+            values = self._values.nbytes
+        else:
+            values = self._values.itemsize * len(self._values)
+        return (self.HEADER_SIZE +
+                self._timestamps.itemsize * len(self._timestamps) + values)
+
     def to_string(self):
         header = (struct.pack("H", int(self.item_type.value)) +
                   struct.pack("H", int(self.bucket_type.value)))
@@ -286,12 +565,18 @@ class Bucket(object):
         item_length = int(struct.unpack("I", string[4:8])[0])
         split = 8 + 4 * item_length
         ts, v = string[8:split], string[split:]
-        i = Bucket(key, item_type=item_type, bucket_type=bucket_type)
+        i = cls(key, item_type=item_type, bucket_type=bucket_type)
         i._timestamps.fromstring(ts)
         i._values.fromstring(v)
         assert(i)
         return i
 
+    @classmethod
+    def from_db_data(cls, key, data):
+        i = cls.from_string(key, data)
+        i._existing = True
+        return i
+
     def insert_point(self, timestamp, value, overwrite=False):
         timestamp = int(timestamp)
         idx = bisect.bisect_left(self._timestamps, timestamp)
@@ -300,6 +585,7 @@ class Bucket(object):
             self._timestamps.append(timestamp)
             self._values.append(value)
             self._dirty = True
+            self._sketch = None
             return 1
         # Already Existing
         if self._timestamps[idx] == timestamp:
@@ -308,20 +594,96 @@ class Bucket(object):
             if overwrite:
                 self._values[idx] = value
                 self._dirty = True
+                self._sketch = None
                 return 1
             return 0
         # Insert
         self._timestamps.insert(idx, timestamp)
         self._values.insert(idx, value)
         self._dirty = True
+        self._sketch = None
         return 1
 
+    def merge(self, timestamps, values):
+        """Merge sorted timestamps and values in one linear pass.
+
+        Like insert_point, stored timestamps are kept and only the first
+        of duplicate input timestamps is used. Returns the number of
+        added points.
+        """
+        n = len(timestamps)
+        if n < 1:
+            return 0
+        m = len(self._timestamps)
+        strictly_sorted = all(a < b for a, b in
+                              zip(timestamps, islice(timestamps, 1, None)))
+        if strictly_sorted and (m < 1 or timestamps[0] > self._timestamps[-1]):
+            # Append, arrays only extend arrays of the same typecode
+            if (isinstance(values, array.array) and
+                    isinstance(self._values, array.array) and
+                    values.typecode != self._values.typecode):
+                values = array.array(self._values.typecode, values)
+            self._timestamps.extend(timestamps)
+            self._values.extend(values)
+            added = n
+        else:
+            old_ts = self._timestamps
+            old_values = self._values
+            ts = []
+            vals = []
+            i = j = added = 0
+            last = None
+            while i < m or j < n:
+                if j >= n or (i < m and old_ts[i] <= timestamps[j]):
+                    t = old_ts[i]
+                    v = old_values[i]
+                    i += 1
+                else:
+                    t = timestamps[j]
+                    v = values[j]
+                    j += 1
+                    if t == last:
+                        continue
+                    added += 1
+                ts.append(t)
+                vals.append(v)
+                last = t
+            if added < 1:
+                return 0
+            self._timestamps = array.array("I", ts)
+            self._values = self._new_values()
+            self._values.extend(vals)
+        self._dirty = True
+        self._sketch = None
+        return added
+
+    def remove_range(self, ts_min, ts_max):
+        """Remove the points in [ts_min, ts_max], returns how many.
+        """
+        a = bisect.bisect_left(self._timestamps, ts_min)
+        b = bisect.bisect_right(self._timestamps, ts_max)
+        if b <= a:
+            return 0
+        del self._timestamps[a:b]
+        del self._values[a:b]
+        self._dirty = True
+        self._sketch = None
+        return b - a
+
     def insert(self, series):
         counter = 0
         for timestamp, value in series:
             counter += self.insert_point(timestamp, value)
         return counter
 
+    def pretty_print(self):
+        lines = []
+        lines.append("{}: {} points({})".format(self.key, len(self),
+                                                self.item_type))
+        for i in range(len(self)):
+            lines.append("{}: {}".format(*self._at(i)))
+        return "\n".join(lines)
+
 
 class BucketCollection(OrderedDict):
     def __init__(self, parent, *args, **kwargs):
@@ -329,8 +691,8 @@ class BucketCollection(OrderedDict):
         super(BucketCollection, self).__init__(*args, **kwargs)
 
     def __missing__(self, key):
-        k = self.parent.key
-        bucket = Bucket(self.parent, k, key)
+        bucket = Bucket(self.parent.key, item_type=self.parent.item_type,
+                        bucket_type=self.parent.bucket_type)
         self[key] = bucket
         return self[key]
 
@@ -348,6 +710,9 @@ class TimeSeries(object):
         self.key = str(key).lower()
 
         self.buckets = BucketCollection(self)
+        # Cumulative bucket lengths, rebuilt lazily after inserts
+        self._offsets = None
+        self._bucket_list = []
         if values is not None:
             self.insert(values)
 
@@ -376,6 +741,7 @@ class TimeSeries(object):
             raise NotImplementedError("invalid bucket type")
 
     def insert(self, series):
+        self._offsets = None
         last_range_min = -1
         last_range_max = -1
         for timestamp, value in series:
@@ -393,118 +759,349 @@ class TimeSeries(object):
 
     @property
     def timestamps(self):
-        bucket_timestamps = [x._timestamps for x in self.buckets.itervalues()]
-        return chain(bucket_timestamps)
+        return chain.from_iterable(x._timestamps
+                                   for x in self.buckets.values())
 
     @property
     def values(self):
-        bucket_values = [x._values for x in self.buckets.itervalues()]
-        return chain(bucket_values)
+        return chain.from_iterable(x._values for x in self.buckets.values())
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            self._bucket_list = list(self.buckets.values())
+            offsets = [0]
+            for b in self._bucket_list:
+                offsets.append(offsets[-1] + len(b))
+            self._offsets = offsets
+        return self._offsets
 
     def __len__(self):
-        return sum([len(x) for x in self.buckets.itervalues()])
+        return self._get_offsets()[-1]
 
     def _at(self, i):
-        offset = 0
-        idx = 0
-        buckets = list(self.buckets.items())
-        current_bucket = buckets[idx]
-        while i >= len(current_bucket) + offset:
-            offset += len(current_bucket)
-            idx += 1
-            current_bucket = buckets[idx]
-        return current_bucket[i-offset]
+        offsets = self._get_offsets()
+        if i < 0:
+            i += offsets[-1]
+        if i < 0 or i >= offsets[-1]:
+            raise IndexError("TimeSeries index out of range")
+        idx = bisect.bisect_right(offsets, i) - 1
+        return self._bucket_list[idx][i - offsets[idx]]
 
     def __getitem__(self, key):
         return self._at(key)
 
 
 class ResultSet(TimeSeries):
+    """Read only view over a list of buckets.
+
+    The buckets are not copied into one array. Every bucket is kept as a
+    segment ``[bucket, start, end]`` and ``_offsets`` holds the prefix sum
+    of the segment lengths for random access.
+    """
     def __init__(self, key, items):
         super(ResultSet, self).__init__(key)
         self.bucket_type = BucketType.resultset
+        self._segments = []
         for i in items:
             if i.key != key:
                 raise ValueError("Item has wrong key")
-            self._timestamps += i._timestamps
-            self._values += i._values
+            if len(i) > 0:
+                self._segments.append([i, 0, len(i)])
+        self._update_offsets()
+
+    def _update_offsets(self):
+        self._segments = [x for x in self._segments if x[2] > x[1]]
+        self._offsets = [0]
+        for _, start, end in self._segments:
+            self._offsets.append(self._offsets[-1] + end - start)
 
     def _trim(self, ts_min, ts_max):
-        low = bisect.bisect_left(self._timestamps, ts_min)
-        high = bisect.bisect_right(self._timestamps, ts_max)
-        self._timestamps = self._timestamps[low:high]
-        self._values = self._values[low:high]
+        segments = self._segments
+        # Drop the buckets completely outside
+        while segments and segments[0][0]._timestamps[segments[0][2] - 1] < ts_min:
+            segments.pop(0)
+        while segments and segments[-1][0]._timestamps[segments[-1][1]] > ts_max:
+            segments.pop()
+        # Adjust the offsets of the first and last bucket
+        if segments:
+            first = segments[0]
+            first[1] = bisect.bisect_left(first[0]._timestamps, ts_min,
+                                          first[1], first[2])
+            last = segments[-1]
+            last[2] = bisect.bisect_right(last[0]._timestamps, ts_max,
+                                          last[1], last[2])
+        self._update_offsets()
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def _at(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("ResultSet index out of range")
+        s = bisect.bisect_right(self._offsets, i) - 1
+        bucket, start, _ = self._segments[s]
+        idx = start + i - self._offsets[s]
+        return (bucket._timestamps[idx], bucket._values[idx])
+
+    def __iter__(self):
+        return self.all()
+
+    @property
+    def timestamps(self):
+        return chain.from_iterable(islice(b._timestamps, start, end)
+                                   for b, start, end in self._segments)
+
+    @property
+    def values(self):
+        return chain.from_iterable(islice(b._values, start, end)
+                                   for b, start, end in self._segments)
 
     def all(self):
         """Return an iterater to get all ts value pairs.
         """
-        return zip(self._timestamps, self._values)
+        return zip(self.timestamps, self.values)
+
+    def _windows(self, group):
+        """Split the data into consecutive windows in one linear pass.
+
+        ``group`` is a calendar window name or a fixed step in seconds.
+        Yields (window_start, [(ts, value), ...]) for non empty windows.
+        """
+        return self._tumbling(*self._parse_group(group))
+
+    def _parse_group(self, group):
+        if isinstance(group, numbers.Integral) and not isinstance(group, bool):
+            if group < 1:
+                raise ValueError("Invalid aggregation step")
+            return group, None, None
+        elif group in CALENDAR_WINDOWS:
+            left, right = CALENDAR_WINDOWS[group]
+            return None, left, right
+        raise ValueError("Invalid aggregation group")
+
+    def _tumbling(self, step, left, right):
+        window = []
+        start = None
+        upper_bound = -1
+        for ts, value in self.all():
+            if ts > upper_bound:
+                if window:
+                    yield (start, window)
+                window = []
+                # Boundaries are only computed once per window
+                if step:
+                    start = ts - ts % step
+                    upper_bound = start + step - 1
+                else:
+                    start = left(ts)
+                    upper_bound = right(ts)
+            window.append((ts, value))
+        if window:
+            yield (start, window)
+
+    def _sliding(self, step, size):
+        """Windows ``[t, t + size)`` for every ``t`` on the step grid.
+
+        Points enter and leave a queue once, empty windows are skipped.
+        """
+        if step < 1 or size < 1:
+            raise ValueError("Invalid sliding window")
+        points = self.all()
+        pending = next(points, None)
+        if pending is None:
+            return
+        queue = deque()
+        t = ((pending[0] - size) // step) * step + step
+        while True:
+            while pending is not None and pending[0] < t + size:
+                queue.append(pending)
+                pending = next(points, None)
+            while queue and queue[0][0] < t:
+                queue.popleft()
+            if queue:
+                yield (t, list(queue))
+                t += step
+            elif pending is None:
+                return
+            else:
+                # Jump over the gap to the first window with data
+                t = ((pending[0] - size) // step) * step + step
 
     def daily(self):
         """Generator to access daily data.
         This will return an inner generator.
         """
-        i = 0
-        while i < len(self._timestamps):
-            j = 0
-            lower_bound = ts_daily_left(self._timestamps[i])
-            upper_bound = ts_daily_right(self._timestamps[i])
-            while (i + j < len(self._timestamps) and
-                   lower_bound <= self._timestamps[i + j] <= upper_bound):
-                j += 1
-            yield ((self._timestamps[x], self._values[x])
-                   for x in range(i, i + j))
-            i += j
+        return (iter(w) for _, w in self._windows("daily"))
 
     def hourly(self):
         """Generator to access hourly data.
         This will return an inner generator.
         """
-        i = 0
-        while i < len(self._timestamps):
-            j = 0
-            lower_bound = ts_hourly_left(self._timestamps[i])
-            upper_bound = ts_hourly_right(self._timestamps[i])
-            while (i + j < len(self._timestamps) and
-                   lower_bound <= self._timestamps[i + j] <= upper_bound):
-                j += 1
-            yield ((self._timestamps[x], self._values[x])
-                   for x in range(i, i + j))
-            i += j
-
-    def aggregation(self, group="hourly", function="mean"):
-        """Aggregation Generator.
+        return (iter(w) for _, w in self._windows("hourly"))
+
+    def sketches(self, group="hourly"):
+        """Merged quantile sketch per window.
+
+        Buckets that lie completely inside one window contribute their
+        (stored) sketch, only the values of the remaining buckets are
+        added one by one.
         """
-        if group == "hourly":
-            it = self.hourly
-            left = ts_hourly_left
-        elif group == "daily":
-            it = self.daily
-            left = ts_daily_left
+        step, left, _ = self._parse_group(group)
+        if step:
+            def window_of(ts):
+                return ts - ts % step
         else:
-            raise ValueError("Invalid aggregation group")
-
-        if function == "sum":
-            func = sum
-        elif function == "count":
-            func = len
-        elif function == "min":
-            func = min
-        elif function == "max":
-            func = max
-        elif function == "amp":
-            def amp(x):
-                return max(x) - min(x)
-            func = amp
-        elif function == "mean":
-            def mean(x):
-                return sum(x) / len(x)
-            func = mean
+            window_of = left
+        current = None
+        sketch = None
+        for bucket, start, end in self._segments:
+            ts = bucket._timestamps
+            first = window_of(ts[start])
+            whole = (start == 0 and end == len(bucket) and
+                     first == window_of(ts[end - 1]) and
+                     bucket.sketch.relative_accuracy == Bucket.SKETCH_ACCURACY)
+            if whole:
+                if first != current:
+                    if sketch is not None:
+                        yield (current, sketch)
+                    current = first
+                    sketch = DDSketch(Bucket.SKETCH_ACCURACY)
+                sketch.merge(bucket.sketch)
+                continue
+            for j in range(start, end):
+                w = window_of(ts[j])
+                if w != current:
+                    if sketch is not None:
+                        yield (current, sketch)
+                    current = w
+                    sketch = DDSketch(Bucket.SKETCH_ACCURACY)
+                sketch.add(bucket._values[j])
+        if sketch is not None:
+            yield (current, sketch)
+
+    def _scalar(self):
+        return all(b.item_type in (ItemType.raw_float, ItemType.raw_int)
+                   for b, _, _ in self._segments)
+
+    def aggregation(self, group="hourly", function="mean", window=None,
+                    exact=False):
+        """Aggregation Generator.
+
+        ``group`` is ``hourly``, ``daily``, ``weekly``, ``monthly`` or a
+        step in seconds. With ``window`` (seconds) the windows slide over
+        the data every ``group`` seconds. ``function`` is one of sum,
+        count, min, max, amp, mean, median or a percentile like ``p95``.
+        Percentiles of scalar series are estimated from merged quantile
+        sketches (1% relative error) unless ``exact`` is set.
+        """
+        func = aggregation_function(function)
+        q = parse_percentile(function)
+        if q is not None and window is None and not exact and self._scalar():
+            self._parse_group(group)
+            return ((start, sketch.quantile(q / 100.0))
+                    for start, sketch in self.sketches(group))
+        if window is not None:
+            if not isinstance(group, numbers.Integral):
+                raise ValueError("Sliding windows need a step in seconds")
+            windows = self._sliding(group, window)
         else:
-            raise ValueError("Invalid aggregation group")
+            windows = self._windows(group)
+        return ((start, func([x[1] for x in w])) for start, w in windows)
+
+
+def _lerp(a, b, f):
+    if isinstance(a, tuple):
+        return tuple(x + (y - x) * f for x, y in zip(a, b))
+    return a + (b - a) * f
+
+
+class AlignedFrame(object):
+    """Several series on one shared timestamp axis.
+
+    ``timestamps`` is shared by all series, ``columns`` holds one list of
+    values per key (``None`` where a series has no value).
+    """
+    def __init__(self, keys, timestamps, columns):
+        self.keys = list(keys)
+        self.timestamps = timestamps
+        self.columns = OrderedDict(zip(self.keys, columns))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def rows(self):
+        """Iterate over (ts, value_key1, value_key2, ...) tuples.
+        """
+        return zip(self.timestamps, *self.columns.values())
+
+    @classmethod
+    def align(cls, keys, results, ts_min, ts_max, step=None, fill="none"):
+        """Merge the result sets of several keys on their timestamps.
 
-        for g in it():
-            t = list(g)
-            ts = left(t[0][0])
-            value = func([x[1] for x in t])
-            yield (ts, value)
\ No newline at end of file
+        Without ``step`` the axis is the union of all timestamps. With
+        ``step`` the axis is the grid ``ts_min + n * step`` and every
+        series contributes its last value inside each step. ``fill`` is
+        one of ``none``, ``prev`` or ``linear``.
+        """
+        if fill not in ("none", "prev", "linear"):
+            raise ValueError("Invalid fill method")
+        n = len(results)
+
+        def stream(i, result):
+            for ts, value in result.all():
+                if step:
+                    ts = ts_min + ((ts - ts_min) // step) * step
+                yield (ts, i, value)
+
+        timestamps = array.array("I")
+        columns = [[] for _ in range(n)]
+
+        def add_row(ts, row):
+            timestamps.append(ts)
+            for i, v in enumerate(row):
+                columns[i].append(v)
+
+        grid = ts_min
+        current = None
+        row = None
+        # k-way merge, the result sets stream bucket by bucket
+        for ts, i, value in heapq.merge(*[stream(i, r)
+                                          for i, r in enumerate(results)]):
+            if ts != current:
+                if current is not None:
+                    add_row(current, row)
+                while step and grid < ts:
+                    add_row(grid, [None] * n)
+                    grid += step
+                if step:
+                    grid = ts + step
+                current = ts
+                row = [None] * n
+            row[i] = value
+        if current is not None:
+            add_row(current, row)
+        while step and grid <= ts_max:
+            add_row(grid, [None] * n)
+            grid += step
+
+        for col in columns:
+            if fill == "prev":
+                last = None
+                for j, v in enumerate(col):
+                    if v is None:
+                        col[j] = last
+                    else:
+                        last = v
+            elif fill == "linear":
+                known = [j for j, v in enumerate(col) if v is not None]
+                for a, b in zip(known, known[1:]):
+                    span = float(timestamps[b] - timestamps[a])
+                    for j in range(a + 1, b):
+                        f = (timestamps[j] - timestamps[a]) / span
+                        col[j] = _lerp(col[a], col[b], f)
+        return cls(keys, timestamps, columns)
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import binascii
+import json
+import logging
+
+from redis import StrictRedis as Redis
+from redis.exceptions import WatchError
+
+from ..errors import NotFoundError, ConflictError, InternalError
+from .backend import StorageAPI
+from .models import Bucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class RedisStorage(StorageAPI):
+    SETTINGS = {
+        "REDIS_HOST": "localhost",
+        "REDIS_PORT": 6379,
+        "REDIS_DB": 0,
+    }
+    CONCURRENT_READS = True
+
+    def __init__(self, redis=None, expire=None, **kwargs):
+        if expire is not None:
+            self.expire = expire
+        else:
+            self.expire = False
+        if redis is not None:
+            self.redis = redis
+        else:
+            self.redis = Redis(**kwargs)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(host=settings["REDIS_HOST"], port=settings["REDIS_PORT"],
+                   db=settings["REDIS_DB"])
+
+    def _to_bucket(self, item):
+        d = json.loads(item)
+        bucket = Bucket.from_db_data(d["key"], binascii.unhexlify(d["data"]))
+        bucket._version = d.get("version", 0)
+        if d.get("sketch"):
+            self._load_sketch(bucket, binascii.unhexlify(d["sketch"]))
+        return bucket
+
+    def _from_bucket(self, bucket):
+        item = {"key": bucket.key,
+                "range_key": bucket.stored_range_key,
+                "data": binascii.hexlify(bucket.to_string()),
+                "version": bucket.version + 1}
+        sketch = self._sketch_data(bucket)
+        if sketch:
+            item["sketch"] = binascii.hexlify(sketch)
+        return json.dumps(item)
+
+    def _write(self, key, range_key, item, check):
+        # Optimistic transaction, the key is watched until EXEC
+        with self.redis.pipeline() as p:
+            try:
+                p.watch(key)
+                current = p.zrangebyscore(key, min=range_key, max=range_key,
+                                          start=0, num=1)
+                check(current)
+                p.multi()
+                p.zremrangebyscore(key, min=range_key, max=range_key)
+                if item is not None:
+                    p.zadd(key, range_key, item)
+                if self.expire:
+                    p.expire(key, self.expire)
+                p.execute()
+            except WatchError:
+                raise ConflictError("bucket {} {} was modified"
+                                    .format(key, range_key))
+
+    def _insert(self, key, range_key, item):
+        def check(current):
+            if len(current) > 0:
+                raise ConflictError("bucket {} {} exists"
+                                    .format(key, range_key))
+        self._write(key, range_key, item, check)
+
+    def _insert_many(self, key, items):
+        p = self.redis.pipeline()
+        for range_key, item in items:
+            p.zadd(key, range_key, item)
+        if self.expire:
+            p.expire(key, self.expire)
+        p.execute()
+
+    def _get(self, key, range_key):
+        l = self.redis.zrevrangebyscore(key, min=range_key, max=range_key,
+                                        start=0, num=1)
+        if len(l) < 1:
+            raise NotFoundError
+        return l[0]
+
+    def _get_many(self, pairs):
+        p = self.redis.pipeline(transaction=False)
+        for key, range_key in pairs:
+            p.zrevrangebyscore(key, min=range_key, max=range_key,
+                               start=0, num=1)
+        return [l[0] if len(l) > 0 else None for l in p.execute()]
+
+    def _first(self, key, limit=1):
+        i = self.redis.zrangebyscore(key, min="-inf", max="+inf",
+                                     start=0, num=limit)
+        if len(i) < 1:
+            raise NotFoundError
+        return i[:limit]
+
+    def _last(self, key, limit=1):
+        i = self.redis.zrevrangebyscore(key, min="-inf", max="+inf",
+                                        start=0, num=limit)
+        if len(i) < 1:
+            raise NotFoundError
+        return i[:limit]
+
+    def _left(self, key, range_key, limit=1):
+        i = self.redis.zrevrangebyscore(key, min="-inf", max=range_key,
+                                        start=0, num=limit)
+        if len(i) < 1:
+            raise NotFoundError
+        return i[:limit]
+
+    def _version_check(self, key, range_key, version):
+        def check(current):
+            if len(current) < 1:
+                raise ConflictError("bucket {} {} was removed"
+                                    .format(key, range_key))
+            if json.loads(current[0]).get("version", 0) != version:
+                raise ConflictError("bucket {} {} was modified"
+                                    .format(key, range_key))
+        return check
+
+    def _update(self, key, range_key, item, version):
+        self._write(key, range_key, item,
+                    self._version_check(key, range_key, version))
+
+    def _delete(self, key, range_key, version):
+        self._write(key, range_key, None,
+                    self._version_check(key, range_key, version))
+
+    def _query(self, key, range_min, range_max):
+        items = self.redis.zrangebyscore(key, min=range_min, max=range_max)
+        try:
+            left = self._left(key, range_min)[0]
+        except NotFoundError:
+            return items
+        if len(items) > 0 and left == items[0]:
+            pass
+        else:
+            items.insert(0, left)
+        return items
+
+    def _chunk_key(self, key):
+        # ":" is not allowed in keys so this can not collide with a series
+        return "{}:chunks".format(key)
+
+    def _insert_chunk(self, key, seq, item):
+        p = self.redis.pipeline()
+        p.zadd(self._chunk_key(key), seq, item)
+        if self.expire:
+            p.expire(self._chunk_key(key), self.expire)
+        p.execute()
+
+    def _chunks(self, key):
+        items = self.redis.zrangebyscore(self._chunk_key(key), min="-inf",
+                                         max="+inf", withscores=True)
+        return [(int(score), item) for item, score in items]
+
+    def _delete_chunks(self, key, seqs):
+        p = self.redis.pipeline()
+        for seq in seqs:
+            p.zremrangebyscore(self._chunk_key(key), min=seq, max=seq)
+        p.execute()
+
+    def _delete_range(self, key, range_min, range_max):
+        p = self.redis.pipeline()
+        p.zrangebyscore(key, min=range_min, max=range_max)
+        p.zremrangebyscore(key, min=range_min, max=range_max)
+        items, _ = p.execute()
+        return items
+
+    # One entry per series and a sorted set of the keys for list_keys,
+    # ":" can not occur in keys
+    META_KEY = "stss:meta:{}"
+    KEYS_KEY = "stss:keys"
+    # Optimistic transactions on a meta entry before giving up
+    META_RETRIES = 16
+
+    def _get_meta(self, key):
+        meta = self.redis.get(self.META_KEY.format(key))
+        if meta is None:
+            return None
+        return json.loads(meta)
+
+    def _put_meta(self, key, meta):
+        p = self.redis.pipeline()
+        p.set(self.META_KEY.format(key), json.dumps(meta))
+        p.zadd(self.KEYS_KEY, 0, key)
+        p.execute()
+
+    def _update_meta(self, key, update):
+        # Only writers of the same series conflict on the watched entry
+        meta_key = self.META_KEY.format(key)
+        for _ in range(self.META_RETRIES):
+            with self.redis.pipeline() as p:
+                try:
+                    p.watch(meta_key)
+                    current = p.get(meta_key)
+                    meta = update(None if current is None
+                                  else json.loads(current))
+                    p.multi()
+                    p.set(meta_key, json.dumps(meta))
+                    p.zadd(self.KEYS_KEY, 0, key)
+                    p.execute()
+                except WatchError:
+                    continue
+            return meta
+        raise InternalError("could not update the index of {}".format(key))
+
+    def _list_keys(self, prefix):
+        # Keys are ascii, all keys with the prefix sort below prefix + DEL
+        return [k.decode("utf8") if isinstance(k, bytes) else k
+                for k in self.redis.zrangebylex(self.KEYS_KEY,
+                                                "[" + prefix,
+                                                "(" + prefix + "\x7f")]
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import math
+import struct
+
+from collections import defaultdict
+
+
+class DDSketch(object):
+    """Mergeable quantile sketch with a relative error guarantee.
+
+    Values are counted in logarithmic bins (DDSketch), every quantile is
+    returned with a relative error of at most ``relative_accuracy``.
+    Sketches with the same accuracy can be merged without loss.
+    """
+    HEADER = struct.Struct("<dQQIIdd")
+    BIN = struct.Struct("<iQ")
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = defaultdict(int)
+        self.negative = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def __len__(self):
+        return self.count
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value > self.MIN_VALUE:
+            self.positive[self._key(value)] += count
+        elif value < -self.MIN_VALUE:
+            self.negative[self._key(-value)] += count
+        else:
+            self.zero_count += count
+        self.count += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def extend(self, values):
+        for v in values:
+            self.add(v)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("can not merge sketches with different accuracy")
+        for k, c in other.positive.items():
+            self.positive[k] += c
+        for k, c in other.negative.items():
+            self.negative[k] += c
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Value at quantile ``q`` (0 - 1).
+        """
+        if self.count < 1:
+            return None
+        if not 0 <= q <= 1:
+            raise ValueError("quantile must be between 0 and 1")
+        rank = q * (self.count - 1)
+        cumulative = 0
+        # Lowest values first: large negative, zero, small positive
+        for k in sorted(self.negative, reverse=True):
+            cumulative += self.negative[k]
+            if cumulative > rank:
+                return max(-self._value(k), self.min)
+        cumulative += self.zero_count
+        if cumulative > rank:
+            return 0.0
+        for k in sorted(self.positive):
+            cumulative += self.positive[k]
+            if cumulative > rank:
+                return min(self._value(k), self.max)
+        return self.max
+
+    def to_string(self):
+        out = [self.HEADER.pack(self.relative_accuracy, self.count,
+                                self.zero_count, len(self.positive),
+                                len(self.negative), self.min, self.max)]
+        for bins in (self.positive, self.negative):
+            for k in sorted(bins):
+                out.append(self.BIN.pack(k, bins[k]))
+        return b"".join(out)
+
+    @classmethod
+    def from_string(cls, string):
+        (accuracy, count, zero_count, n_pos, n_neg,
+         min_value, max_value) = cls.HEADER.unpack_from(string, 0)
+        sketch = cls(accuracy)
+        sketch.count = count
+        sketch.zero_count = zero_count
+        sketch.min = min_value
+        sketch.max = max_value
+        offset = cls.HEADER.size
+        for bins, n in ((sketch.positive, n_pos), (sketch.negative, n_neg)):
+            for _ in range(n):
+                k, c = cls.BIN.unpack_from(string, offset)
+                bins[k] = c
+                offset += cls.BIN.size
+        return sketch
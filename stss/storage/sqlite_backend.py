@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# coding: utf8
+
+from __future__ import unicode_literals
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from ..errors import NotFoundError, ConflictError
+from .backend import StorageAPI
+from .models import Bucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(StorageAPI):
+    """Single file storage in SQLite.
+
+    Buckets are rows clustered by their (key, range_key) primary key with
+    the bucket data as a BLOB. The database runs in WAL mode, so readers
+    in other threads and processes do not block the writer.
+    """
+    SETTINGS = {
+        "SQLITE_PATH": "./stss.db",
+        "SQLITE_SYNCHRONOUS": "NORMAL",
+    }
+    # Every thread uses its own connection
+    CONCURRENT_READS = True
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS buckets ("
+        "key TEXT NOT NULL, range_key INTEGER NOT NULL, "
+        "version INTEGER NOT NULL, data BLOB NOT NULL, sketch BLOB, "
+        "PRIMARY KEY (key, range_key)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS chunks ("
+        "key TEXT NOT NULL, range_key INTEGER NOT NULL, "
+        "version INTEGER NOT NULL, data BLOB NOT NULL, sketch BLOB, "
+        "PRIMARY KEY (key, range_key)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS meta ("
+        "key TEXT NOT NULL PRIMARY KEY, meta TEXT NOT NULL) WITHOUT ROWID",
+    ]
+    # Constant statements so the connections reuse the prepared statements
+    COLUMNS = "key, range_key, version, data, sketch"
+    SELECT = "SELECT " + COLUMNS + " FROM buckets WHERE key = ? "
+    INSERT = "INSERT INTO {} (" + COLUMNS + ") VALUES (?, ?, ?, ?, ?)"
+
+    def __init__(self, path, synchronous="NORMAL"):
+        self.path = os.path.realpath(path)
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.synchronous = synchronous
+        self._local = threading.local()
+        with self._transaction() as c:
+            for statement in self.SCHEMA:
+                c.execute(statement)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings["SQLITE_PATH"],
+                   synchronous=settings["SQLITE_SYNCHRONOUS"])
+
+    @property
+    def connection(self):
+        c = getattr(self._local, "connection", None)
+        if c is None:
+            # Autocommit, write transactions are started explicitly
+            c = sqlite3.connect(self.path, timeout=30,
+                                isolation_level=None, cached_statements=64)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous={}".format(self.synchronous))
+            self._local.connection = c
+        return c
+
+    @contextmanager
+    def _transaction(self):
+        c = self.connection
+        # Take the write lock up front instead of upgrading a read lock
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        else:
+            c.execute("COMMIT")
+
+    def _to_bucket(self, item):
+        bucket = Bucket.from_db_data(item[0], bytes(item[3]))
+        bucket._version = item[2]
+        if item[4]:
+            self._load_sketch(bucket, bytes(item[4]))
+        return bucket
+
+    def _from_bucket(self, bucket):
+        sketch = self._sketch_data(bucket)
+        return {"data": sqlite3.Binary(bucket.to_string()),
+                "version": bucket.version + 1,
+                "sketch": sqlite3.Binary(sketch) if sketch else None}
+
+    def _row(self, key, range_key, item):
+        return (key, range_key, item["version"], item["data"],
+                item["sketch"])
+
+    def _insert(self, key, range_key, item):
+        try:
+            self.connection.execute(self.INSERT.format("buckets"),
+                                    self._row(key, range_key, item))
+        except sqlite3.IntegrityError:
+            raise ConflictError("bucket {} {} exists".format(key, range_key))
+
+    def _insert_many(self, key, items):
+        # One transaction, a single commit for all buckets
+        try:
+            with self._transaction() as c:
+                c.executemany(self.INSERT.format("buckets"),
+                              [self._row(key, range_key, item)
+                               for range_key, item in items])
+        except sqlite3.IntegrityError:
+            raise ConflictError("bucket of {} exists".format(key))
+
+    def _version_conflict(self, key, range_key):
+        if self.connection.execute(
+                "SELECT 1 FROM buckets WHERE key = ? AND range_key = ?",
+                (key, range_key)).fetchone() is None:
+            return ConflictError("bucket {} {} was removed"
+                                 .format(key, range_key))
+        return ConflictError("bucket {} {} was modified"
+                             .format(key, range_key))
+
+    def _update(self, key, range_key, item, version):
+        cursor = self.connection.execute(
+            "UPDATE buckets SET version = ?, data = ?, sketch = ? "
+            "WHERE key = ? AND range_key = ? AND version = ?",
+            (item["version"], item["data"], item["sketch"],
+             key, range_key, version))
+        if cursor.rowcount < 1:
+            raise self._version_conflict(key, range_key)
+
+    def _delete(self, key, range_key, version):
+        cursor = self.connection.execute(
+            "DELETE FROM buckets "
+            "WHERE key = ? AND range_key = ? AND version = ?",
+            (key, range_key, version))
+        if cursor.rowcount < 1:
+            raise self._version_conflict(key, range_key)
+
+    def _get(self, key, range_key):
+        item = self.connection.execute(self.SELECT + "AND range_key = ?",
+                                       (key, range_key)).fetchone()
+        if item is None:
+            raise NotFoundError
+        return item
+
+    def _get_many(self, pairs):
+        c = self.connection
+        return [c.execute(self.SELECT + "AND range_key = ?",
+                          (key, range_key)).fetchone()
+                for key, range_key in pairs]
+
+    def _first(self, key, limit=1):
+        items = self.connection.execute(
+            self.SELECT + "ORDER BY range_key LIMIT ?",
+            (key, limit)).fetchall()
+        if len(items) < 1:
+            raise NotFoundError
+        return items
+
+    def _last(self, key, limit=1):
+        items = self.connection.execute(
+            self.SELECT + "ORDER BY range_key DESC LIMIT ?",
+            (key, limit)).fetchall()
+        if len(items) < 1:
+            raise NotFoundError
+        return items
+
+    def _left(self, key, range_key, limit=1):
+        items = self.connection.execute(
+            self.SELECT + "AND range_key <= ? ORDER BY range_key DESC LIMIT ?",
+            (key, range_key, limit)).fetchall()
+        if len(items) < 1:
+            raise NotFoundError
+        return items
+
+    def _query(self, key, range_min, range_max):
+        # The range including the bucket left of range_min in one scan
+        return self.connection.execute(
+            self.SELECT + "AND range_key >= "
+            "(SELECT COALESCE(MAX(range_key), ?) "
+            "FROM buckets WHERE key = ? AND range_key <= ?) "
+            "AND range_key <= ? ORDER BY range_key",
+            (key, range_min, key, range_min, range_max)).fetchall()
+
+    def _insert_chunk(self, key, seq, item):
+        self.connection.execute(self.INSERT.format("chunks"),
+                                self._row(key, seq, item))
+
+    def _chunks(self, key):
+        items = self.connection.execute(
+            "SELECT " + self.COLUMNS + " FROM chunks WHERE key = ? "
+            "ORDER BY range_key", (key,)).fetchall()
+        return [(i[1], i) for i in items]
+
+    def _delete_chunks(self, key, seqs):
+        with self._transaction() as c:
+            c.executemany("DELETE FROM chunks WHERE key = ? AND range_key = ?",
+                          [(key, seq) for seq in seqs])
+
+    def _delete_range(self, key, range_min, range_max):
+        with self._transaction() as c:
+            items = c.execute(
+                self.SELECT + "AND range_key >= ? AND range_key <= ? "
+                "ORDER BY range_key", (key, range_min, range_max)).fetchall()
+            c.execute("DELETE FROM buckets "
+                      "WHERE key = ? AND range_key >= ? AND range_key <= ?",
+                      (key, range_min, range_max))
+        return items
+
+    def _get_meta(self, key):
+        item = self.connection.execute(
+            "SELECT meta FROM meta WHERE key = ?", (key,)).fetchone()
+        if item is None:
+            return None
+        return json.loads(item[0])
+
+    def _put_meta(self, key, meta):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, meta) VALUES (?, ?)",
+            (key, json.dumps(meta)))
+
+    def _update_meta(self, key, update):
+        # Read and write under the write lock
+        with self._transaction() as c:
+            item = c.execute("SELECT meta FROM meta WHERE key = ?",
+                             (key,)).fetchone()
+            meta = update(None if item is None else json.loads(item[0]))
+            c.execute("INSERT OR REPLACE INTO meta (key, meta) VALUES (?, ?)",
+                      (key, json.dumps(meta)))
+        return meta
+
+    def _list_keys(self, prefix):
+        # Range scan on the primary key, keys are plain ascii
+        items = self.connection.execute(
+            "SELECT key FROM meta WHERE key >= ? AND key < ?",
+            (prefix, prefix + "\uffff")).fetchall()
+        return [i[0] for i in items]
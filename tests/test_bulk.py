@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# coding: utf8
+
+import unittest
+import shutil
+import tempfile
+import logging
+import io
+
+from stss.storage import TSDB
+from stss.storage.models import ItemType
+from stss.storage.bulk import BulkLoader, read_binary, write_binary
+from stss.storage.bulk import read_csv
+
+
+class BulkTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def tsdb(self, **settings):
+        """TSDB with file storage in the temporary folder of the test.
+        """
+        return TSDB(FILE_STORAGE_FOLDER=self.folder, **settings)
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.INFO)
+
+    def test_binary_format(self):
+        f = io.BytesIO()
+        write_binary(f, [(1, 1.5), (2, 2.5)])
+        write_binary(f, [(3, (1.0, 2.0))], ItemType.tuple_float_2)
+        f.seek(0)
+        self.assertEqual(list(read_binary(f)),
+                         [(1, 1.5), (2, 2.5), (3, (1.0, 2.0))])
+
+    def test_csv_format(self):
+        f = io.StringIO(u"ts,value\n10,1.5\n20,2\n30,1,2\n")
+        self.assertEqual(list(read_csv(f)),
+                         [(10, 1.5), (20, 2.0), (30, (1.0, 2.0))])
+
+    def test_load_dump(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        day = 24 * 60 * 60
+        points = [(i * 600, float(i % 7)) for i in range(3 * 144)]
+        f = io.BytesIO()
+        write_binary(f, reversed(points))
+        f.seek(0)
+
+        # Small chunks to sort on disk
+        loader = BulkLoader(d, chunk_points=100, batch_buckets=2)
+        stats = loader.load("bulk.a", f)
+        self.assertTrue(stats["direct"])
+        self.assertEqual(stats["runs"], 5)
+        self.assertEqual(stats["buckets"], 3)
+        self.assertEqual(stats["count"], len(points))
+        res = d.query("bulk.a", 0, 3 * day)
+        self.assertEqual(list(res.all()), points)
+        self.assertEqual(d.describe("bulk.a")["count"], len(points))
+
+        # Overlapping data goes through the merge path
+        f = io.StringIO(u"%d,9.0\n%d,8.0\n" % (day + 1, 5 * day))
+        stats = loader.load("bulk.a", f, fmt="csv")
+        self.assertFalse(stats["direct"])
+        self.assertEqual(len(d.query("bulk.a", 0, 6 * day)),
+                         len(points) + 2)
+
+        out = io.BytesIO()
+        self.assertEqual(loader.dump("bulk.a", out, 0, day - 1), 144)
+        out.seek(0)
+        self.assertEqual(list(read_binary(out)), points[:144])
+
+
+    def test_duplicates(self):
+        d = self.tsdb()
+        # The first value of a timestamp wins, also across sorted runs
+        f = io.StringIO(u"20,9.0\n10,1.0\n20,2.0\n10,5.0\n30,3.0\n")
+        loader = BulkLoader(d, chunk_points=2)
+        stats = loader.load("bulk.b", f, fmt="csv")
+        self.assertEqual(stats["runs"], 3)
+        self.assertEqual(stats["count"], 3)
+        self.assertEqual(list(d.query("bulk.b", 0, 100).all()),
+                         [(10, 1.0), (20, 9.0), (30, 3.0)])
+
+    def test_load_checks(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        loader = BulkLoader(d)
+        with self.assertRaises(ValueError):
+            loader.load("../evil", io.StringIO(u"10,1.0\n"), fmt="csv")
+
+        # Rows with several values are loaded as tuples
+        f = io.StringIO(u"10,1,2,3\n20,4,5,6\n")
+        stats = loader.load("bulk.axes", f, fmt="csv")
+        self.assertTrue(stats["direct"])
+        res = d.query("bulk.axes", 0, 100)
+        self.assertEqual(list(res.all()),
+                         [(10, (1.0, 2.0, 3.0)), (20, (4.0, 5.0, 6.0))])
+        self.assertEqual(res._segments[0][0].item_type,
+                         ItemType.tuple_float_3)
+
+        # The insert path only creates scalar buckets
+        with self.assertRaises(ValueError):
+            loader.load("bulk.axes", io.StringIO(u"15,1,2,3\n"), fmt="csv")
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# coding: utf8
+
+import unittest
+import shutil
+import tempfile
+import logging
+
+from stss.storage import TSDB
+from stss.storage.models import Bucket
+from stss.storage.compaction import Compactor
+
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def tsdb(self, **settings):
+        """TSDB with file storage in the temporary folder of the test.
+        """
+        return TSDB(FILE_STORAGE_FOLDER=self.folder, **settings)
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.INFO)
+
+    def test_merge_undersized(self):
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=4,
+                      BUCKET_DYNAMIC_MAX=8)
+        for i in range(6):
+            d.storage.insert(Bucket.new("frag", [(i * 2, float(i))]))
+        self.assertEqual(len(d.storage.query("frag", 0, 100)), 6)
+
+        c = Compactor(d)
+        stats = c.compact_key("frag")
+        self.assertEqual(stats["buckets_before"], 6)
+        self.assertEqual(stats["buckets_after"], 2)
+        self.assertEqual(stats["merged"], 4)
+        self.assertGreater(stats["bytes_reclaimed"], 0)
+
+        buckets = d.storage.query("frag", 0, 100)
+        self.assertEqual([len(b) for b in buckets], [4, 2])
+        res = d._query("frag", 0, 100)
+        self.assertEqual(len(res), 6)
+
+        # Nothing left to do
+        stats = c.compact_key("frag")
+        self.assertEqual(stats["writes"], 0)
+
+    def test_split_oversized(self):
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=4,
+                      BUCKET_DYNAMIC_MAX=8)
+        d.storage.insert(Bucket.new("big", [(i, float(i)) for i in range(10)]))
+
+        c = Compactor(d, max_writes_per_second=1000)
+        stats = c.compact(["big"])
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["splits"], 1)
+        buckets = d.storage.query("big", 0, 100)
+        self.assertEqual([len(b) for b in buckets], [4, 4, 2])
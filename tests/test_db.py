@@ -2,20 +2,32 @@
 # coding: utf8
 
 import unittest
+import shutil
+import tempfile
 import random
 import logging
 import os
+import array
+import struct
+import time
+import threading
 
 
 from stss.storage import TSDB
+from stss.errors import ConflictError, NotFoundError
 
 
 class DatabaseTest(unittest.TestCase):
     def setUp(self):
-        pass
+        self.folder = tempfile.mkdtemp()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.folder)
+
+    def tsdb(self, **settings):
+        """TSDB with file storage in the temporary folder of the test.
+        """
+        return TSDB(FILE_STORAGE_FOLDER=self.folder, **settings)
 
     @classmethod
     def tearDownClass(cls):
@@ -143,11 +155,396 @@ class DatabaseTest(unittest.TestCase):
 
     def test_invalidmetricname(self):
         with self.assertRaises(ValueError):
-            d = TSDB()
+            d = self.tsdb()
             d._insert("hüü", [(1, 1.1)])
 
+    def test_conflict_retry(self):
+        d = self.tsdb(BUCKET_TYPE="daily", INSERT_RETRIES=2)
+        d._insert("retry", [(1, 1.0)])
+
+        update = d.storage.update
+        calls = []
+
+        def conflicting_update(bucket):
+            calls.append(bucket)
+            if len(calls) == 1:
+                raise ConflictError
+            return update(bucket)
+
+        d.storage.update = conflicting_update
+        stats = d._insert("retry", [(2, 2.0)])
+        self.assertEqual(stats["retries"], 1)
+        self.assertEqual(len(calls), 2)
+        res = d._query("retry", 0, 10)
+        self.assertEqual(len(res), 2)
+
+        def always_conflicting(bucket):
+            raise ConflictError
+
+        d.storage.update = always_conflicting
+        with self.assertRaises(ConflictError):
+            d._insert("retry", [(3, 3.0)])
+
+    def test_read_consistency(self):
+        d = self.tsdb(BUCKET_TYPE="daily", SETTLED_HORIZON=3600)
+        query = d.storage.query
+        calls = []
+
+        def recording_query(key, range_min, range_max, consistent=True):
+            calls.append(consistent)
+            return query(key, range_min, range_max, consistent=consistent)
+
+        d.storage.query = recording_query
+        now = int(time.time())
+        d._insert("consistency", [(100, 1.0), (now, 2.0)])
+        # The merge path reads consistently
+        del calls[:]
+        d._insert("consistency", [(200, 1.5)])
+        self.assertEqual(calls, [True])
+
+        del calls[:]
+        self.assertEqual(len(d.query("consistency", 0, 1000)), 2)
+        self.assertEqual(len(d.query("consistency", 0, now + 10)), 3)
+        d.query("consistency", 0, 1000, consistent=True)
+        d.aggregate("consistency", now - 10, now + 10, consistent=False)
+        self.assertEqual(calls, [False, True, True, False])
+
+        d.settings["CONSISTENT_QUERIES"] = False
+        del calls[:]
+        d.query("consistency", 0, now + 10)
+        self.assertEqual(calls, [False])
+
+    def test_append_chunks(self):
+        d = self.tsdb(BUCKET_TYPE="daily", APPEND_CHUNKS=True)
+        stats = d._insert("chunked", [(0, 1.0), (600, 2.0)])
+        self.assertEqual(stats["chunks"], 0)
+
+        # Behind the known end, blind writes
+        stats = d._insert("chunked", [(1200, 3.0)])
+        self.assertEqual(stats["chunks"], 1)
+        stats = d._insert("chunked", [(1800, 4.0), (2400, 5.0)])
+        self.assertEqual(stats["chunks"], 1)
+        self.assertEqual(len(d.storage.chunks("chunked")), 2)
+        self.assertEqual(len(d.storage.last("chunked")), 2)
+
+        # Out of order data folds the chunks first
+        stats = d._insert("chunked", [(300, 1.5)])
+        self.assertEqual(stats["chunks"], 0)
+        self.assertEqual(len(d.storage.chunks("chunked")), 0)
+        self.assertEqual(len(d.storage.last("chunked")), 6)
+
+        # Reading folds as well
+        d._insert("chunked", [(3000, 6.0)])
+        self.assertEqual(len(d.storage.chunks("chunked")), 1)
+        res = d._query("chunked", 0, 3000)
+        self.assertEqual(len(res), 7)
+        self.assertEqual(len(d.storage.chunks("chunked")), 0)
+
+    def test_query_aligned(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        d._insert("aligned.a", [(0, 1.0), (10, 2.0), (30, 4.0)])
+        d._insert("aligned.b", [(5, 10.0), (10, 20.0), (35, 50.0)])
+
+        f = d.query_aligned(["aligned.a", "aligned.b"], 0, 40)
+        self.assertEqual(list(f.timestamps), [0, 5, 10, 30, 35])
+        self.assertEqual(f["aligned.a"], [1.0, None, 2.0, 4.0, None])
+        self.assertEqual(f["aligned.b"], [None, 10.0, 20.0, None, 50.0])
+
+        f = d.query_aligned(["aligned.a", "aligned.b"], 0, 40, step=10,
+                            fill="prev")
+        self.assertEqual(list(f.timestamps), [0, 10, 20, 30, 40])
+        self.assertEqual(f["aligned.a"], [1.0, 2.0, 2.0, 4.0, 4.0])
+        self.assertEqual(f["aligned.b"], [10.0, 20.0, 20.0, 50.0, 50.0])
+
+        f = d.query_aligned(["aligned.a", "aligned.b"], 0, 40, step=10,
+                            fill="linear")
+        self.assertEqual(f["aligned.a"], [1.0, 2.0, 3.0, 4.0, None])
+        self.assertEqual(list(f.rows())[2], (20, 3.0, 35.0))
+
+        with self.assertRaises(ValueError):
+            d.query_aligned(["aligned.a"], 0, 40, fill="next")
+
+    def test_query_cache(self):
+        d = self.tsdb(BUCKET_TYPE="daily", ENABLE_CACHING=True)
+        day = 24 * 60 * 60
+        d._insert("cached", [(i * 600, 1.0) for i in range(3 * 144)])
+
+        r1 = d.aggregate("cached", 0, day - 1, "hourly", "sum")
+        r2 = d.aggregate("cached", 2 * day, 3 * day - 1, "hourly", "sum")
+        self.assertEqual(len(r1), 24)
+        self.assertEqual(d.aggregate("cached", 0, day - 1, "hourly", "sum"),
+                         r1)
+        s = d.cache_stats()
+        self.assertEqual(s["hits"], 1)
+        self.assertEqual(s["misses"], 2)
+        self.assertEqual(s["entries"], 2)
+
+        # Writing the last day only invalidates the live window
+        d._insert("cached", [(2 * day + 1, 5.0)])
+        self.assertEqual(d.aggregate("cached", 0, day - 1, "hourly", "sum"),
+                         r1)
+        r3 = d.aggregate("cached", 2 * day, 3 * day - 1, "hourly", "sum")
+        self.assertEqual(r3[0][1], r2[0][1] + 5.0)
+        s = d.cache_stats()
+        self.assertEqual(s["hits"], 2)
+        self.assertEqual(s["invalidations"], 1)
+        self.assertAlmostEqual(s["hit_ratio"], 0.4)
+
+        self.assertIsNone(self.tsdb().cache_stats())
+
+    def test_query_cache_live(self):
+        d = self.tsdb(BUCKET_TYPE="daily", ENABLE_CACHING=True,
+                      CACHE_LIVE_TTL=0.2)
+        now = int(time.time())
+        d._insert("live", [(now - 60, 1.0)])
+        r1 = d.aggregate("live", now - 3600, now + 3600, "hourly", "sum")
+        self.assertEqual(d.aggregate("live", now - 3600, now + 3600,
+                                     "hourly", "sum"), r1)
+
+        # A write of another process does not invalidate this cache
+        other = self.tsdb(BUCKET_TYPE="daily")
+        other._insert("live", [(now - 30, 2.0)])
+        self.assertEqual(d.aggregate("live", now - 3600, now + 3600,
+                                     "hourly", "sum"), r1)
+        time.sleep(0.3)
+        r2 = d.aggregate("live", now - 3600, now + 3600, "hourly", "sum")
+        self.assertEqual(sum(v for _, v in r2), 3.0)
+        self.assertEqual(d.cache_stats()["hits"], 2)
+
+    def test_index(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        day = 24 * 60 * 60
+        d._insert("indexed.a", [(0, 1.0), (600, 2.0)])
+        d._insert("indexed.a", [(day + 10, 3.0)])
+        d._insert("indexed.b", [(300, 1.0)])
+
+        self.assertEqual(d.list_keys("indexed."), ["indexed.a", "indexed.b"])
+        self.assertIn("indexed.a", d.list_keys())
+        m = d.describe("indexed.a")
+        self.assertEqual(m["buckets"], 2)
+        self.assertEqual(m["count"], 3)
+        self.assertEqual(m["ts_min"], 0)
+        self.assertEqual(m["ts_max"], day + 10)
+        self.assertEqual(m["bucket_type"], "daily")
+        self.assertEqual(m["item_type"], "raw_float")
+        self.assertGreater(m["bytes"], 0)
+
+        # Duplicates do not change the index
+        d._insert("indexed.a", [(600, 2.0)])
+        self.assertEqual(d.describe("indexed.a")["count"], 3)
+
+        with self.assertRaises(NotFoundError):
+            d.describe("indexed.c")
+
+    def test_index_conflicts(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        day = 24 * 60 * 60
+        d._insert("meta.retry", [(0, 1.0), (day, 1.0)])
+
+        update = d.storage.update
+        calls = []
+
+        def conflict_on_second(bucket):
+            calls.append(bucket)
+            if len(calls) == 2:
+                raise ConflictError
+            return update(bucket)
+
+        # The first bucket is written before the conflict, the retry
+        # writes the second one
+        d.storage.update = conflict_on_second
+        stats = d._insert("meta.retry", [(1, 2.0), (day + 1, 2.0)])
+        self.assertEqual(stats["retries"], 1)
+        self.assertEqual(d.describe("meta.retry")["count"], 4)
+
+        # Writers in other instances do not lose index updates
+        writers = [self.tsdb(BUCKET_TYPE="daily") for _ in range(4)]
+
+        def write(n):
+            for j in range(10):
+                writers[n]._insert("meta.shared", [(n * day + j, 1.0)])
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        m = d.describe("meta.shared")
+        self.assertEqual(m["count"], 40)
+        self.assertEqual(m["buckets"], 4)
+        self.assertEqual(m["ts_max"], 3 * day + 9)
+
+    def test_query_pattern(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        d._insert("fleet.m1.temp", [(0, 1.0), (10, 3.0), (3600, 5.0)])
+        d._insert("fleet.m2.temp", [(5, 10.0), (3605, 20.0)])
+        d._insert("fleet.m2.rpm", [(5, 100.0)])
+        d._insert("fleet.m2.temp.raw", [(5, 100.0)])
+
+        self.assertEqual(d.resolve_pattern("fleet.*.temp"),
+                         ["fleet.m1.temp", "fleet.m2.temp"])
+        self.assertEqual(len(d.resolve_pattern("fleet.**")), 4)
+        self.assertEqual(d.resolve_pattern("fleet.m?.rpm"), ["fleet.m2.rpm"])
+
+        res = d.query_pattern("fleet.*.temp", 0, 7200)
+        self.assertEqual(sorted(res), ["fleet.m1.temp", "fleet.m2.temp"])
+        self.assertEqual(len(res["fleet.m1.temp"]), 3)
+
+        res = d.query_pattern("fleet.*.temp", 0, 7200, aggregation="mean")
+        self.assertEqual(res["fleet.m1.temp"], [(0, 2.0), (3600, 5.0)])
+
+        res = d.query_pattern("fleet.*.temp", 0, 7200, aggregation="mean",
+                              reduce="sum")
+        self.assertEqual(res, [(0, 12.0), (3600, 25.0)])
+        res = d.query_pattern("fleet.*.temp", 0, 7200, aggregation="max",
+                              reduce="max")
+        self.assertEqual(res, [(0, 10.0), (3600, 20.0)])
+
+        with self.assertRaises(ValueError):
+            d.query_pattern("fleet.*.temp", 0, 7200, reduce="sum")
+        with self.assertRaises(ValueError):
+            d.resolve_pattern("fleet/*")
+
+    def test_delete_range(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        day = 24 * 60 * 60
+        d._insert("deleted", [(i * 3600, float(i)) for i in range(5 * 24)])
+        self.assertEqual(d.describe("deleted")["buckets"], 5)
+
+        # Trims day 0 and day 3, drops day 1 and 2
+        stats = d.delete_range("deleted", 12 * 3600, 3 * day + 5 * 3600)
+        self.assertEqual(stats["deleted"], 2)
+        self.assertEqual(stats["trimmed"], 2)
+        self.assertEqual(stats["removed"], 12 + 48 + 6)
+        res = d._query("deleted", 0, 5 * day)
+        self.assertEqual(len(res), 5 * 24 - 66)
+        self.assertEqual(res[11][0], 11 * 3600)
+        self.assertEqual(res[12][0], 3 * day + 6 * 3600)
+        m = d.describe("deleted")
+        self.assertEqual(m["buckets"], 3)
+        self.assertEqual(m["count"], 5 * 24 - 66)
+
+        # Inside one bucket
+        stats = d.delete_range("deleted", 4 * day + 3600, 4 * day + 7200)
+        self.assertEqual(stats["removed"], 2)
+        self.assertEqual(stats["deleted"], 0)
+        self.assertEqual(len(d._query("deleted", 4 * day, 5 * day)), 22)
+
+        # Nothing left in range
+        stats = d.delete_range("deleted", day, 2 * day)
+        self.assertEqual(stats["removed"], 0)
+
+    def test_delete_range_empty_edge(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        d._insert("emptied", [(36000, 1.0), (40000, 2.0), (90000, 3.0)])
+
+        # Trimming removes all points of the left edge bucket
+        stats = d.delete_range("emptied", 30000, 50000)
+        self.assertEqual(stats["removed"], 2)
+        self.assertEqual(stats["trimmed"], 1)
+        self.assertEqual(list(d._query("emptied", 0, 100000).all()),
+                         [(90000, 3.0)])
+        m = d.describe("emptied")
+        self.assertEqual(m["buckets"], 1)
+        self.assertEqual(m["count"], 1)
+
+    def test_delete_range_dynamic(self):
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=3,
+                      BUCKET_DYNAMIC_MAX=5)
+        d._insert("dyn", [(i, float(i)) for i in range(10)])
+        buckets = d.describe("dyn")["buckets"]
+        self.assertGreater(buckets, 2)
+
+        # The right edge loses its first points and moves
+        stats = d.delete_range("dyn", 2, 7)
+        self.assertEqual(stats["removed"], 6)
+        self.assertEqual(list(d._query("dyn", 0, 10).all()),
+                         [(0, 0.0), (1, 1.0), (8, 8.0), (9, 9.0)])
+        m = d.describe("dyn")
+        self.assertEqual(m["count"], 4)
+        self.assertEqual(m["ts_min"], 0)
+        self.assertEqual(m["ts_max"], 9)
+        self.assertEqual([b.range_key for b in d.storage.query("dyn", 0, 10)],
+                         [b.ts_min for b in d.storage.query("dyn", 0, 10)])
+
+    def test_retention(self):
+        day = 24 * 60 * 60
+        d = self.tsdb(BUCKET_TYPE="daily",
+                      RETENTION={"retained.*": 2 * day,
+                                 "retained.short": day})
+        for key in ("retained.long", "retained.short", "kept"):
+            d._insert(key, [(i * 3600, 1.0) for i in range(4 * 24)])
+        self.assertEqual(d.retention("retained.long"), 2 * day)
+        self.assertEqual(d.retention("retained.short"), day)
+        self.assertIsNone(d.retention("kept"))
+
+        stats = d.apply_retention(now=4 * day)
+        self.assertEqual(sorted(s["key"] for s in stats),
+                         ["retained.long", "retained.short"])
+        self.assertEqual(d.describe("retained.long")["ts_min"], 2 * day)
+        self.assertEqual(d.describe("retained.short")["ts_min"], 3 * day)
+        self.assertEqual(d.describe("kept")["ts_min"], 0)
+
+    def test_insert_columnar(self):
+        d = self.tsdb(BUCKET_TYPE="daily")
+        stats = d._insert("columnar", (array.array("I", [0, 10, 20]),
+                                       array.array("f", [1.0, 2.0, 3.0])))
+        self.assertEqual(stats["appended"], 3)
+        packed = b"".join(struct.pack("=If", ts, float(ts))
+                          for ts in (15, 5, 30))
+        stats = d._insert("columnar", packed)
+        self.assertEqual(stats["count"], 3)
+        res = d._query("columnar", 0, 30)
+        self.assertEqual(list(res.timestamps), [0, 5, 10, 15, 20, 30])
+        self.assertEqual(res[1], (5, 5.0))
+
+        # Native float arrays on the append and the merge path
+        d._insert("columnar", (array.array("I", [40, 50]),
+                               array.array("d", [4.0, 5.0])))
+        d._insert("columnar", (array.array("I", [25, 35]),
+                               array.array("d", [2.5, 3.5])))
+        packed = struct.pack("=IfIf", 60, 6.0, 70, 7.0)
+        d._insert("columnar", memoryview(packed))
+        res = d._query("columnar", 0, 70)
+        self.assertEqual(list(res.timestamps),
+                         [0, 5, 10, 15, 20, 25, 30, 35, 40, 50, 60, 70])
+        self.assertEqual(res[8], (40, 4.0))
+        self.assertEqual(res[11], (70, 7.0))
+
+        with self.assertRaises(ValueError):
+            d._insert("columnar", ([1, 2], [1.0]))
+        with self.assertRaises(ValueError):
+            d._insert("columnar", ((40, 1.0), (50, 2.0)))
+        with self.assertRaises(ValueError):
+            d._insert("columnar", b"123")
+        with self.assertRaises(ValueError):
+            d._insert("columnar", [])
+
+    def test_merge_partitioned(self):
+        day = 24 * 60 * 60
+        d = self.tsdb(BUCKET_TYPE="daily")
+        d._insert("late.daily", [(3 * day + 5, 1.0), (5 * day, 2.0)])
+        # In front of the first bucket, into a gap and into a bucket
+        stats = d._insert("late.daily", [(10, 1.0), (day + 1, 1.0),
+                                         (4 * day, 1.0), (5 * day + 1, 1.0)])
+        self.assertEqual(stats["inserted"], 4)
+        self.assertEqual(stats["merged"], 1)
+        buckets = d.storage.query("late.daily", 0, 6 * day)
+        self.assertEqual([b.range_key for b in buckets],
+                         [0, day, 3 * day, 4 * day, 5 * day])
+        self.assertEqual(len(d._query("late.daily", 0, 6 * day)), 6)
+
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=4,
+                      BUCKET_DYNAMIC_MAX=8)
+        d._insert("late.dynamic", [(100 + i, 1.0) for i in range(4)])
+        stats = d._insert("late.dynamic", [(i, 1.0) for i in range(6)] +
+                          [(102, 2.0), (103, 2.0)])
+        self.assertEqual(stats["inserted"], 6)
+        buckets = d.storage.query("late.dynamic", 0, 200)
+        self.assertEqual([len(b) for b in buckets], [6, 4])
+
     def test_merge(self):
-        d = TSDB(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=2, BUCKET_DYNAMIC_MAX=2)
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=2, BUCKET_DYNAMIC_MAX=2)
         d._insert("merge", [(1, 2.0), (2, 3.0), (5, 6.0), (6, 7.0),
                             (9, 10.0), (0, 1.0)])
         res = d._query("merge", 0, 10)
@@ -164,7 +561,7 @@ class DatabaseTest(unittest.TestCase):
             self.assertAlmostEqual(float(ts + 1.0), v)
 
     def test_dynamic(self):
-        d = TSDB(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=3, BUCKET_DYNAMIC_MAX=3)
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=3, BUCKET_DYNAMIC_MAX=3)
         d._insert("hi", [(1, 1.1), (2, 2.2)])
         d._insert("hi", [(4, 4.4)])
         i = d.storage.last("hi")
@@ -187,7 +584,7 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(i2[0][0], 4)
 
     def test_hourly(self):
-        d = TSDB(BUCKET_TYPE="hourly")
+        d = self.tsdb(BUCKET_TYPE="hourly")
         for i in range(0, 70):
             d._insert("his", [(i * 60, 1.1)])
 
@@ -204,7 +601,7 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(i2[9][0], 69*60)
 
     def test_daily(self):
-        d = TSDB(BUCKET_TYPE="daily")
+        d = self.tsdb(BUCKET_TYPE="daily")
         for i in range(0, 50):
             d._insert("daily", [(i * 60 * 30, 1.1)])
 
@@ -221,7 +618,7 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(i2[1][0], 49 * 30 * 60)
 
     def test_weekly(self):
-        d = TSDB(BUCKET_TYPE="weekly")
+        d = self.tsdb(BUCKET_TYPE="weekly")
         for i in range(0, 20):
             d._insert("weekly", [(i * 24 * 60 * 60, 1.1)])
 
@@ -238,7 +635,7 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(i2[6][0], 10 * 24 * 60 * 60)
 
     def test_monthly(self):
-        d = TSDB(BUCKET_TYPE="monthly")
+        d = self.tsdb(BUCKET_TYPE="monthly")
         for i in range(0, 40):
             d._insert("monthly", [(i * 24 * 60 * 60, 1.1)])
 
@@ -282,7 +679,7 @@ class DatabaseTest(unittest.TestCase):
         s.insert(2000, s.pop(1800))
 
         # Insert
-        d = TSDB(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=100)
+        d = self.tsdb(BUCKET_TYPE="dynamic", BUCKET_DYNAMIC_TARGET=100)
         for p in s:
             d._insert("large", p)
 
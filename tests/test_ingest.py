@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# coding: utf8
+
+import unittest
+import shutil
+import tempfile
+import logging
+
+from stss.storage.ingest import IngestCoordinator
+
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.INFO)
+
+    def test_sharding(self):
+        with IngestCoordinator(workers=2, queue_size=4,
+                               FILE_STORAGE_FOLDER=self.folder) as c:
+            # Same key always lands on the same worker
+            self.assertEqual(c._shard("sensor1.ph"), c._shard("sensor1.ph"))
+
+            inserts = [{"key": "ingest{}".format(i % 3),
+                        "data": [(i, float(i))]} for i in range(30)]
+            pending = c.insert_bulk(inserts)
+            # Invalid keys are rejected before they are queued
+            with self.assertRaises(ValueError):
+                c.insert("hüü", [(1, 1.0)])
+            with self.assertRaises(ValueError):
+                c.insert(u"h\xfc\xfc", [(1, 1.0)])
+            invalid = c.insert("ingest.empty", [])
+            self.assertTrue(c.flush(timeout=30))
+
+            for p in pending:
+                stats = p.get(timeout=1)
+                self.assertEqual(stats["key"], p.key)
+                self.assertEqual(stats["count"], 1)
+            with self.assertRaises(ValueError):
+                invalid.get(timeout=1)
@@ -8,7 +8,7 @@ import binascii
 import datetime
 
 from stss.storage.models import Bucket, ItemType, Aggregation, TupleArray
-from stss.storage.models import ResultSet
+from stss.storage.models import ResultSet, TimeSeries
 from stss.storage.helper import to_ts
 
 
@@ -100,6 +100,108 @@ class ModelTest(unittest.TestCase):
         for x in g:
             self.assertEqual(x[1], 5.0)
 
+    def test_aggregation_windows(self):
+        ts = to_ts(datetime.datetime(2000, 1, 1, 0, 0))
+        series = TimeSeries("w", [(ts + j * 60, float(j % 10))
+                                  for j in range(60 * 24 * 62)])
+        res = ResultSet("w", series.buckets.values())
+
+        # Fixed step
+        five = list(res.aggregation(300, "count"))
+        self.assertEqual(len(five), 12 * 24 * 62)
+        self.assertEqual(five[1], (ts + 300, 5))
+
+        # Calendar windows
+        monthly = list(res.aggregation("monthly", "count"))
+        self.assertEqual([x[0] for x in monthly],
+                         [ts, to_ts(datetime.datetime(2000, 2, 1)),
+                          to_ts(datetime.datetime(2000, 3, 1))])
+        self.assertEqual([x[1] for x in monthly],
+                         [31 * 1440, 29 * 1440, 2 * 1440])
+        weekly = list(res.aggregation("weekly", "count"))
+        self.assertEqual(weekly[1], (to_ts(datetime.datetime(2000, 1, 3)),
+                                     7 * 1440))
+
+        # Sliding windows
+        sliding = list(res.aggregation(600, "count", window=1800))
+        self.assertEqual(sliding[2], (ts, 30))
+        self.assertEqual(sliding[3], (ts + 600, 30))
+        self.assertEqual(sliding[-1][1], 10)
+
+        # Percentiles
+        for _, v in res.aggregation("daily", "median", exact=True):
+            self.assertAlmostEqual(v, 4.5)
+        for _, v in res.aggregation("hourly", "p100", exact=True):
+            self.assertEqual(v, 9.0)
+
+        with self.assertRaises(ValueError):
+            res.aggregation("yearly", "sum")
+        with self.assertRaises(ValueError):
+            res.aggregation("daily", "p101")
+        with self.assertRaises(ValueError):
+            res.aggregation("daily", "sum", window=3600)
+
+    def test_aggregation_sketches(self):
+        random.seed(7)
+        series = TimeSeries("lat", [(j * 60, random.expovariate(0.01))
+                                    for j in range(60 * 24 * 3)])
+        res = ResultSet("lat", series.buckets.values())
+        res._trim(3600, 3 * 24 * 60 * 60)
+
+        for function in ("p50", "p95", "p99"):
+            approx = list(res.aggregation("daily", function))
+            exact = list(res.aggregation("daily", function, exact=True))
+            self.assertEqual(len(approx), 3)
+            for (t1, v1), (t2, v2) in zip(approx, exact):
+                self.assertEqual(t1, t2)
+                # Sketch error plus the distance between neighbouring ranks
+                self.assertLess(abs(v1 - v2) / v2, 0.05)
+
+        # Whole buckets are merged from their sketch
+        sketches = list(res.sketches("daily"))
+        self.assertEqual(len(sketches[1][1]), 1440)
+        self.assertEqual(sum(len(s) for _, s in sketches), len(res))
+
+    def test_resultset_segments(self):
+        ts = to_ts(datetime.datetime(2000, 1, 1, 0, 0))
+        series = TimeSeries("d", [(ts + j * 600, float(j)) for j in range(1440)])
+        res = ResultSet("d", series.buckets.values())
+        self.assertEqual(len(res), 1440)
+        self.assertEqual(len(res._segments), 10)
+        self.assertEqual(res[144], (ts + 144 * 600, 144.0))
+        self.assertEqual(res[-1], (ts + 1439 * 600, 1439.0))
+
+        # Trimming only touches the first and the last segment
+        res._trim(ts + 600, ts + 3 * 24 * 60 * 60)
+        self.assertEqual(len(res._segments), 4)
+        self.assertEqual(len(res), 432)
+        self.assertEqual(res[0], (ts + 600, 1.0))
+        self.assertEqual(res[-1], (ts + 432 * 600, 432.0))
+        self.assertEqual(list(res.all()), [res[x] for x in range(len(res))])
+        with self.assertRaises(IndexError):
+            res[432]
+
+        res._trim(ts + 10 * 24 * 60 * 60, ts + 11 * 24 * 60 * 60)
+        self.assertEqual(len(res), 0)
+        self.assertEqual(list(res.all()), [])
+
+    def test_timeseries_access(self):
+        series = TimeSeries("ts", [(j * 600, float(j)) for j in range(1440)])
+        self.assertEqual(len(series.buckets), 10)
+        self.assertEqual(len(series), 1440)
+        for j in (0, 143, 144, 1439):
+            self.assertEqual(series[j], (j * 600, float(j)))
+        self.assertEqual(series[-1], (1439 * 600, 1439.0))
+        with self.assertRaises(IndexError):
+            series[1440]
+        self.assertEqual(list(series.timestamps), [j * 600 for j in range(1440)])
+        self.assertEqual(sum(series.values), sum(range(1440)))
+
+        # Inserts invalidate the offsets
+        series.insert([(1440 * 600, 1440.0)])
+        self.assertEqual(len(series), 1441)
+        self.assertEqual(series[1440], (1440 * 600, 1440.0))
+
     def test_item(self):
         i1 = Bucket("test", item_type=ItemType.tuple_float_3)
         self.assertFalse(i1)
@@ -149,6 +251,27 @@ class ModelTest(unittest.TestCase):
             t.append(3)
         self.assertTrue(str(t))
 
+    def test_tuplearray_bulk(self):
+        t = TupleArray("f", 3)
+        t.extend_columns([[1.0, 4.0], [2.0, 5.0], [3.0, 6.0]])
+        t.extend([(7.0, 8.0, 9.0)])
+        self.assertEqual(len(t), 3)
+        self.assertEqual(t[-1], (7.0, 8.0, 9.0))
+        self.assertEqual(list(t.column(1)), [2.0, 5.0, 8.0])
+        with self.assertRaises(ValueError):
+            t.extend_columns([[1.0], [2.0]])
+        with self.assertRaises(IndexError):
+            t[3]
+
+        s = t[1:]
+        self.assertIsInstance(s, TupleArray)
+        self.assertEqual(list(s), [(4.0, 5.0, 6.0), (7.0, 8.0, 9.0)])
+
+        t2 = TupleArray("f", 3)
+        t2.fromstring(t.tostring())
+        self.assertEqual(t, t2)
+        self.assertEqual(len(t.tostring()), 3 * 3 * 4)
+
     def test_split(self):
         d = []
         for i in range(100):
@@ -164,6 +287,22 @@ class ModelTest(unittest.TestCase):
         self.assertEqual(len(buckets[3]), 10)
         self.assertEqual(len(i), 30)
 
+    def test_merge(self):
+        i = Bucket("merge")
+        self.assertEqual(i.merge([1, 2, 3], [1.0, 2.0, 3.0]), 3)
+        # Stored and duplicate input timestamps keep the first value
+        self.assertEqual(i.merge([0, 2, 2, 5, 5], [9.0, 9.0, 8.0, 5.0, 6.0]),
+                         2)
+        self.assertEqual(list(i._timestamps), [0, 1, 2, 3, 5])
+        self.assertEqual(list(i._values), [9.0, 1.0, 2.0, 3.0, 5.0])
+        self.assertEqual(i.merge([1, 2], [0.0, 0.0]), 0)
+
+        t = Bucket("merge", item_type=ItemType.tuple_float_2)
+        t.merge([3, 4], [(1.0, 2.0), (3.0, 4.0)])
+        t.merge([1, 3], [(0.0, 0.0), (9.0, 9.0)])
+        self.assertEqual(t[0], (1, (0.0, 0.0)))
+        self.assertEqual(t[1], (3, (1.0, 2.0)))
+
     def test_intdata(self):
         i = Bucket("int", item_type=ItemType.raw_int)
         for j in range(10):
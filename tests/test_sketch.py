@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# coding: utf8
+
+import unittest
+import random
+import logging
+
+from stss.storage.sketch import DDSketch
+from stss.storage.models import percentile
+
+
+class SketchTest(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        logging.basicConfig(level=logging.INFO)
+
+    def test_relative_error(self):
+        random.seed(42)
+        values = [random.lognormvariate(3, 1.5) for _ in range(20000)]
+        sketch = DDSketch(0.01)
+        sketch.extend(values)
+        self.assertEqual(len(sketch), 20000)
+        values.sort()
+        for q in (0.0, 0.25, 0.5, 0.9, 0.95, 0.99, 0.999, 1.0):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - expected),
+                                 0.01 * expected + 1e-9)
+
+    def test_negative_and_zero(self):
+        sketch = DDSketch(0.02)
+        sketch.extend([-100.0, -10.0, 0.0, 0.0, 10.0, 100.0])
+        self.assertAlmostEqual(sketch.quantile(0.0), -100.0, delta=2.0)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assertAlmostEqual(sketch.quantile(1.0), 100.0, delta=2.0)
+        self.assertIsNone(DDSketch().quantile(0.5))
+        with self.assertRaises(ValueError):
+            sketch.quantile(1.5)
+
+    def test_merge(self):
+        random.seed(1)
+        values = [random.uniform(1, 1000) for _ in range(10000)]
+        s1 = DDSketch()
+        s1.extend(values[:3000])
+        s2 = DDSketch()
+        s2.extend(values[3000:])
+        s1.merge(s2)
+        full = DDSketch()
+        full.extend(values)
+        self.assertEqual(s1.count, full.count)
+        self.assertEqual(dict(s1.positive), dict(full.positive))
+        self.assertLess(abs(s1.quantile(0.99) - percentile(values, 99)),
+                        0.02 * percentile(values, 99))
+        with self.assertRaises(ValueError):
+            s1.merge(DDSketch(0.05))
+
+    def test_serialization(self):
+        sketch = DDSketch()
+        sketch.extend([-5.0, 0.0, 1.5, 2.5, 1000.0])
+        s = sketch.to_string()
+        copy = DDSketch.from_string(s)
+        self.assertEqual(copy.count, 5)
+        self.assertEqual(copy.zero_count, 1)
+        self.assertEqual(dict(copy.positive), dict(sketch.positive))
+        self.assertEqual(dict(copy.negative), dict(sketch.negative))
+        for q in (0.0, 0.5, 1.0):
+            self.assertEqual(copy.quantile(q), sketch.quantile(q))
@@ -4,16 +4,34 @@
 import unittest
 import logging
 import os
+import sys
+import shutil
+import time
+import subprocess
+
+import botocore
 
 
 from stss.storage.models import Bucket, BucketType
-from stss.storage.backend import FileStorage, RedisStorage, DynamoStorage
-from stss.errors import NotFoundError
+from stss.storage import TSDB
+from stss.storage.backend import FileStorage, load_backend
+from stss.storage.backend import register_backend
+from stss.storage.redis_backend import RedisStorage
+from stss.storage.dynamo_backend import DynamoStorage, CapacityBudget
+from stss.storage.dynamo_backend import _client_config
+from stss.storage.sqlite_backend import SQLiteStorage
+from stss.errors import NotFoundError, ConflictError, InternalError
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
 
 
 class StorageTest(unittest.TestCase):
     def setUp(self):
-        pass
+        # A TSDB sets the class defaults from its settings
+        Bucket.DEFAULT_BUCKETTYPE = BucketType.dynamic
 
     def tearDown(self):
         pass
@@ -266,3 +284,424 @@ class StorageTest(unittest.TestCase):
         s = storage.range(key="test.ph")
         self.assertEqual(s["ts_min"], 1000)
         self.assertEqual(s["ts_max"], 2000)
+
+    def test_memorystore_versioning(self):
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_dir = os.path.join(test_path, "testdb")
+        if not os.path.exists(testdb_dir):
+            os.makedirs(testdb_dir)
+        for the_file in os.listdir(testdb_dir):
+            file_path = os.path.join(testdb_dir, the_file)
+            if os.path.isfile(file_path):
+                os.unlink(file_path)
+
+        # Two writers on the same folder
+        s1 = FileStorage(testdb_dir)
+        s2 = FileStorage(testdb_dir)
+
+        i = Bucket.new("test.version", [(1000, 1.0)])
+        self.assertEqual(i.version, 0)
+        s1.insert(i)
+        self.assertEqual(i.version, 1)
+        with self.assertRaises(ConflictError):
+            s2.insert(Bucket.new("test.version", [(1000, 1.0)]))
+
+        b1 = s1.get(key="test.version", range_key=1000)
+        b2 = s2.get(key="test.version", range_key=1000)
+        self.assertEqual(b1.version, 1)
+        b1.insert_point(1001, 2.0)
+        s1.update(b1)
+        self.assertEqual(b1.version, 2)
+
+        b2.insert_point(1002, 3.0)
+        with self.assertRaises(ConflictError):
+            s2.update(b2)
+
+        b2 = s2.get(key="test.version", range_key=1000)
+        b2.insert_point(1002, 3.0)
+        s2.update(b2)
+        d = s1.get(key="test.version", range_key=1000)
+        self.assertEqual(len(d), 3)
+        self.assertEqual(d.version, 3)
+
+    def test_memorystore_meta(self):
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_dir = os.path.join(test_path, "testdb")
+        if not os.path.exists(testdb_dir):
+            os.makedirs(testdb_dir)
+        for the_file in os.listdir(testdb_dir):
+            file_path = os.path.join(testdb_dir, the_file)
+            if os.path.isfile(file_path):
+                os.unlink(file_path)
+
+        storage = FileStorage(testdb_dir)
+        self.assertIsNone(storage.get_meta("test.meta"))
+        self.assertEqual(storage.list_keys(), [])
+
+        storage.put_meta("test.meta", {"count": 10})
+        storage.put_meta("test.meta2", {"count": 1})
+        storage.put_meta("other", {"count": 2})
+        self.assertEqual(storage.get_meta("test.meta"), {"count": 10})
+        self.assertEqual(storage.list_keys("test."),
+                         ["test.meta", "test.meta2"])
+        self.assertEqual(len(storage.list_keys()), 3)
+
+        def increment(meta):
+            meta = meta or {"count": 0}
+            meta["count"] += 5
+            return meta
+        self.assertEqual(storage.update_meta("test.meta", increment),
+                         {"count": 15})
+        storage.update_meta("test.new", increment)
+        self.assertEqual(storage.get_meta("test.new"), {"count": 5})
+
+    def test_memorystore_delete_range(self):
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_dir = os.path.join(test_path, "testdb")
+        if not os.path.exists(testdb_dir):
+            os.makedirs(testdb_dir)
+        for the_file in os.listdir(testdb_dir):
+            file_path = os.path.join(testdb_dir, the_file)
+            if os.path.isfile(file_path):
+                os.unlink(file_path)
+
+        storage = FileStorage(testdb_dir)
+        day = 24 * 60 * 60
+        for i in range(5):
+            storage.insert(Bucket("test.range", [(i * day + 10, 1.0)],
+                                  bucket_type=BucketType.daily))
+
+        removed = storage.delete_range("test.range", day, 3 * day)
+        self.assertEqual([b.range_key for b in removed],
+                         [day, 2 * day, 3 * day])
+        self.assertEqual(storage.first("test.range").range_key, 0)
+        self.assertEqual(len(storage.query("test.range", 0, 5 * day)), 2)
+        self.assertEqual(storage.delete_range("test.range", day, 3 * day), [])
+
+    def test_memorystore_get_many(self):
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_dir = os.path.join(test_path, "testdb")
+        if not os.path.exists(testdb_dir):
+            os.makedirs(testdb_dir)
+        for the_file in os.listdir(testdb_dir):
+            file_path = os.path.join(testdb_dir, the_file)
+            if os.path.isfile(file_path):
+                os.unlink(file_path)
+
+        storage = FileStorage(testdb_dir)
+        storage.insert(Bucket.new("test.many1", [(1000, 1.0)]))
+        storage.insert(Bucket.new("test.many1", [(2000, 2.0)]))
+        storage.insert(Bucket.new("test.many2", [(1000, 3.0)]))
+
+        res = storage.get_many([("test.many2", 1000), ("test.many1", 2000),
+                                ("test.many1", 3000), ("test.many3", 1000),
+                                ("test.many1", 1000)])
+        self.assertEqual(len(res), 5)
+        self.assertEqual(res[0][0], (1000, 3.0))
+        self.assertEqual(res[1][0], (2000, 2.0))
+        self.assertIsNone(res[2])
+        self.assertIsNone(res[3])
+        self.assertEqual(res[4][0], (1000, 1.0))
+        self.assertEqual(storage.get_many([]), [])
+
+    def test_sqlitestore(self):
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_file = os.path.join(test_path, "testdb", "test.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(testdb_file + suffix):
+                os.unlink(testdb_file + suffix)
+
+        storage = SQLiteStorage(testdb_file)
+        with self.assertRaises(NotFoundError):
+            storage.get(key="test.ph", range_key=1000)
+        with self.assertRaises(NotFoundError):
+            storage.last(key="test.ph")
+
+        storage.insert(Bucket.new("test.ph", [(1000, 1.0)]))
+        storage.insert_many([Bucket.new("test.ph", [(1100, 2.0)]),
+                             Bucket.new("test.ph", [(1200, 3.0)]),
+                             Bucket.new("test.ph", [(2000, 4.0)])])
+        with self.assertRaises(ConflictError):
+            storage.insert(Bucket.new("test.ph", [(1000, 1.0)]))
+        with self.assertRaises(ConflictError):
+            storage.insert_many([Bucket.new("test.ph", [(3000, 1.0)]),
+                                 Bucket.new("test.ph", [(2000, 1.0)])])
+        # The failed batch is rolled back as a whole
+        self.assertEqual(storage.last(key="test.ph")[0], (2000, 4.0))
+
+        self.assertEqual(storage.get(key="test.ph", range_key=1100)[0],
+                         (1100, 2.0))
+        ds = storage.query(key="test.ph", range_min=1101, range_max=1200)
+        self.assertEqual([d[0] for d in ds], [(1100, 2.0), (1200, 3.0)])
+        ds = storage.query(key="test.ph", range_min=-999, range_max=999)
+        self.assertEqual(len(ds), 0)
+        self.assertEqual(len(storage.query("test.ph", 99, 999999)), 4)
+        self.assertEqual(storage.first(key="test.ph")[0], (1000, 1.0))
+        self.assertEqual(storage.left(key="test.ph", range_key=1050)[0],
+                         (1000, 1.0))
+        res = storage.get_many([("test.ph", 2000), ("test.ph", 3000)])
+        self.assertEqual(res[0][0], (2000, 4.0))
+        self.assertIsNone(res[1])
+
+        # Versioned writes from a second connection
+        other = SQLiteStorage(testdb_file)
+        b1 = storage.get(key="test.ph", range_key=1000)
+        b2 = other.get(key="test.ph", range_key=1000)
+        b1.insert_point(1001, 1.5)
+        storage.update(b1)
+        with self.assertRaises(ConflictError):
+            other.update(b2)
+        with self.assertRaises(ConflictError):
+            other.delete(b2)
+        self.assertEqual(len(other.get(key="test.ph", range_key=1000)), 2)
+
+        removed = storage.delete_range("test.ph", 1100, 1200)
+        self.assertEqual([b.range_key for b in removed], [1100, 1200])
+        self.assertEqual(len(storage.query("test.ph", 0, 999999)), 2)
+
+        storage.insert_chunk(Bucket.new("test.ph", [(3000, 1.0)]), 2)
+        storage.insert_chunk(Bucket.new("test.ph", [(3001, 1.0)]), 1)
+        self.assertEqual([seq for seq, _ in storage.chunks("test.ph")],
+                         [1, 2])
+        storage.delete_chunks("test.ph", [1])
+        self.assertEqual([seq for seq, _ in storage.chunks("test.ph")], [2])
+
+        storage.put_meta("test.ph", {"count": 5})
+        storage.put_meta("test_other", {"count": 1})
+        self.assertEqual(storage.get_meta("test.ph"), {"count": 5})
+        self.assertIsNone(storage.get_meta("test.none"))
+        storage.update_meta("test.ph", lambda m: dict(m, count=m["count"] + 1))
+        self.assertEqual(storage.get_meta("test.ph"), {"count": 6})
+        self.assertEqual(storage.list_keys("test."), ["test.ph"])
+        self.assertEqual(len(storage.list_keys()), 2)
+
+    @unittest.skipUnless(lmdb, "lmdb is not installed")
+    def test_lmdbstore(self):
+        from stss.storage.lmdb_backend import LMDBStorage
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_dir = os.path.join(test_path, "testdb", "test.lmdb")
+        if os.path.exists(testdb_dir):
+            shutil.rmtree(testdb_dir)
+
+        storage = LMDBStorage(testdb_dir)
+        with self.assertRaises(NotFoundError):
+            storage.get(key="test.ph", range_key=1000)
+        with self.assertRaises(NotFoundError):
+            storage.last(key="test.ph")
+
+        storage.insert(Bucket.new("test.ph", [(1000, 1.0)]))
+        storage.insert_many([Bucket.new("test.ph", [(1100, 2.0)]),
+                             Bucket.new("test.ph", [(1200, 3.0)]),
+                             Bucket.new("test.ph", [(2000, 4.0)])])
+        # Neighbouring keys must not show up in the cursor walks
+        storage.insert(Bucket.new("test.p", [(1500, 9.0)]))
+        storage.insert(Bucket.new("test.ph2", [(1500, 9.0)]))
+        with self.assertRaises(ConflictError):
+            storage.insert(Bucket.new("test.ph", [(1000, 1.0)]))
+        with self.assertRaises(ConflictError):
+            storage.insert_many([Bucket.new("test.ph", [(3000, 1.0)]),
+                                 Bucket.new("test.ph", [(2000, 1.0)])])
+        self.assertEqual(storage.last(key="test.ph")[0], (2000, 4.0))
+
+        ds = storage.query(key="test.ph", range_min=1101, range_max=1200)
+        self.assertEqual([d[0] for d in ds], [(1100, 2.0), (1200, 3.0)])
+        ds = storage.query(key="test.ph", range_min=-999, range_max=999)
+        self.assertEqual(len(ds), 0)
+        self.assertEqual(len(storage.query("test.ph", 99, 999999)), 4)
+        self.assertEqual(storage.first(key="test.ph")[0], (1000, 1.0))
+        self.assertEqual(storage.left(key="test.ph", range_key=1050)[0],
+                         (1000, 1.0))
+        self.assertEqual(storage.left(key="test.ph", range_key=1100)[0],
+                         (1100, 2.0))
+        res = storage.get_many([("test.ph", 2000), ("test.ph", 3000)])
+        self.assertEqual(res[0][0], (2000, 4.0))
+        self.assertIsNone(res[1])
+
+        b1 = storage.get(key="test.ph", range_key=1000)
+        b2 = storage.get(key="test.ph", range_key=1000)
+        b1.insert_point(1001, 1.5)
+        storage.update(b1)
+        with self.assertRaises(ConflictError):
+            storage.update(b2)
+        with self.assertRaises(ConflictError):
+            storage.delete(b2)
+        self.assertEqual(len(storage.get(key="test.ph", range_key=1000)), 2)
+
+        removed = storage.delete_range("test.ph", 1100, 1200)
+        self.assertEqual([b.range_key for b in removed], [1100, 1200])
+        self.assertEqual(len(storage.query("test.ph", 0, 999999)), 2)
+        self.assertEqual(len(storage.query("test.ph2", 0, 999999)), 1)
+
+        storage.insert_chunk(Bucket.new("test.ph", [(3000, 1.0)]), 2)
+        storage.insert_chunk(Bucket.new("test.ph", [(3001, 1.0)]), 1)
+        self.assertEqual([seq for seq, _ in storage.chunks("test.ph")],
+                         [1, 2])
+        storage.delete_chunks("test.ph", [1])
+        self.assertEqual([seq for seq, _ in storage.chunks("test.ph")], [2])
+
+        storage.put_meta("test.ph", {"count": 5})
+        storage.put_meta("test_other", {"count": 1})
+        self.assertEqual(storage.get_meta("test.ph"), {"count": 5})
+        self.assertIsNone(storage.get_meta("test.none"))
+        storage.update_meta("test.ph", lambda m: dict(m, count=m["count"] + 1))
+        self.assertEqual(storage.get_meta("test.ph"), {"count": 6})
+        self.assertEqual(storage.list_keys("test."), ["test.ph"])
+        self.assertEqual(len(storage.list_keys()), 2)
+
+    def test_dynamo_throttling(self):
+        storage = DynamoStorage(table_name="testtable", local_dynamo=True,
+                                write_capacity=1000)
+        storage.BACKOFF_BASE = 0.001
+        calls = []
+
+        def throttled(**kwargs):
+            calls.append(kwargs)
+            if len(calls) < 3:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ProvisionedThroughputExceededException"}},
+                    "PutItem")
+            return {"ConsumedCapacity": {"CapacityUnits": 3.0}}
+
+        storage._call("write", throttled, units=2, Item={})
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(calls[0]["ReturnConsumedCapacity"], "TOTAL")
+        self.assertEqual(storage.throttled, 2)
+        self.assertEqual(storage.consumed["write"], 3.0)
+
+        def failing(**kwargs):
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "ValidationException"}}, "PutItem")
+        with self.assertRaises(botocore.exceptions.ClientError):
+            storage._call("write", failing)
+        self.assertEqual(storage.throttled, 2)
+
+    def test_dynamo_eventual_query(self):
+        storage = DynamoStorage(table_name="testtable", local_dynamo=True)
+        calls = []
+
+        def query_items(condition, values, forward=True, limit=None,
+                        consistent=True):
+            calls.append(consistent)
+            return []
+
+        storage._query_items = query_items
+        self.assertEqual(storage.query("test.eventual", 0, 100), [])
+        self.assertEqual(calls, [True, True])
+        del calls[:]
+        storage.query("test.eventual", 0, 100, consistent=False)
+        self.assertEqual(calls, [False, False])
+        # Reads of the insert path stay consistent
+        del calls[:]
+        with self.assertRaises(NotFoundError):
+            storage.last("test.eventual")
+        self.assertEqual(calls, [True])
+
+    def test_capacity_budget(self):
+        budget = CapacityBudget(100)
+        start = time.time()
+        budget.acquire(100)
+        budget.acquire(10)
+        self.assertGreater(time.time() - start, 0.05)
+
+    def test_dynamo_shared_clients(self):
+        s1 = DynamoStorage(table_name="testtable", local_dynamo=True)
+        s2 = DynamoStorage(table_name="othertable", local_dynamo=True)
+        self.assertIs(s1.client_low, s2.client_low)
+        self.assertIs(s1.client, s2.client)
+        s3 = DynamoStorage(table_name="testtable", local_dynamo=True,
+                           max_pool_connections=64)
+        self.assertIsNot(s1.client_low, s3.client_low)
+        self.assertTrue(DynamoStorage.CONCURRENT_READS)
+        # Retries are done by DynamoStorage only
+        self.assertEqual(_client_config(16).retries, {"max_attempts": 0})
+
+        item = s1._low_item("test.low", 1000, {"data": b"abc", "version": 2,
+                                               "sketch": None})
+        self.assertEqual(item["range_key"], {"N": "1000"})
+        self.assertEqual(s1._plain(item), {"key": "test.low",
+                                           "range_key": 1000,
+                                           "data": b"abc", "version": 2})
+        self.assertEqual(s1._names("#k = :k AND #r <= :r"),
+                         {"#k": "key", "#r": "range_key"})
+
+    def test_dynamo_meta_retries(self):
+        storage = DynamoStorage(table_name="testtable", local_dynamo=True)
+        storage.MAX_RETRIES = 2
+        storage.BACKOFF_BASE = 0.001
+        writes = []
+
+        def call(kind, func, units=1, **kwargs):
+            if kind == "read":
+                return {"Item": {"key": "test.meta", "meta": "{}"}}
+            writes.append(kwargs)
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}},
+                "PutItem")
+        storage._call = call
+
+        # Conflicting index writes give up after MAX_RETRIES
+        with self.assertRaises(InternalError):
+            storage.update_meta("test.meta", lambda m: m)
+        self.assertEqual(len(writes), 3)
+        # The meta table only exists in new deployments
+        self.assertFalse(DynamoStorage.SETTINGS["ENABLE_INDEX"])
+
+    def test_dynamo_unprocessed(self):
+        storage = DynamoStorage(table_name="testtable", local_dynamo=True)
+        storage.MAX_RETRIES = 2
+        storage.BACKOFF_BASE = 0.001
+        calls = []
+
+        def call(kind, func, units=1, RequestItems=None, **kwargs):
+            calls.append(RequestItems)
+            if kind == "read":
+                return {"Responses": {}, "UnprocessedKeys": RequestItems}
+            return {"UnprocessedItems": RequestItems}
+        storage._call = call
+
+        # Sustained throttling gives up after MAX_RETRIES
+        with self.assertRaises(InternalError):
+            storage._batch_write([{"DeleteRequest": {}}])
+        self.assertEqual(len(calls), 3)
+        with self.assertRaises(InternalError):
+            storage.get_many([("test.ph", 1000)])
+        self.assertEqual(len(calls), 6)
+
+    def test_backend_registry(self):
+        self.assertIs(load_backend("file"), FileStorage)
+        self.assertIs(load_backend("redis"), RedisStorage)
+        self.assertIs(load_backend("dynamo"), DynamoStorage)
+        with self.assertRaises(NotImplementedError):
+            load_backend("tape")
+
+        class CustomStorage(FileStorage):
+            SETTINGS = {"CUSTOM_FOLDER": "./custom/"}
+
+            @classmethod
+            def from_settings(cls, settings):
+                return cls(settings["CUSTOM_FOLDER"])
+
+        test_path = os.path.dirname(os.path.realpath(__file__))
+        testdb_dir = os.path.join(test_path, "testdb")
+        register_backend("custom", CustomStorage)
+        d = TSDB(STORAGE="custom", CUSTOM_FOLDER=testdb_dir)
+        self.assertIsInstance(d.storage, CustomStorage)
+        self.assertEqual(d.storage.storage_path, testdb_dir)
+        self.assertNotIn("FILE_STORAGE_FOLDER", d.settings)
+
+        d = TSDB(STORAGE="file", FILE_STORAGE_FOLDER=testdb_dir)
+        self.assertEqual(d.storage.storage_path, testdb_dir)
+
+    def test_lazy_imports(self):
+        # Importing stss must not pull in the backend dependencies
+        code = ("import sys, stss.storage; "
+                "print(','.join(m for m in ('redis', 'boto3', 'botocore', "
+                "'multiprocessing.pool') if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, "-c", code])
+        self.assertEqual(out.strip(), b"")
+
+        # Cold start budget in seconds, measured in a fresh interpreter
+        code = ("import time; t = time.time(); import stss.storage; "
+                "print(time.time() - t)")
+        out = subprocess.check_output([sys.executable, "-c", code])
+        self.assertLess(float(out.strip()), 0.25)